@@ -2,6 +2,8 @@
 ASGI config for freecups project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it (e.g. ``uvicorn freecups.asgi:application``) for the live map updates
+stream at /map/live, which WSGI servers refuse (see map/realtime.py).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
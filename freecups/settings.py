@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 from pathlib import Path
 import os
 from dotenv import load_dotenv
+from .database import database_config
 
 # Load environment variables
 load_dotenv()
@@ -82,14 +83,55 @@ WSGI_APPLICATION = "freecups.wsgi.application"
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
+# Configured from DATABASE_URL (SQLite in BASE_DIR when unset), see freecups/database.py
 
 DATABASES = {
+    "default": database_config(BASE_DIR),
+}
+
+
+# Cache
+# CACHE_URL selects the backend: redis://host:6379/0 (Django's RedisCache, needs the redis
+# package), locmem:// (per process, the default) or dummy:// (caching disabled).
+# Bump CACHE_VERSION to invalidate every key after an incompatible deploy.
+
+CACHE_URL = os.getenv("CACHE_URL", "locmem://")
+if CACHE_URL.startswith(("redis://", "rediss://", "unix://")):
+    _cache_backend = {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": CACHE_URL}
+elif CACHE_URL.startswith("dummy://"):
+    _cache_backend = {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
+else:
+    _cache_backend = {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "freecups"}
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        **_cache_backend,
+        "KEY_PREFIX": "freecups",
+        "VERSION": int(os.getenv("CACHE_VERSION", "1")),
+        "TIMEOUT": 300,
     }
 }
 
+# Seconds the rendered map page, filter fragment and facets are cached (changes invalidate them earlier)
+MAP_CACHE_TIMEOUT = int(os.getenv("MAP_CACHE_TIMEOUT", "300"))
+
+# Rendered point tiles of the map (see map/tiles.py); safe to delete at any time
+TILE_CACHE_DIR = Path(os.getenv("TILE_CACHE_DIR") or BASE_DIR / "tile_cache")
+
+# Pre-serialized map snapshots (see map/snapshots.py); rebuilt SNAPSHOT_DEBOUNCE seconds after
+# the last Location change, at most SNAPSHOT_MAX_DELAY seconds after the first
+SNAPSHOT_DIR = Path(os.getenv("SNAPSHOT_DIR") or BASE_DIR / "snapshots")
+SNAPSHOT_DEBOUNCE = float(os.getenv("SNAPSHOT_DEBOUNCE", "5"))
+SNAPSHOT_MAX_DELAY = float(os.getenv("SNAPSHOT_MAX_DELAY", "60"))
+
+
+# Live map updates (see map/realtime.py): map.realtime.InProcessBroker serves a single ASGI
+# process; map.realtime.RedisBroker (REALTIME_REDIS_URL, default CACHE_URL) reaches every worker
+# and also carries changes made by management commands
+REALTIME_BROKER = os.getenv("REALTIME_BROKER", "map.realtime.InProcessBroker")
+REALTIME_REDIS_URL = os.getenv("REALTIME_REDIS_URL") or None
+REALTIME_BATCH_INTERVAL = float(os.getenv("REALTIME_BATCH_INTERVAL", "0.5"))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -131,6 +173,19 @@ STATIC_URL = "static/"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'map' / 'media'
 
+# Address normalization rule tables (see map/normalization.py; default map/address_rules.json)
+# and the country whose rules apply to addresses without one
+ADDRESS_RULES_FILE = os.getenv("ADDRESS_RULES_FILE") or None
+ADDRESS_DEFAULT_COUNTRY = os.getenv("ADDRESS_DEFAULT_COUNTRY", "Israel")
+
+# Geocoding backend (dotted path) and optional offline answers for map.geocoders.StaticGeocoder
+GEOCODER_BACKEND = os.getenv("GEOCODER_BACKEND", "map.geocoders.NominatimGeocoder")
+GEOCODER_STATIC_FILE = os.getenv("GEOCODER_STATIC_FILE") or None
+# Index file of map.geocoders.GazetteerGeocoder (built by manage.py build_gazetteer) and the
+# backends tried in order by map.geocoders.FallbackGeocoder
+GEOCODER_GAZETTEER = os.getenv("GEOCODER_GAZETTEER") or None
+GEOCODER_CHAIN = os.getenv("GEOCODER_CHAIN", "map.geocoders.GazetteerGeocoder,map.geocoders.NominatimGeocoder").split(",")
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -1,8 +1,25 @@
-from django.contrib import admin
-from .models import Location, Event
+import csv
+import io
+from django import forms
+from django.contrib import admin, messages
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.html import format_html, format_html_join
+from .importer import FORMATS, LocationImporter, detect_format
+from .recommendations import HolderRecommender
+from .models import Location, Event, GeocodingJob, RemoteImage
 from .tasks import geocode_selected_locations
 
 
+class LocationImportForm(forms.Form):
+    file = forms.FileField(help_text="CSV with a header row, or JSON Lines (one object per line)")
+    format = forms.ChoiceField(
+        choices=[('', 'From file extension')] + [(fmt, fmt.upper()) for fmt in FORMATS], required=False
+    )
+    dry_run = forms.BooleanField(required=False, help_text="Validate only, write nothing")
+
+
 @admin.register(Location)
 class LocationAdmin(admin.ModelAdmin):
     list_display = ('name', 'location_type', 'category', 'city', 'country', 'has_coordinates', 'created_at')
@@ -11,6 +28,47 @@ class LocationAdmin(admin.ModelAdmin):
     readonly_fields = ('created_at', 'updated_at')
     actions = [geocode_selected_locations]
     
+    def get_urls(self):
+        urls = [
+            path('import/', self.admin_site.admin_view(self.import_view), name='map_location_import'),
+        ]
+        return urls + super().get_urls()
+    
+    def import_view(self, request):
+        """Upload counterpart of the import_locations command."""
+        if not self.has_add_permission(request):
+            return redirect('admin:map_location_changelist')
+        form = LocationImportForm(request.POST or None, request.FILES or None)
+        result = None
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            fmt = form.cleaned_data['format'] or detect_format(upload.name)
+            importer = LocationImporter(dry_run=form.cleaned_data['dry_run'])
+            verb = "Validated" if importer.dry_run else "Imported"
+            try:
+                result = importer.run(io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline=''), fmt)
+            except (UnicodeDecodeError, csv.Error) as e:
+                # Not UTF-8 or not a CSV file; batches before the bad line are already saved
+                result = importer.result
+                form.add_error('file', f"Cannot read the file after line {result.rows}: {e}. {verb} {result.created} rows before it.")
+            else:
+                self.message_user(
+                    request,
+                    f"{verb} {result.created} of {result.rows} rows in {result.seconds:.2f}s "
+                    f"({result.rows_per_second:,.0f} rows/s); {result.geocoding_queued} queued for geocoding.",
+                    messages.WARNING if result.errors else messages.SUCCESS,
+                )
+                if not result.errors and not importer.dry_run:
+                    return redirect('admin:map_location_changelist')
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Import locations',
+            'opts': self.model._meta,
+            'form': form,
+            'result': result,
+        }
+        return TemplateResponse(request, 'admin/map/location/import.html', context)
+    
     fieldsets = (
         ('Basic Info', {
             'fields': ('name', 'location_type', 'category')
@@ -44,14 +102,14 @@ class EventAdmin(admin.ModelAdmin):
     list_filter = ('buyer', 'created_at')
     search_fields = ('name', 'description', 'buyer__name')
     filter_horizontal = ('holders',)
-    readonly_fields = ('created_at', 'updated_at')
+    readonly_fields = ('created_at', 'updated_at', 'recommended_holders')
     
     fieldsets = (
         ('Event Info', {
             'fields': ('name', 'description')
         }),
         ('Participants', {
-            'fields': ('buyer', 'holders')
+            'fields': ('buyer', 'holders', 'recommended_holders')
         }),
         ('Metadata', {
             'fields': ('created_at', 'updated_at'),
@@ -63,4 +121,37 @@ class EventAdmin(admin.ModelAdmin):
         """Display count of holders in this event."""
         return obj.holders.count()
     holder_count.short_description = 'Holders'
+    
+    def recommended_holders(self, obj):
+        """Best-ranked holders for the buyer that are not in a recent event."""
+        if obj is None or obj.pk is None:
+            return "Save the event to see recommendations."
+        try:
+            holders = HolderRecommender.recommend(obj.buyer, limit=10)
+        except ValueError as e:
+            return str(e)
+        if not holders:
+            return "No available holders nearby."
+        return format_html('<ol>{}</ol>', format_html_join(
+            '', '<li>{} ({}, {} m, score {})</li>',
+            ((holder['name'], holder['city'], round(holder['distance']), holder['score']) for holder in holders),
+        ))
+    recommended_holders.short_description = 'Recommended holders'
+
+
+
+@admin.register(GeocodingJob)
+class GeocodingJobAdmin(admin.ModelAdmin):
+    list_display = ('location', 'status', 'attempts', 'run_after', 'locked_by', 'updated_at')
+    list_filter = ('status',)
+    search_fields = ('location__name', 'last_error')
+    raw_id_fields = ('location',)
+    readonly_fields = ('created_at', 'updated_at')
+
 
+@admin.register(RemoteImage)
+class RemoteImageAdmin(admin.ModelAdmin):
+    list_display = ('url', 'status', 'size', 'failures', 'fetched_at', 'check_after')
+    list_filter = ('status',)
+    search_fields = ('url', 'last_error')
+    readonly_fields = ('content_hash', 'size', 'etag', 'last_modified', 'fetched_at')
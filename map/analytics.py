@@ -0,0 +1,148 @@
+"""Event coverage: which businesses (by category) lie around each holder of an event.
+
+For every holder with coordinates, the businesses within the catchment radius
+come from one geohash-indexed query (LocationQuerySet.within_radius), which
+also computes the distances in SQL. Each holder's catchment is cached on its
+own under a versioned key (map.caching), so when an event's holders change
+only the added holders are queried; the event summary is then merged from
+the cached catchments. Any Location change that moves the map generation
+invalidates the catchments too.
+"""
+import math
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from .caching import cache_timeout, versioned_key
+from .models import Event, Location
+from .spatial import haversine_m
+
+
+# Catchment radius in metres (override with settings.EVENT_CATCHMENT_RADIUS)
+DEFAULT_CATCHMENT_RADIUS = 500
+
+# Upper edges (metres) of the distance distribution buckets; the last bucket is open-ended
+DISTANCE_BUCKETS = (100, 250, 500, 1000, 2000)
+
+
+def catchment_radius() -> float:
+    return getattr(settings, 'EVENT_CATCHMENT_RADIUS', DEFAULT_CATCHMENT_RADIUS)
+
+
+def bucket_label(distance: float) -> str:
+    low = 0
+    for edge in DISTANCE_BUCKETS:
+        if distance <= edge:
+            return f"{low}-{edge}m"
+        low = edge
+    return f"{low}m+"
+
+
+def distance_stats(distances) -> dict:
+    """min / median / mean / max of a list of metres (None when empty)."""
+    if not distances:
+        return None
+    distances = sorted(distances)
+    middle = len(distances) // 2
+    median = distances[middle] if len(distances) % 2 else (distances[middle - 1] + distances[middle]) / 2
+    return {
+        'min': round(distances[0], 1),
+        'median': round(median, 1),
+        'mean': round(math.fsum(distances) / len(distances), 1),
+        'max': round(distances[-1], 1),
+    }
+
+
+class EventCoverage:
+    """Business catchment per holder and per event."""
+
+    @staticmethod
+    def _holder_key(holder_id, latitude, longitude, radius):
+        return versioned_key('catchment', holder_id, str(latitude), str(longitude), radius)
+
+    @staticmethod
+    def compute_catchment(latitude, longitude, radius) -> list:
+        """[(business id, category, metres)] of businesses within radius of a point, nearest first."""
+        rows = Location.objects.filter(location_type=Location.TYPE_BUSINESS).within_radius(
+            float(latitude), float(longitude), radius
+        ).order_by('distance').values_list('id', 'category', 'distance')
+        return [(business_id, category or '', round(distance, 1)) for business_id, category, distance in rows]
+
+    @classmethod
+    def catchments(cls, holders, radius) -> dict:
+        """{holder id: catchment} for (id, latitude, longitude) holders, querying only uncached ones."""
+        keys = {cls._holder_key(pk, lat, lng, radius): (pk, lat, lng) for pk, lat, lng in holders}
+        cached = cache.get_many(list(keys))
+        found = {keys[key][0]: value for key, value in cached.items()}
+        missing = {}
+        for key, (pk, lat, lng) in keys.items():
+            if key not in cached:
+                found[pk] = missing[key] = cls.compute_catchment(lat, lng, radius)
+        if missing:
+            cache.set_many(missing, cache_timeout())
+        return found
+
+    @classmethod
+    def compute(cls, event: Event, radius: float = None) -> dict:
+        """Coverage summary of one event."""
+        radius = radius or catchment_radius()
+        buyer = event.buyer
+        holders = list(event.holders.order_by('id').values_list('id', 'name', 'latitude', 'longitude'))
+        located = [(pk, lat, lng) for pk, _, lat, lng in holders if lat is not None and lng is not None]
+        catchments = cls.catchments(located, radius)
+
+        per_holder = []
+        business_categories = {}
+        pair_distances = []
+        buckets = Counter()
+        buyer_distances = []
+        for pk, name, lat, lng in holders:
+            if pk not in catchments:
+                continue
+            catchment = catchments[pk]
+            categories = Counter(category for _, category, _ in catchment)
+            distances = [distance for _, _, distance in catchment]
+            to_buyer = None
+            if buyer.latitude is not None and buyer.longitude is not None:
+                to_buyer = round(haversine_m(float(buyer.latitude), float(buyer.longitude), float(lat), float(lng)), 1)
+                buyer_distances.append(to_buyer)
+            per_holder.append({
+                'id': pk,
+                'name': name,
+                'businesses': len(catchment),
+                'categories': dict(categories.most_common()),
+                'distances': distance_stats(distances),
+                'buyer_distance': to_buyer,
+            })
+            for business_id, category, _ in catchment:
+                business_categories[business_id] = category
+            pair_distances.extend(distances)
+            buckets.update(bucket_label(distance) for distance in distances)
+
+        return {
+            'event_id': event.id,
+            'radius': radius,
+            'holders': per_holder,
+            'unlocated_holders': [pk for pk, _, lat, lng in holders if pk not in catchments],
+            # A business near several holders is counted once
+            'businesses': len(business_categories),
+            'categories': dict(Counter(business_categories.values()).most_common()),
+            'holder_business_pairs': len(pair_distances),
+            'distances': distance_stats(pair_distances),
+            'distance_buckets': {
+                label: buckets[label]
+                for label in [bucket_label(edge) for edge in DISTANCE_BUCKETS] + [bucket_label(math.inf)]
+            },
+            'buyer_distances': distance_stats(buyer_distances),
+        }
+
+    @classmethod
+    def get(cls, event: Event, radius: float = None) -> dict:
+        """Cached summary; a changed holder set or map generation misses the cache."""
+        radius = radius or catchment_radius()
+        holder_ids = tuple(event.holders.order_by('id').values_list('id', flat=True))
+        key = versioned_key('event_coverage', event.id, event.buyer_id, holder_ids, radius)
+        summary = cache.get(key)
+        if summary is None:
+            summary = cls.compute(event, radius)
+            cache.set(key, summary, cache_timeout())
+        return summary
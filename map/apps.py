@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MapConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "map"
+
+    def ready(self):
+        import map.signals  # noqa
+        import map.tasks  # noqa
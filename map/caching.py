@@ -0,0 +1,64 @@
+"""Versioned cache keys for map data (rendered page, fragments, facets).
+
+Every key embeds a generation number. Any Location change that affects what
+the map shows bumps the generation (see map.signals), which orphans all
+cached entries at once; they then age out through their timeout. This avoids
+having to enumerate every filter combination on invalidation.
+"""
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+
+GENERATION_KEY = 'map:generation'
+
+# Timeout of cached map data in seconds (override with settings.MAP_CACHE_TIMEOUT)
+DEFAULT_TIMEOUT = 300
+
+
+def cache_timeout() -> int:
+    return getattr(settings, 'MAP_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def generation() -> int:
+    """Current map data generation."""
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        # Missing (first use or evicted): start from the clock so old generations are never reused
+        cache.add(GENERATION_KEY, time.time_ns(), None)
+        value = cache.get(GENERATION_KEY, time.time_ns())
+    return value
+
+
+async def ageneration() -> int:
+    """Async generation()."""
+    value = await cache.aget(GENERATION_KEY)
+    if value is None:
+        await cache.aadd(GENERATION_KEY, time.time_ns(), None)
+        value = await cache.aget(GENERATION_KEY, time.time_ns())
+    return value
+
+
+def bump_generation():
+    """Invalidate every versioned map cache entry."""
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+
+
+def versioned_key(name: str, *parts) -> str:
+    """Cache key valid until the next bump_generation(); free-form parts (filter values) are hashed."""
+    key = f"map:{generation()}:{name}"
+    if parts:
+        key += ':' + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+    return key
+
+
+async def aversioned_key(name: str, *parts) -> str:
+    """Async versioned_key()."""
+    key = f"map:{await ageneration()}:{name}"
+    if parts:
+        key += ':' + hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+    return key
@@ -0,0 +1,214 @@
+"""Server-side grid clustering of locations, precomputed per zoom level.
+
+Each zoom level is split into square Web Mercator cells of CLUSTER_CELL_SIZE
+pixels. Every Location adds 1 to one cell per zoom level, so a save or delete
+only touches the cells it leaves and enters instead of reclustering the table.
+"""
+import math
+from collections import defaultdict
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from .models import Location, LocationCluster
+
+
+# Clusters are precomputed for zoom 0..CLUSTER_MAX_ZOOM; above it the map shows single markers
+CLUSTER_MAX_ZOOM = 13
+
+# Map tiles are 256px, so each tile holds TILE_SIZE / CLUSTER_CELL_SIZE cells per axis
+TILE_SIZE = 256
+CLUSTER_CELL_SIZE = 64
+CELLS_PER_TILE = TILE_SIZE // CLUSTER_CELL_SIZE
+
+# Web Mercator is undefined at the poles
+MAX_LATITUDE = 85.05112878
+
+BULK_BATCH_SIZE = 1000
+
+
+def cell_for(latitude: float, longitude: float, zoom: int):
+    """Return the (cell_x, cell_y) grid cell of a coordinate at a zoom level."""
+    cells = CELLS_PER_TILE << zoom
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    x = (longitude + 180.0) / 360.0
+    y = (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0
+    return (
+        min(cells - 1, max(0, int(x * cells))),
+        min(cells - 1, max(0, int(y * cells))),
+    )
+
+
+def cluster_key(location):
+    """Return the clustering-relevant values of a Location, or None if it has no coordinates."""
+    if location.latitude is None or location.longitude is None:
+        return None
+    return (
+        float(location.latitude),
+        float(location.longitude),
+        location.country or '',
+        location.location_type,
+        location.category or '',
+    )
+
+
+def _cells_q(key):
+    """Q matching the cluster rows of a key across all zoom levels."""
+    latitude, longitude, country, location_type, category = key
+    cells = Q()
+    for zoom in range(CLUSTER_MAX_ZOOM + 1):
+        cell_x, cell_y = cell_for(latitude, longitude, zoom)
+        cells |= Q(zoom=zoom, cell_x=cell_x, cell_y=cell_y)
+    return cells & Q(country=country, location_type=location_type, category=category)
+
+
+def add_to_clusters(key):
+    """Count a location in its cell at every zoom level."""
+    latitude, longitude, country, location_type, category = key
+    with transaction.atomic():
+        rows = LocationCluster.objects.filter(_cells_q(key))
+        existing = set(rows.values_list('zoom', flat=True))
+        rows.update(
+            count=F('count') + 1,
+            latitude_sum=F('latitude_sum') + latitude,
+            longitude_sum=F('longitude_sum') + longitude,
+        )
+        missing = []
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            if zoom in existing:
+                continue
+            cell_x, cell_y = cell_for(latitude, longitude, zoom)
+            missing.append(LocationCluster(
+                zoom=zoom, cell_x=cell_x, cell_y=cell_y,
+                country=country, location_type=location_type, category=category,
+                count=1, latitude_sum=latitude, longitude_sum=longitude,
+            ))
+        if missing:
+            try:
+                with transaction.atomic():
+                    LocationCluster.objects.bulk_create(missing)
+            except IntegrityError:
+                # A concurrent save created some of the cells first; count into those instead
+                for cluster in missing:
+                    try:
+                        with transaction.atomic():
+                            cluster.save(force_insert=True)
+                    except IntegrityError:
+                        LocationCluster.objects.filter(
+                            zoom=cluster.zoom, cell_x=cluster.cell_x, cell_y=cluster.cell_y,
+                            country=country, location_type=location_type, category=category,
+                        ).update(
+                            count=F('count') + 1,
+                            latitude_sum=F('latitude_sum') + latitude,
+                            longitude_sum=F('longitude_sum') + longitude,
+                        )
+
+
+def remove_from_clusters(key):
+    """Remove a location from its cell at every zoom level, dropping empty cells."""
+    latitude, longitude = key[0], key[1]
+    with transaction.atomic():
+        rows = LocationCluster.objects.filter(_cells_q(key))
+        rows.update(
+            count=F('count') - 1,
+            latitude_sum=F('latitude_sum') - latitude,
+            longitude_sum=F('longitude_sum') - longitude,
+        )
+        rows.filter(count__lte=0).delete()
+
+
+def update_clusters(old_key, new_key):
+    """Move a location between clusters after a save or delete (either key may be None)."""
+    if old_key == new_key:
+        return
+    if old_key is not None:
+        remove_from_clusters(old_key)
+    if new_key is not None:
+        add_to_clusters(new_key)
+
+
+def rebuild_clusters():
+    """Recompute every cluster from scratch. Returns the number of cluster rows written."""
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    rows = Location.objects.filter(latitude__isnull=False, longitude__isnull=False).values_list(
+        'latitude', 'longitude', 'country', 'location_type', 'category'
+    )
+    for latitude, longitude, country, location_type, category in rows.iterator(chunk_size=BULK_BATCH_SIZE):
+        latitude, longitude = float(latitude), float(longitude)
+        for zoom in range(CLUSTER_MAX_ZOOM + 1):
+            cell_x, cell_y = cell_for(latitude, longitude, zoom)
+            total = totals[(zoom, cell_x, cell_y, country or '', location_type, category or '')]
+            total[0] += 1
+            total[1] += latitude
+            total[2] += longitude
+
+    with transaction.atomic():
+        LocationCluster.objects.all().delete()
+        LocationCluster.objects.bulk_create(
+            (
+                LocationCluster(
+                    zoom=zoom, cell_x=cell_x, cell_y=cell_y,
+                    country=country, location_type=location_type, category=category,
+                    count=count, latitude_sum=latitude_sum, longitude_sum=longitude_sum,
+                )
+                for (zoom, cell_x, cell_y, country, location_type, category), (count, latitude_sum, longitude_sum)
+                in totals.items()
+            ),
+            batch_size=BULK_BATCH_SIZE,
+        )
+    return len(totals)
+
+
+# Columns read from LocationCluster to build a tile
+TILE_CLUSTER_FIELDS = ('cell_x', 'cell_y', 'location_type', 'category', 'count', 'latitude_sum', 'longitude_sum')
+
+
+def _tile_rows(zoom: int, tile_x: int, tile_y: int, country='', location_type='', category=''):
+    rows = LocationCluster.objects.filter(
+        zoom=zoom,
+        cell_x__gte=tile_x * CELLS_PER_TILE, cell_x__lt=(tile_x + 1) * CELLS_PER_TILE,
+        cell_y__gte=tile_y * CELLS_PER_TILE, cell_y__lt=(tile_y + 1) * CELLS_PER_TILE,
+    )
+    if country:
+        rows = rows.filter(country__iexact=country)
+    if location_type:
+        rows = rows.filter(location_type=location_type)
+    if category:
+        rows = rows.filter(category=category)
+    return rows.values(*TILE_CLUSTER_FIELDS)
+
+
+def _merge_cells(rows):
+    """Merge per-(type, category) cluster rows into one cluster per cell."""
+    cells = {}
+    for row in rows:
+        cell = cells.setdefault((row['cell_x'], row['cell_y']), {
+            'count': 0, 'latitude_sum': 0.0, 'longitude_sum': 0.0, 'types': {}, 'categories': {},
+        })
+        cell['count'] += row['count']
+        cell['latitude_sum'] += row['latitude_sum']
+        cell['longitude_sum'] += row['longitude_sum']
+        cell['types'][row['location_type']] = cell['types'].get(row['location_type'], 0) + row['count']
+        if row['category']:
+            cell['categories'][row['category']] = cell['categories'].get(row['category'], 0) + row['count']
+
+    return [
+        {
+            'lat': round(cell['latitude_sum'] / cell['count'], 6),
+            'lng': round(cell['longitude_sum'] / cell['count'], 6),
+            'count': cell['count'],
+            'types': cell['types'],
+            'categories': cell['categories'],
+        }
+        for cell in cells.values()
+        if cell['count'] > 0
+    ]
+
+
+def clusters_for_tile(zoom: int, tile_x: int, tile_y: int, country='', location_type='', category=''):
+    """Return the clusters inside map tile z/x/y, with counts broken down by type and category."""
+    return _merge_cells(_tile_rows(zoom, tile_x, tile_y, country, location_type, category))
+
+
+async def aclusters_for_tile(zoom: int, tile_x: int, tile_y: int, country='', location_type='', category=''):
+    """Async clusters_for_tile()."""
+    rows = _tile_rows(zoom, tile_x, tile_y, country, location_type, category)
+    return _merge_cells([row async for row in rows])
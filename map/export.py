@@ -0,0 +1,143 @@
+"""Streaming exports of locations and events as CSV, JSON Lines or GeoJSON.
+
+Rows come from values_list() projections read with .iterator(chunk_size), and
+are rendered into text chunks as they arrive, so memory stays flat however many
+rows are exported. Events are flattened to one row per (event, holder); events
+without holders produce a single row with empty holder columns.
+"""
+import csv
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from .models import Event, Location
+
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Rendered rows per yielded piece of output (a few hundred KB)
+ROWS_PER_PIECE = 500
+
+FORMATS = ('csv', 'jsonl', 'geojson')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson',
+    'geojson': 'application/geo+json',
+}
+
+# (output column, ORM lookup) per dataset
+LOCATION_COLUMNS = (
+    ('id', 'id'),
+    ('name', 'name'),
+    ('location_type', 'location_type'),
+    ('category', 'category'),
+    ('address', 'address'),
+    ('city', 'city'),
+    ('country', 'country'),
+    ('latitude', 'latitude'),
+    ('longitude', 'longitude'),
+    ('company_logo_url', 'company_logo_url'),
+    ('product_photo_url', 'product_photo_url'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+)
+EVENT_COLUMNS = (
+    ('event_id', 'id'),
+    ('event_name', 'name'),
+    ('buyer_id', 'buyer_id'),
+    ('buyer_name', 'buyer__name'),
+    ('holder_id', 'holders__id'),
+    ('holder_name', 'holders__name'),
+    ('holder_city', 'holders__city'),
+    ('holder_latitude', 'holders__latitude'),
+    ('holder_longitude', 'holders__longitude'),
+    ('created_at', 'created_at'),
+)
+
+# dataset: (columns, ordering, GeoJSON coordinate columns)
+DATASETS = {
+    'locations': (LOCATION_COLUMNS, ('id',), ('latitude', 'longitude')),
+    'events': (EVENT_COLUMNS, ('id', 'holders__id'), ('holder_latitude', 'holder_longitude')),
+}
+
+
+def default_queryset(dataset: str):
+    return Location.objects.all() if dataset == 'locations' else Event.objects.all()
+
+
+def export_rows(dataset: str, queryset=None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Yield one dict per exported row, reading chunk_size rows at a time."""
+    columns, ordering, coordinates = DATASETS[dataset]
+    if queryset is None:
+        queryset = default_queryset(dataset)
+    names = [name for name, _ in columns]
+    # The holders join is a LEFT OUTER JOIN, so events without holders are kept
+    rows = queryset.order_by(*ordering).values_list(*(lookup for _, lookup in columns))
+    for values in rows.iterator(chunk_size=chunk_size):
+        row = dict(zip(names, values))
+        # Numbers rather than the Decimal strings DjangoJSONEncoder would write
+        for name in coordinates:
+            if row[name] is not None:
+                row[name] = float(row[name])
+        yield row
+
+
+def _pieces(lines):
+    """Join rendered lines into larger pieces so the response is not written row by row."""
+    piece = []
+    for line in lines:
+        piece.append(line)
+        if len(piece) >= ROWS_PER_PIECE:
+            yield ''.join(piece)
+            piece = []
+    if piece:
+        yield ''.join(piece)
+
+
+class _Echo:
+    """File-like object handing csv.writer output straight back."""
+
+    def write(self, value):
+        return value
+
+
+def render_csv(rows, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in columns])
+    for row in rows:
+        yield writer.writerow(row.values())
+
+
+def render_jsonl(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def render_geojson(rows, latitude_column, longitude_column):
+    """A FeatureCollection with one Point feature per row (null geometry without coordinates)."""
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ''
+    for row in rows:
+        latitude, longitude = row.pop(latitude_column), row.pop(longitude_column)
+        geometry = None
+        if latitude is not None and longitude is not None:
+            geometry = {'type': 'Point', 'coordinates': [longitude, latitude]}
+        feature = {'type': 'Feature', 'geometry': geometry, 'properties': row}
+        yield separator + json.dumps(feature, cls=DjangoJSONEncoder)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+def stream_export(dataset: str, fmt: str, queryset=None, chunk_size: int = EXPORT_CHUNK_SIZE):
+    """Iterator of text pieces making up the whole export."""
+    if dataset not in DATASETS:
+        raise ValueError(f"Unknown export dataset: {dataset!r} (expected one of {', '.join(DATASETS)})")
+    columns, _, (latitude_column, longitude_column) = DATASETS[dataset]
+    rows = export_rows(dataset, queryset, chunk_size)
+    if fmt == 'csv':
+        lines = render_csv(rows, columns)
+    elif fmt == 'jsonl':
+        lines = render_jsonl(rows)
+    elif fmt == 'geojson':
+        lines = render_geojson(rows, latitude_column, longitude_column)
+    else:
+        raise ValueError(f"Unknown export format: {fmt!r} (expected one of {', '.join(FORMATS)})")
+    return _pieces(lines)
@@ -0,0 +1,76 @@
+"""Cached filter facets (countries, types, categories with location counts) for the map page.
+
+Computed with one GROUP BY query and kept in the Django cache under a
+versioned key (map.caching) until a Location save or delete changes a
+faceted field (see map.signals). Code that bypasses signals (bulk_update,
+queryset.update) must call invalidate().
+"""
+from django.core.cache import cache
+from django.db.models import Count, Q
+from .caching import aversioned_key, bump_generation, cache_timeout, versioned_key
+from .models import Location
+
+
+# Location fields the facets (and the map page extent) are built from
+FACET_FIELDS = ('country', 'location_type', 'category', 'latitude', 'longitude')
+
+
+class LocationFacets:
+    """Per-country, per-type and per-category counts of locations shown on the map."""
+
+    @staticmethod
+    def _rows():
+        return Location.objects.values('country', 'location_type', 'category').annotate(
+            mapped=Count('id', filter=Q(latitude__isnull=False, longitude__isnull=False))
+        ).order_by()
+
+    @staticmethod
+    def _build(rows) -> dict:
+        valid_categories = dict(Location.CATEGORY_CHOICES)
+        countries, types, categories = {}, {}, {}
+        for row in rows:
+            if row['country']:
+                countries[row['country']] = countries.get(row['country'], 0) + row['mapped']
+            types[row['location_type']] = types.get(row['location_type'], 0) + row['mapped']
+            # Only categories from CATEGORY_CHOICES that exist in the data
+            if row['category'] in valid_categories:
+                categories[row['category']] = categories.get(row['category'], 0) + row['mapped']
+
+        return {
+            'countries': sorted(countries.items()),
+            'types': types,
+            'categories': [(key, valid_categories[key], categories[key]) for key in sorted(categories)],
+        }
+
+    @classmethod
+    def compute(cls) -> dict:
+        """Build the facets from the database.
+
+        Every country in use is listed; counts only include locations with coordinates.
+        """
+        return cls._build(cls._rows())
+
+    @classmethod
+    def get(cls) -> dict:
+        """Cached facets: {'countries': [(name, count)], 'types': {type: count}, 'categories': [(key, label, count)]}."""
+        key = versioned_key('facets')
+        facets = cache.get(key)
+        if facets is None:
+            facets = cls.compute()
+            cache.set(key, facets, cache_timeout())
+        return facets
+
+    @classmethod
+    async def aget(cls) -> dict:
+        """Async get()."""
+        key = await aversioned_key('facets')
+        facets = await cache.aget(key)
+        if facets is None:
+            facets = cls._build([row async for row in cls._rows()])
+            await cache.aset(key, facets, cache_timeout())
+        return facets
+
+    @staticmethod
+    def invalidate():
+        """Invalidate the facets together with every other versioned map cache entry."""
+        bump_generation()
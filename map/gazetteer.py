@@ -0,0 +1,181 @@
+"""Memory-mapped gazetteer index for offline geocoding.
+
+A gazetteer extract (street, house number, city, country, coordinates) is
+compiled once by the build_gazetteer command into a sorted binary file:
+
+    b'FCG1'  uint32 count
+    count x (uint32 key offset, uint16 key length, int32 lat * 1e6, int32 lng * 1e6)
+    keys (UTF-8, sorted bytewise)
+
+Keys are "country \\x1f city \\x1f street \\x1f number", normalized the same way
+as Location addresses and case-folded, so one street's numbers and one city's
+streets are contiguous. The file is opened with mmap: lookups are binary
+searches over the mapped pages, nothing is loaded up front and processes
+share the page cache. Queries try the exact street, then the first street
+starting with the query, then the closest street of the city by edit distance.
+"""
+import mmap
+import os
+import re
+import struct
+import tempfile
+from bisect import bisect_left
+from functools import lru_cache
+from pathlib import Path
+from .models import Location
+
+
+GAZETTEER_MAGIC = b'FCG1'
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<IHii')
+SEPARATOR = '\x1f'
+
+# Edit distance allowed for fuzzy street matches: one per FUZZY_CHARS characters, at least one
+FUZZY_CHARS = 4
+
+# Distinct streets kept in memory per recently queried city
+CITY_CACHE_SIZE = 256
+
+HOUSE_NUMBER = re.compile(r'\b(\d+[a-z]?)\b', re.IGNORECASE)
+PUNCTUATION = re.compile(r'[^\w\s-]')
+
+
+def address_parts(address='', city='', country='', number=''):
+    """(country, city, street, house number) of an address, normalized like Location addresses and case-folded."""
+    address, city, country = Location.normalize_address(address, city, country)
+    match = HOUSE_NUMBER.search(address or '')
+    street = address or ''
+    if match:
+        number = number or match.group(1)
+        street = street[:match.start()] + ' ' + street[match.end():]
+    street = ' '.join(PUNCTUATION.sub(' ', street).split())
+    return (country or '').casefold(), (city or '').casefold(), street.casefold(), (number or '').casefold()
+
+
+def build_index(rows, path) -> int:
+    """Write the index of (street, number, city, country, latitude, longitude) rows to path. Returns the entry count."""
+    entries = {}
+    for street, number, city, country, latitude, longitude in rows:
+        key = SEPARATOR.join(address_parts(street, city, country, number)).encode('utf-8')
+        entries[key] = (round(float(latitude) * 1e6), round(float(longitude) * 1e6))
+    keys = sorted(entries)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as out:
+        out.write(HEADER.pack(GAZETTEER_MAGIC, len(keys)))
+        offset = 0
+        for key in keys:
+            out.write(RECORD.pack(offset, len(key), *entries[key]))
+            offset += len(key)
+        for key in keys:
+            out.write(key)
+    # Readers keep their mapping of the previous file
+    os.replace(temp, path)
+    return len(keys)
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance, or limit + 1 as soon as it must exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class GazetteerIndex:
+    """Read-only view of an index file."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != GAZETTEER_MAGIC:
+            raise ValueError(f"{self.path} is not a gazetteer index")
+        self._keys_start = HEADER.size + self.count * RECORD.size
+        self.city_streets = lru_cache(maxsize=CITY_CACHE_SIZE)(self._city_streets)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        """Key of entry i (supports bisect)."""
+        offset, length, _, _ = RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size)
+        start = self._keys_start + offset
+        return self._map[start:start + length]
+
+    def coordinates(self, i: int):
+        _, _, latitude, longitude = RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size)
+        return latitude / 1e6, longitude / 1e6
+
+    def prefix_range(self, prefix: str):
+        """(first, end) entries whose key starts with prefix."""
+        encoded = prefix.encode('utf-8')
+        first = bisect_left(self, encoded)
+        # Keys never contain 0xff bytes (UTF-8), so this sorts after every key with the prefix
+        return first, bisect_left(self, encoded + b'\xff', first)
+
+    def _city_streets(self, country: str, city: str) -> list:
+        """Distinct streets of a city."""
+        prefix = SEPARATOR.join((country, city, ''))
+        first, end = self.prefix_range(prefix)
+        streets = []
+        for i in range(first, end):
+            street = self[i].decode('utf-8')[len(prefix):].split(SEPARATOR, 1)[0]
+            if not streets or streets[-1] != street:
+                streets.append(street)
+        return streets
+
+    def street_point(self, country: str, city: str, street: str, number: str):
+        """Coordinates of a house number (or of the street, or the numerically closest house), None if no such street."""
+        prefix = SEPARATOR.join((country, city, street, ''))
+        first, end = self.prefix_range(prefix)
+        if first == end:
+            return None
+        best, best_distance = first, None
+        wanted = int(re.match(r'\d*', number).group() or 0)
+        for i in range(first, end):
+            entry_number = self[i].decode('utf-8')[len(prefix):]
+            if entry_number == number:
+                return self.coordinates(i)
+            if not number:
+                # The street-level entry (no number) sorts first
+                break
+            digits = re.match(r'\d*', entry_number).group()
+            distance = abs(int(digits) - wanted) if digits else wanted
+            if best_distance is None or distance < best_distance:
+                best, best_distance = i, distance
+        return self.coordinates(best)
+
+    def lookup(self, country: str, city: str, street: str, number: str):
+        """Coordinates for address_parts(): exact, prefix, then fuzzy street match."""
+        point = self.street_point(country, city, street, number)
+        if point or not street:
+            return point
+
+        first, end = self.prefix_range(SEPARATOR.join((country, city, street)))
+        if first < end:
+            longer = self[first].decode('utf-8').split(SEPARATOR)[2]
+            return self.street_point(country, city, longer, number)
+
+        limit = max(1, len(street) // FUZZY_CHARS)
+        best, best_distance = None, limit + 1
+        for candidate in self.city_streets(country, city):
+            distance = edit_distance(street, candidate, best_distance - 1)
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        if best is not None:
+            return self.street_point(country, city, best, number)
+        return None
+
+    def close(self):
+        self._map.close()
@@ -0,0 +1,179 @@
+"""Persistent cache for Nominatim lookups, keyed on the normalized address."""
+import hashlib
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import GeocodeCacheEntry, Location
+
+
+# How long answers are kept, in seconds (override with settings.GEOCODE_CACHE_TTL / GEOCODE_CACHE_NEGATIVE_TTL)
+DEFAULT_TTL = 90 * 24 * 3600
+DEFAULT_NEGATIVE_TTL = 24 * 3600
+
+
+def forward_query(address: str, city: str = None, country: str = None) -> str:
+    """Normalized, case-folded query string used as the forward cache key."""
+    address, city, country = Location.normalize_address(address, city, country)
+    return ', '.join(part for part in (address, city, country) if part).casefold()
+
+
+def reverse_query(latitude: float, longitude: float) -> str:
+    """Coordinates rounded to the precision Location stores, used as the reverse cache key."""
+    return f"{float(latitude):.6f},{float(longitude):.6f}"
+
+
+class GeocodeCache:
+    """DB-backed geocode cache with TTL, negative caching and per-process hit/miss counters."""
+    MISS = object()
+
+    hits = 0
+    misses = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: str) -> str:
+        return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _count(cls, hit: bool):
+        with cls._lock:
+            if hit:
+                cls.hits += 1
+            else:
+                cls.misses += 1
+
+    @classmethod
+    def _get(cls, kind: str, query: str):
+        entry = GeocodeCacheEntry.objects.filter(
+            kind=kind, key=cls._key(query), expires_at__gt=timezone.now()
+        ).first()
+        cls._count(entry is not None)
+        return entry
+
+    @classmethod
+    async def _aget(cls, kind: str, query: str):
+        entry = await GeocodeCacheEntry.objects.filter(
+            kind=kind, key=cls._key(query), expires_at__gt=timezone.now()
+        ).afirst()
+        cls._count(entry is not None)
+        return entry
+
+    @classmethod
+    def _defaults(cls, query: str, found: bool, **values) -> dict:
+        if found:
+            ttl = getattr(settings, 'GEOCODE_CACHE_TTL', DEFAULT_TTL)
+        else:
+            ttl = getattr(settings, 'GEOCODE_CACHE_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL)
+        return {
+            'query': query[:500],
+            'found': found,
+            'expires_at': timezone.now() + timedelta(seconds=ttl),
+            **values,
+        }
+
+    @classmethod
+    def _set(cls, kind: str, query: str, found: bool, **values):
+        GeocodeCacheEntry.objects.update_or_create(
+            kind=kind, key=cls._key(query), defaults=cls._defaults(query, found, **values),
+        )
+
+    @classmethod
+    async def _aset(cls, kind: str, query: str, found: bool, **values):
+        await GeocodeCacheEntry.objects.aupdate_or_create(
+            kind=kind, key=cls._key(query), defaults=cls._defaults(query, found, **values),
+        )
+
+    @staticmethod
+    def _forward_result(entry):
+        if not entry.found:
+            return None
+        return (entry.latitude, entry.longitude)
+
+    @staticmethod
+    def _forward_values(coords) -> dict:
+        return {
+            'latitude': coords[0] if coords else None,
+            'longitude': coords[1] if coords else None,
+            'result': None,
+        }
+
+    @classmethod
+    def get_forward(cls, query: str):
+        """Return (lat, lng), None for a cached failure, or GeocodeCache.MISS."""
+        entry = cls._get(GeocodeCacheEntry.KIND_FORWARD, query)
+        if entry is None:
+            return cls.MISS
+        return cls._forward_result(entry)
+
+    @classmethod
+    async def aget_forward(cls, query: str):
+        """Async get_forward()."""
+        entry = await cls._aget(GeocodeCacheEntry.KIND_FORWARD, query)
+        if entry is None:
+            return cls.MISS
+        return cls._forward_result(entry)
+
+    @classmethod
+    def set_forward(cls, query: str, coords):
+        """Store a forward result; coords=None caches the failure for the negative TTL."""
+        cls._set(GeocodeCacheEntry.KIND_FORWARD, query, coords is not None, **cls._forward_values(coords))
+
+    @classmethod
+    async def aset_forward(cls, query: str, coords):
+        """Async set_forward()."""
+        await cls._aset(GeocodeCacheEntry.KIND_FORWARD, query, coords is not None, **cls._forward_values(coords))
+
+    @classmethod
+    def get_reverse(cls, query: str):
+        """Return the reverse geocoding dict, None for a cached failure, or GeocodeCache.MISS."""
+        entry = cls._get(GeocodeCacheEntry.KIND_REVERSE, query)
+        if entry is None:
+            return cls.MISS
+        return entry.result if entry.found else None
+
+    @classmethod
+    async def aget_reverse(cls, query: str):
+        """Async get_reverse()."""
+        entry = await cls._aget(GeocodeCacheEntry.KIND_REVERSE, query)
+        if entry is None:
+            return cls.MISS
+        return entry.result if entry.found else None
+
+    @classmethod
+    def set_reverse(cls, query: str, result):
+        """Store a reverse result; result=None caches the failure for the negative TTL."""
+        cls._set(
+            GeocodeCacheEntry.KIND_REVERSE, query, result is not None,
+            latitude=None, longitude=None, result=result,
+        )
+
+    @classmethod
+    async def aset_reverse(cls, query: str, result):
+        """Async set_reverse()."""
+        await cls._aset(
+            GeocodeCacheEntry.KIND_REVERSE, query, result is not None,
+            latitude=None, longitude=None, result=result,
+        )
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Hit/miss counters of this process."""
+        total = cls.hits + cls.misses
+        return {
+            'hits': cls.hits,
+            'misses': cls.misses,
+            'hit_rate': cls.hits / total if total else 0.0,
+        }
+
+    @classmethod
+    def reset_stats(cls):
+        with cls._lock:
+            cls.hits = 0
+            cls.misses = 0
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        """Delete expired entries. Returns the number removed."""
+        deleted, _ = GeocodeCacheEntry.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
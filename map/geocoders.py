@@ -0,0 +1,309 @@
+"""Pluggable geocoding backends.
+
+The backend used by geocode_address and the batch ``geocode`` command is
+settings.GEOCODER_BACKEND (a dotted path); FallbackGeocoder chains several,
+e.g. the offline GazetteerGeocoder with Nominatim behind it. Backends raise
+on transport errors and return None when an address is not found. Every
+backend can be awaited (ageocode/areverse); NominatimGeocoder does so
+natively over a pooled httpx.AsyncClient, others run in a worker thread.
+"""
+import asyncio
+import csv
+import json
+import threading
+import weakref
+from pathlib import Path
+from typing import Optional, Tuple
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .gazetteer import GazetteerIndex, address_parts
+from .geocache import forward_query
+
+
+DEFAULT_GEOCODER_BACKEND = 'map.geocoders.NominatimGeocoder'
+
+
+class BaseGeocoder:
+    """Interface for geocoding backends."""
+    # Requests per second allowed by the service (None = unlimited)
+    default_rate = None
+
+    def geocode(self, address: str, city: str = None, country: str = None) -> Optional[Tuple[float, float]]:
+        """Return (lat, lng) for an address, None if not found; raise on errors."""
+        raise NotImplementedError
+
+    async def ageocode(self, address: str, city: str = None, country: str = None) -> Optional[Tuple[float, float]]:
+        """Async geocode(); runs the blocking version in a worker thread unless overridden."""
+        return await sync_to_async(self.geocode, thread_sensitive=False)(address, city, country)
+
+    def reverse(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Return address details for coordinates, None if not found; raise on errors."""
+        raise NotImplementedError
+
+    async def areverse(self, latitude: float, longitude: float) -> Optional[dict]:
+        """Async reverse(); runs the blocking version in a worker thread unless overridden."""
+        return await sync_to_async(self.reverse, thread_sensitive=False)(latitude, longitude)
+
+    def close(self):
+        """Release network resources."""
+
+    async def aclose(self):
+        """Release network resources of the running event loop."""
+
+
+class NominatimGeocoder(BaseGeocoder):
+    """OpenStreetMap Nominatim over pooled keep-alive HTTP connections (sync and async)."""
+    default_rate = 1.0
+    url = "https://nominatim.openstreetmap.org/search"
+    reverse_url = "https://nominatim.openstreetmap.org/reverse"
+    user_agent = 'FreeCups-Django-App/1.0'
+
+    def __init__(self, url=None, reverse_url=None, timeout=10, pool_size=4, session=None):
+        self.url = url or getattr(settings, 'NOMINATIM_URL', self.url)
+        self.reverse_url = reverse_url or getattr(settings, 'NOMINATIM_REVERSE_URL', self.reverse_url)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = self.user_agent
+        # Async connections belong to the event loop that opened them
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                headers={'User-Agent': self.user_agent},
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+            self._async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def _search_params(address, city, country):
+        query = ", ".join(part for part in (address, city, country) if part)
+        return {'q': query, 'format': 'json', 'limit': 1}
+
+    @staticmethod
+    def _parse_search(data):
+        if data:
+            return (float(data[0]['lat']), float(data[0]['lon']))
+        return None
+
+    @staticmethod
+    def _parse_reverse(data):
+        if 'address' not in data:
+            return None
+        return {
+            'full_address': data.get('display_name', ''),
+            'address': data.get('address', {}),
+            'city': data['address'].get('city') or data['address'].get('town') or data['address'].get('village'),
+            'country': data['address'].get('country'),
+        }
+
+    def geocode(self, address, city=None, country=None):
+        response = self.session.get(self.url, params=self._search_params(address, city, country), timeout=self.timeout)
+        response.raise_for_status()
+        return self._parse_search(response.json())
+
+    async def ageocode(self, address, city=None, country=None):
+        response = await self._async_client().get(self.url, params=self._search_params(address, city, country))
+        response.raise_for_status()
+        return self._parse_search(response.json())
+
+    def reverse(self, latitude, longitude):
+        params = {'lat': latitude, 'lon': longitude, 'format': 'json'}
+        response = self.session.get(self.reverse_url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return self._parse_reverse(response.json())
+
+    async def areverse(self, latitude, longitude):
+        params = {'lat': latitude, 'lon': longitude, 'format': 'json'}
+        response = await self._async_client().get(self.reverse_url, params=params)
+        response.raise_for_status()
+        return self._parse_reverse(response.json())
+
+    def close(self):
+        self.session.close()
+
+    async def aclose(self):
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+class StaticGeocoder(BaseGeocoder):
+    """Offline geocoder answering from a local file, for tests and development.
+
+    The file (settings.GEOCODER_STATIC_FILE) is either JSON mapping
+    "address, city, country" strings to [lat, lng], or CSV with columns
+    address, city, country, latitude, longitude. Lookups use the same
+    normalized key as the geocode cache.
+    """
+
+    def __init__(self, path=None, data=None):
+        self.coordinates = {}
+        path = path or getattr(settings, 'GEOCODER_STATIC_FILE', None)
+        if path:
+            self.load(path)
+        for query, coords in (data or {}).items():
+            self.coordinates[forward_query(query)] = (float(coords[0]), float(coords[1]))
+
+    def load(self, path):
+        path = Path(path)
+        with path.open(newline='', encoding='utf-8') as f:
+            if path.suffix == '.json':
+                for query, coords in json.load(f).items():
+                    self.coordinates[forward_query(query)] = (float(coords[0]), float(coords[1]))
+            else:
+                for row in csv.DictReader(f):
+                    key = forward_query(row['address'], row.get('city'), row.get('country'))
+                    self.coordinates[key] = (float(row['latitude']), float(row['longitude']))
+
+    def geocode(self, address, city=None, country=None):
+        key = forward_query(address, city, country)
+        if key not in self.coordinates:
+            # JSON keys are whole "address, city, country" strings
+            key = forward_query(", ".join(part for part in (address, city, country) if part))
+        return self.coordinates.get(key)
+
+    async def ageocode(self, address, city=None, country=None):
+        # In-memory lookup, no need for a thread
+        return self.geocode(address, city, country)
+
+
+class GazetteerGeocoder(BaseGeocoder):
+    """Offline geocoder over a memory-mapped gazetteer index (see map.gazetteer, built by build_gazetteer).
+
+    Answers thousands of lookups per second without network; streets missing
+    from the extract return None, so put it first in a FallbackGeocoder chain.
+    """
+
+    def __init__(self, path=None):
+        path = path or getattr(settings, 'GEOCODER_GAZETTEER', None)
+        if not path:
+            raise ImproperlyConfigured("GazetteerGeocoder needs settings.GEOCODER_GAZETTEER (run build_gazetteer)")
+        self.index = GazetteerIndex(path)
+
+    def geocode(self, address, city=None, country=None):
+        country, city, street, number = address_parts(address, city, country)
+        # Extracts built without a country column have empty countries
+        return self.index.lookup(country, city, street, number) or (
+            self.index.lookup('', city, street, number) if country else None
+        )
+
+    async def ageocode(self, address, city=None, country=None):
+        # A few mmap reads, no need for a thread
+        return self.geocode(address, city, country)
+
+    def reverse(self, latitude, longitude):
+        # The index is keyed by address only
+        return None
+
+    async def areverse(self, latitude, longitude):
+        return None
+
+    def close(self):
+        self.index.close()
+
+
+class FallbackGeocoder(BaseGeocoder):
+    """Tries backends in order (settings.GEOCODER_CHAIN) until one finds the address.
+
+    Backends with a default_rate are only called through the shared rate
+    limiter, so the chain itself needs none. Errors are raised only if no
+    backend found an answer.
+    """
+    DEFAULT_CHAIN = ('map.geocoders.GazetteerGeocoder', 'map.geocoders.NominatimGeocoder')
+
+    def __init__(self, backends=None):
+        self.backends = [
+            import_string(backend)() if isinstance(backend, str) else backend
+            for backend in backends or getattr(settings, 'GEOCODER_CHAIN', self.DEFAULT_CHAIN)
+        ]
+
+    def _call(self, method, *args):
+        # Imported here: map.utils depends on this module
+        from .utils import GeocodeRateLimiter
+
+        error = None
+        for backend in self.backends:
+            if backend.default_rate:
+                GeocodeRateLimiter.wait_if_needed()
+            try:
+                result = getattr(backend, method)(*args)
+            except Exception as e:
+                error = e
+                continue
+            if result is not None:
+                return result
+        if error is not None:
+            raise error
+        return None
+
+    async def _acall(self, method, *args):
+        # Imported here: map.utils depends on this module
+        from .utils import GeocodeRateLimiter
+
+        error = None
+        for backend in self.backends:
+            if backend.default_rate:
+                await GeocodeRateLimiter.await_slot()
+            try:
+                result = await getattr(backend, method)(*args)
+            except Exception as e:
+                error = e
+                continue
+            if result is not None:
+                return result
+        if error is not None:
+            raise error
+        return None
+
+    def geocode(self, address, city=None, country=None):
+        return self._call('geocode', address, city, country)
+
+    async def ageocode(self, address, city=None, country=None):
+        return await self._acall('ageocode', address, city, country)
+
+    def reverse(self, latitude, longitude):
+        return self._call('reverse', latitude, longitude)
+
+    async def areverse(self, latitude, longitude):
+        return await self._acall('areverse', latitude, longitude)
+
+    def close(self):
+        for backend in self.backends:
+            backend.close()
+
+    async def aclose(self):
+        for backend in self.backends:
+            await backend.aclose()
+
+
+_default_geocoder = None
+_default_lock = threading.Lock()
+
+
+def get_geocoder(backend: str = None, **kwargs) -> BaseGeocoder:
+    """Instantiate a geocoder backend (settings.GEOCODER_BACKEND by default)."""
+    backend = backend or getattr(settings, 'GEOCODER_BACKEND', DEFAULT_GEOCODER_BACKEND)
+    return import_string(backend)(**kwargs)
+
+
+def get_default_geocoder() -> BaseGeocoder:
+    """Process-wide shared instance of the configured backend."""
+    global _default_geocoder
+    with _default_lock:
+        if _default_geocoder is None:
+            _default_geocoder = get_geocoder()
+        return _default_geocoder
@@ -0,0 +1,80 @@
+"""Business density heatmap tiles, read from the precomputed cluster grid.
+
+LocationCluster already holds, for every zoom level, the number of locations
+per grid cell, type, category and country, and map.signals keeps it current
+on every save and delete. Summing the business rows of one tile gives a
+per-category 2D histogram, so a heatmap tile needs one indexed query and no
+pass over Location.
+
+A tile at zoom z is read from the cells of zoom z + HEATMAP_DETAIL (capped at
+CLUSTER_MAX_ZOOM), i.e. a grid of CELLS_PER_TILE << HEATMAP_DETAIL cells per
+side. It is sent as little-endian binary:
+
+    b'FCH1'  uint32 grid  uint32 scale  uint32 counts[grid * grid] (row-major)
+
+scale is the densest cell of the layer at that resolution, so neighbouring
+tiles share one colour scale. Encoded tiles are cached under versioned keys.
+"""
+import struct
+import sys
+from array import array
+from django.core.cache import cache
+from django.db.models import Sum
+from .caching import cache_timeout, versioned_key
+from .clustering import CELLS_PER_TILE, CLUSTER_MAX_ZOOM
+from .models import Location, LocationCluster
+
+
+# Extra zoom levels of detail below each heatmap tile (4 << 2 = 16x16 cells of 16px)
+HEATMAP_DETAIL = 2
+
+HEATMAP_MAGIC = b'FCH1'
+
+
+def _business_cells(zoom: int, country='', category=''):
+    rows = LocationCluster.objects.filter(zoom=zoom, location_type=Location.TYPE_BUSINESS)
+    if country:
+        rows = rows.filter(country__iexact=country)
+    if category:
+        rows = rows.filter(category=category)
+    return rows
+
+
+def heatmap_scale(zoom: int, country='', category='') -> int:
+    """Business count of the densest cell at a cluster zoom level."""
+    key = versioned_key('heatmap_scale', zoom, country.lower(), category)
+    scale = cache.get(key)
+    if scale is None:
+        densest = _business_cells(zoom, country, category).values('cell_x', 'cell_y').annotate(
+            total=Sum('count')
+        ).order_by('-total').values_list('total', flat=True).first()
+        scale = densest or 0
+        cache.set(key, scale, cache_timeout())
+    return scale
+
+
+def render_heatmap_tile(zoom: int, tile_x: int, tile_y: int, country='', category='') -> bytes:
+    detail = min(HEATMAP_DETAIL, CLUSTER_MAX_ZOOM - zoom)
+    source_zoom = zoom + detail
+    grid = CELLS_PER_TILE << detail
+    first_x, first_y = tile_x * grid, tile_y * grid
+    counts = array('I', bytes(4 * grid * grid))
+    rows = _business_cells(source_zoom, country, category).filter(
+        cell_x__gte=first_x, cell_x__lt=first_x + grid,
+        cell_y__gte=first_y, cell_y__lt=first_y + grid,
+    ).values('cell_x', 'cell_y').annotate(total=Sum('count')).order_by()
+    for row in rows:
+        counts[(row['cell_y'] - first_y) * grid + row['cell_x'] - first_x] = row['total']
+    if sys.byteorder == 'big':
+        counts.byteswap()
+    return HEATMAP_MAGIC + struct.pack('<II', grid, heatmap_scale(source_zoom, country, category)) + counts.tobytes()
+
+
+def heatmap_tile(zoom: int, tile_x: int, tile_y: int, country='', category='') -> bytes:
+    """Encoded heatmap tile z/x/y (zoom 0..CLUSTER_MAX_ZOOM), cached until the map data changes."""
+    key = versioned_key('heatmap', zoom, tile_x, tile_y, country.lower(), category)
+    data = cache.get(key)
+    if data is None:
+        data = render_heatmap_tile(zoom, tile_x, tile_y, country, category)
+        cache.set(key, data, cache_timeout())
+    return data
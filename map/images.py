@@ -0,0 +1,342 @@
+"""Background optimization of Location logos and product photos.
+
+Uploads are stored as-is and served until the process_images worker has
+produced the optimized version. Output files are named after the SHA-256 of
+the source bytes, so the work is idempotent: re-running it, or uploading the
+same image for several locations, never encodes the same source twice.
+
+Besides the optimized JPEG kept in the model field, every image gets
+responsive variants (several widths, AVIF when Pillow supports it, WebP and
+JPEG) under variants/<dir>/<hash>/, described by a manifest stored in
+Location.image_variants and served with long-lived cache headers.
+"""
+import hashlib
+import json
+import re
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+from .models import Location
+from .realtime import LiveUpdates
+from .snapshots import SnapshotBuilder
+
+
+# Field name -> (max width, max height, storage directory)
+IMAGE_SPECS = {
+    'company_logo': (100, 100, 'company_logos'),
+    'product_photo': (300, 300, 'product_photos'),
+}
+
+
+# Variant widths in pixels per field (square bounding boxes, never upscaled)
+VARIANT_WIDTHS = {
+    'company_logo': (32, 64, 100, 200),
+    'product_photo': (150, 300, 600),
+}
+
+# Encoder settings per variant format, best compression first
+VARIANT_FORMATS = {
+    'avif': {'format': 'AVIF', 'quality': 60},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 6},
+    'jpeg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+}
+
+VARIANT_CONTENT_TYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def available_variant_formats():
+    """Variant formats the installed Pillow can encode."""
+    return [fmt for fmt in VARIANT_FORMATS if fmt == 'jpeg' or features.check(fmt)]
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def optimized_name(field_name: str, source_hash: str) -> str:
+    """Content-addressed storage path of the optimized image."""
+    return f"{IMAGE_SPECS[field_name][2]}/{source_hash}.jpg"
+
+
+def hash_from_optimized_name(field_name: str, name: str):
+    """Source hash encoded in an optimized file name, or None for any other file."""
+    match = re.fullmatch(rf"{IMAGE_SPECS[field_name][2]}/([0-9a-f]{{64}})\.jpg", name)
+    return match.group(1) if match else None
+
+
+def image_url(field_name: str, name: str, external_url: str, image_hash: str) -> str:
+    """URL to show for an image field: the upload, the local mirror of the external URL, or the external URL."""
+    if name:
+        return default_storage.url(name)
+    if external_url and image_hash:
+        # Mirrored by mirror_images; the hash is only set once the optimized copy exists
+        return default_storage.url(optimized_name(field_name, image_hash))
+    return external_url or ''
+
+
+def variant_dir(field_name: str, source_hash: str) -> str:
+    return f"variants/{IMAGE_SPECS[field_name][2]}/{source_hash}"
+
+
+def variant_name(field_name: str, source_hash: str, width: int, fmt: str) -> str:
+    """Content-addressed storage path of one responsive variant."""
+    return f"{variant_dir(field_name, source_hash)}/{width}.{fmt}"
+
+
+def _prepare_image(data: bytes):
+    """Open image bytes as an upright RGB image."""
+    img = Image.open(BytesIO(data))
+
+    # Fix orientation based on EXIF data (phone photos)
+    img = ImageOps.exif_transpose(img)
+
+    # Convert to RGB if necessary
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode in ('RGBA', 'LA') else None)
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def optimize_image_bytes(data: bytes, width: int, height: int) -> bytes:
+    """Fix orientation, flatten transparency and shrink to fit width x height as an optimized JPEG.
+
+    Pure function of its arguments so it can run in a worker process.
+    """
+    img = _prepare_image(data)
+
+    # Resize to specified dimensions for fast loading
+    img.thumbnail((width, height), Image.Resampling.LANCZOS)
+
+    output = BytesIO()
+    img.save(output, format='JPEG', quality=85, optimize=True)
+    return output.getvalue()
+
+
+def render_variants(data: bytes, field_name: str, formats) -> dict:
+    """Encode every variant of an image: {(width, fmt): bytes}.
+
+    Widths above the source size are skipped (except the smallest) since they would only upscale.
+    """
+    img = _prepare_image(data)
+    largest = max(img.size)
+    widths = [w for w in VARIANT_WIDTHS[field_name] if w <= largest] or [VARIANT_WIDTHS[field_name][0]]
+    variants = {}
+    for width in widths:
+        resized = img.copy()
+        resized.thumbnail((width, width), Image.Resampling.LANCZOS)
+        for fmt in formats:
+            output = BytesIO()
+            resized.save(output, **VARIANT_FORMATS[fmt])
+            variants[(width, fmt)] = output.getvalue()
+    return variants
+
+
+def optimize_task(task):
+    """Process-pool entry point: (field, hash, source bytes, need_main, formats) -> (field, hash, main, variants, error)."""
+    field_name, source_hash, data, need_main, formats = task
+    width, height, _ = IMAGE_SPECS[field_name]
+    try:
+        main = optimize_image_bytes(data, width, height) if need_main else None
+        return field_name, source_hash, main, render_variants(data, field_name, formats), None
+    except Exception as e:
+        return field_name, source_hash, None, None, f"{type(e).__name__}: {e}"
+
+
+def save_variants(field_name: str, source_hash: str, variants: dict) -> dict:
+    """Store rendered variants and their manifest; returns the manifest."""
+    manifest = {
+        'hash': source_hash,
+        'widths': sorted({width for width, _ in variants}),
+        'formats': [fmt for fmt in VARIANT_FORMATS if any(f == fmt for _, f in variants)],
+    }
+    for (width, fmt), data in variants.items():
+        name = variant_name(field_name, source_hash, width, fmt)
+        if not default_storage.exists(name):
+            default_storage.save(name, ContentFile(data))
+    manifest_name = f"{variant_dir(field_name, source_hash)}/manifest.json"
+    if not default_storage.exists(manifest_name):
+        default_storage.save(manifest_name, ContentFile(json.dumps(manifest).encode('utf-8')))
+    return manifest
+
+
+def store_outputs(field_name: str, source_hash: str, main, variants: dict) -> dict:
+    """Save encoder output (shared by every location with this source); returns the variant manifest."""
+    target = optimized_name(field_name, source_hash)
+    if main is not None and not default_storage.exists(target):
+        default_storage.save(target, ContentFile(main))
+    return save_variants(field_name, source_hash, variants)
+
+
+def load_manifest(field_name: str, source_hash: str):
+    """Variant manifest written by an earlier run, or None."""
+    manifest_name = f"{variant_dir(field_name, source_hash)}/manifest.json"
+    if not default_storage.exists(manifest_name):
+        return None
+    with default_storage.open(manifest_name, 'rb') as f:
+        return json.loads(f.read())
+
+
+def current_manifest(image_variants, field_name: str, image_hash: str):
+    """Manifest of a field if it belongs to the image currently stored (hashes match)."""
+    manifest = (image_variants or {}).get(field_name)
+    if manifest and image_hash and manifest.get('hash') == image_hash:
+        return manifest
+    return None
+
+
+def variant_url(field_name: str, manifest: dict, width: int, fmt: str = 'webp'):
+    """URL of the smallest variant at least `width` wide (largest available otherwise), or None."""
+    if not manifest or fmt not in manifest['formats']:
+        return None
+    widths = manifest['widths']
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    return reverse('map:image_variant', args=[variant_name(field_name, manifest['hash'], chosen, fmt)])
+
+
+def variant_srcset(field_name: str, manifest: dict, fmt: str = 'webp') -> str:
+    """srcset attribute value ("url 64w, ...") for a format, or ''."""
+    if not manifest or fmt not in manifest['formats']:
+        return ''
+    return ', '.join(
+        f"{reverse('map:image_variant', args=[variant_name(field_name, manifest['hash'], width, fmt)])} {width}w"
+        for width in manifest['widths']
+    )
+
+
+def pending_images(field_name: str):
+    """Locations whose image in field_name has not been optimized yet."""
+    return Location.objects.exclude(**{field_name: ''}).filter(
+        Q(**{f'{field_name}__isnull': False}), **{f'{field_name}_hash': ''}
+    )
+
+
+def report_image_update(location_id, filter_values):
+    """Tell snapshots and open map pages about an image written with queryset.update(), which sends no signals.
+
+    filter_values is the location's (country, location_type, category).
+    """
+    SnapshotBuilder.mark_stale_on_commit({filter_values})
+    LiveUpdates.record_on_commit('location', [location_id])
+
+
+def delete_if_unreferenced(name: str):
+    """Delete a stored image unless some Location still points at it (outputs are shared)."""
+    if not name:
+        return
+    in_use = Location.objects.filter(Q(company_logo=name) | Q(product_photo=name)).exists()
+    if not in_use and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+class ImagePipeline:
+    """Optimizes pending images in a pool of worker processes (Pillow work holds the GIL)."""
+
+    def __init__(self, workers: int = None, batch_size: int = 50):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.stats = {'optimized': 0, 'reused': 0, 'failed': 0}
+        self.formats = available_variant_formats()
+
+    def _collect_tasks(self, limit):
+        """Read pending sources and resolve those whose output already exists.
+
+        Returns (tasks for the pool, number of images settled without encoding).
+        """
+        tasks = []
+        settled = 0
+        for field_name in IMAGE_SPECS:
+            for location in pending_images(field_name).only('id', field_name)[:limit]:
+                name = getattr(location, field_name).name
+                try:
+                    with default_storage.open(name, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    self._finish(location.id, field_name, name, None, error=f"cannot read {name}: {e}")
+                    settled += 1
+                    continue
+                # An optimized output is never re-encoded; it only serves as the variant source if needed
+                source_hash = hash_from_optimized_name(field_name, name) or content_hash(data)
+                target = optimized_name(field_name, source_hash)
+                has_main = name == target or default_storage.exists(target)
+                manifest = load_manifest(field_name, source_hash) if has_main else None
+                if manifest:
+                    # Already processed by an earlier run or for another location
+                    self._finish(location.id, field_name, name, source_hash, manifest=manifest)
+                    self.stats['reused'] += 1
+                    settled += 1
+                else:
+                    tasks.append((location.id, field_name, source_hash, data, name, not has_main))
+        return tasks, settled
+
+    def _finish(self, location_id, field_name, source_name, source_hash, manifest=None, error=None):
+        """Point the location at the optimized file and variants unless the image changed meanwhile."""
+        if error:
+            # Keep serving the original; a content hash marks it as handled so it is not retried forever
+            print(f"❌ Image optimization failed for location {location_id} ({field_name}): {error}")
+            self.stats['failed'] += 1
+            target = source_name
+            source_hash = source_hash or 'unreadable'
+        else:
+            target = optimized_name(field_name, source_hash)
+
+        current = Location.objects.filter(**{'id': location_id, field_name: source_name}).values(
+            'image_variants', 'country', 'location_type', 'category'
+        ).first()
+        if current is None:
+            return 0
+        image_variants = dict(current['image_variants'] or {})
+        if manifest:
+            image_variants[field_name] = manifest
+        else:
+            image_variants.pop(field_name, None)
+        updated = Location.objects.filter(**{'id': location_id, field_name: source_name}).update(**{
+            field_name: target,
+            f'{field_name}_hash': source_hash,
+            'image_variants': image_variants,
+            'updated_at': timezone.now(),
+        })
+        if updated:
+            report_image_update(location_id, (current['country'], current['location_type'], current['category']))
+            if target != source_name:
+                delete_if_unreferenced(source_name)
+        return updated
+
+    def run(self, limit: int = None) -> dict:
+        """Process pending images until none are left (or about `limit` per field)."""
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                batch_limit = self.batch_size if limit is None else min(self.batch_size, limit)
+                tasks, settled = self._collect_tasks(batch_limit)
+                if not tasks and not settled:
+                    break
+                # Identical sources in one batch are encoded once
+                waiting = {}
+                for location_id, field_name, source_hash, data, name, need_main in tasks:
+                    entry = waiting.setdefault((field_name, source_hash), [data, False, []])
+                    entry[1] = entry[1] or need_main
+                    entry[2].append((location_id, name))
+                unique = [
+                    (field_name, source_hash, data, need_main, self.formats)
+                    for (field_name, source_hash), (data, need_main, _) in waiting.items()
+                ]
+                for field_name, source_hash, main, variants, error in pool.map(optimize_task, unique):
+                    manifest = None if error else store_outputs(field_name, source_hash, main, variants)
+                    for location_id, name in waiting[(field_name, source_hash)][2]:
+                        self._finish(location_id, field_name, name, source_hash, manifest=manifest, error=error)
+                    if not error:
+                        self.stats['optimized'] += 1
+                if limit is not None:
+                    limit -= len(tasks) + settled
+                    if limit <= 0:
+                        break
+        return self.stats
@@ -0,0 +1,258 @@
+"""Bulk import of locations from CSV or JSON Lines files.
+
+Rows are streamed, validated against the Location fields, then normalized
+(map.normalization) and inserted with bulk_create in batches of BATCH_SIZE,
+one transaction per batch. bulk_create skips Location.save() and its signals,
+so the follow-up work runs once at the end instead of per row: cluster counts,
+the facet cache, holder recommendation features, geocoding jobs for rows
+without coordinates and registration of external image URLs for mirror_images. It also runs for the batches already
+committed when reading the file fails part way.
+"""
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from .clustering import add_to_clusters, cluster_key, rebuild_clusters
+from .facets import LocationFacets
+from .models import GeocodingJob, Location, RemoteImage
+from .normalization import get_normalizer
+from .recommendations import HolderRecommender
+from .realtime import LiveUpdates
+from .snapshots import ANY, SnapshotBuilder
+from .tiles import clear_tiles, invalidate_tiles
+
+
+BATCH_SIZE = 500
+
+# Above this many imported rows with coordinates, recomputing all clusters is cheaper than counting rows in one by one
+CLUSTER_REBUILD_THRESHOLD = 200
+
+# Columns read from each row; anything else is ignored
+IMPORT_FIELDS = (
+    'name', 'location_type', 'category', 'address', 'city', 'country',
+    'latitude', 'longitude', 'company_logo_url', 'product_photo_url',
+)
+
+# Accepted alternative column names
+COLUMN_ALIASES = {
+    'type': 'location_type',
+    'lat': 'latitude',
+    'lng': 'longitude',
+    'lon': 'longitude',
+    'logo_url': 'company_logo_url',
+    'photo_url': 'product_photo_url',
+}
+
+FORMATS = ('csv', 'jsonl')
+
+
+def detect_format(filename: str) -> str:
+    """Guess the file format from its extension ('csv' unless it looks like JSON Lines)."""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def read_rows(stream, fmt: str):
+    """Yield (line number, dict) for every record of a text stream, without loading it all."""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ValueError(f"invalid JSON: {e}")
+                continue
+            yield line_number, row if isinstance(row, dict) else ValueError("expected a JSON object")
+    else:
+        raise ValueError(f"Unknown import format: {fmt!r} (expected one of {', '.join(FORMATS)})")
+
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    created: int = 0
+    errors: list = field(default_factory=list)
+    geocoding_queued: int = 0
+    images_registered: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+class LocationImporter:
+    """Validates rows into unsaved Locations and inserts them in batches."""
+
+    def __init__(self, batch_size: int = BATCH_SIZE, dry_run: bool = False, max_errors: int = 1000):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.max_errors = max_errors
+        self.fields = {name: Location._meta.get_field(name) for name in IMPORT_FIELDS}
+
+    def build(self, row: dict) -> Location:
+        """Return an unsaved, normalized Location for a row; raises ValidationError."""
+        values = {}
+        for column, value in row.items():
+            if column is None:
+                continue
+            name = column.strip().lower()
+            name = COLUMN_ALIASES.get(name, name)
+            if name in self.fields:
+                values[name] = value
+
+        data = {}
+        errors = {}
+        for name, model_field in self.fields.items():
+            value = values.get(name)
+            if isinstance(value, str):
+                value = value.strip()
+            if value in (None, ''):
+                if not model_field.blank and not model_field.has_default():
+                    errors[name] = ["This field is required."]
+                continue
+            if name in ('location_type', 'category'):
+                value = str(value).lower()
+            elif name in ('latitude', 'longitude'):
+                value = self._coordinate(value, model_field.decimal_places)
+            try:
+                data[name] = model_field.clean(value, None)
+            except ValidationError as e:
+                errors[name] = e.messages
+
+        latitude, longitude = data.get('latitude'), data.get('longitude')
+        if (latitude is None) != (longitude is None):
+            errors.setdefault('latitude', []).append("Latitude and longitude must be given together.")
+        if latitude is not None and not -90 <= latitude <= 90:
+            errors.setdefault('latitude', []).append("Latitude must be between -90 and 90.")
+        if longitude is not None and not -180 <= longitude <= 180:
+            errors.setdefault('longitude', []).append("Longitude must be between -180 and 180.")
+        if errors:
+            raise ValidationError(errors)
+
+        # Addresses are normalized per batch in _insert
+        location = Location(**data)
+        location.geohash = location.compute_geohash()
+        return location
+
+    @staticmethod
+    def _coordinate(value, decimal_places):
+        """Round a coordinate to the stored precision (left as is if it is not a number)."""
+        try:
+            return Decimal(str(value)).quantize(Decimal(1).scaleb(-decimal_places))
+        except (InvalidOperation, ValueError):
+            return value
+
+    def run(self, stream, fmt: str) -> ImportResult:
+        """Import every row of stream. Invalid rows are reported in the result and skipped.
+
+        Errors reading the stream (UnicodeDecodeError, csv.Error) propagate after the
+        follow-up work for the committed batches; self.result tells how far it got.
+        """
+        result = self.result = ImportResult()
+        started = time.perf_counter()
+        # Only what the follow-up work needs is kept, not the inserted instances
+        self.cluster_keys = []
+        self.holder_ids = []
+        self.geocode_ids = []
+        # Backends that cannot return ids from bulk inserts (e.g. MySQL)
+        self.geocode_unqueued = 0
+        self.image_urls = set()
+        batch = []
+        try:
+            for line_number, row in read_rows(stream, fmt):
+                result.rows += 1
+                try:
+                    if isinstance(row, Exception):
+                        raise ValidationError(str(row))
+                    batch.append(self.build(row))
+                except ValidationError as e:
+                    self._error(result, line_number, e)
+                    continue
+                if len(batch) >= self.batch_size:
+                    result.created += self._insert(batch)
+                    batch = []
+            if batch:
+                result.created += self._insert(batch)
+        finally:
+            # _insert only records rows once their transaction committed
+            if result.created and not self.dry_run:
+                self.after_import(result)
+            result.seconds = time.perf_counter() - started
+        return result
+
+    def _error(self, result, line_number, error):
+        if len(result.errors) < self.max_errors:
+            if hasattr(error, 'message_dict'):
+                message = '; '.join(f"{name}: {' '.join(messages)}" for name, messages in error.message_dict.items())
+            else:
+                message = ' '.join(error.messages)
+            result.errors.append((line_number, message))
+
+    def _insert(self, batch) -> int:
+        normalized = get_normalizer().normalize_many(
+            (location.address, location.city, location.country) for location in batch
+        )
+        for location, (address, city, country) in zip(batch, normalized):
+            location.address, location.city, location.country = address, city, country
+        if self.dry_run:
+            return len(batch)
+        with transaction.atomic():
+            Location.objects.bulk_create(batch, batch_size=self.batch_size)
+        for location in batch:
+            key = cluster_key(location)
+            if key is not None:
+                self.cluster_keys.append(key)
+                if location.location_type == Location.TYPE_HOLDER and location.id is not None:
+                    self.holder_ids.append(location.id)
+            elif location.address:
+                # Same condition as the auto_queue_geocoding signal
+                if location.id is None:
+                    self.geocode_unqueued += 1
+                else:
+                    self.geocode_ids.append(location.id)
+            self.image_urls.update(url for url in (location.company_logo_url, location.product_photo_url) if url)
+        return len(batch)
+
+    def after_import(self, result):
+        """Do the per-save signal work once for all created rows."""
+        if len(self.cluster_keys) > CLUSTER_REBUILD_THRESHOLD:
+            rebuild_clusters()
+            clear_tiles()
+        else:
+            for key in self.cluster_keys:
+                add_to_clusters(key)
+            invalidate_tiles([(latitude, longitude) for latitude, longitude, *_ in self.cluster_keys])
+
+        LocationFacets.invalidate()
+        HolderRecommender.refresh_bulk(self.holder_ids, [
+            (latitude, longitude) for latitude, longitude, _, location_type, _ in self.cluster_keys
+            if location_type == Location.TYPE_BUSINESS
+        ])
+        LiveUpdates.reload()
+        SnapshotBuilder.mark_stale([ANY])
+
+        if self.geocode_ids:
+            now = timezone.now()
+            GeocodingJob.objects.bulk_create(
+                [GeocodingJob(location_id=location_id, run_after=now) for location_id in self.geocode_ids],
+                batch_size=self.batch_size, ignore_conflicts=True,
+            )
+            result.geocoding_queued = len(self.geocode_ids)
+        if self.geocode_unqueued:
+            print(f"❌ {self.geocode_unqueued} locations need geocoding but were not queued; run 'manage.py geocode'")
+
+        # mirror_images downloads these on its next pass
+        if self.image_urls:
+            RemoteImage.objects.bulk_create(
+                [RemoteImage(url=url) for url in self.image_urls], batch_size=self.batch_size, ignore_conflicts=True
+            )
+            result.images_registered = len(self.image_urls)
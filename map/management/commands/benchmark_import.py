@@ -0,0 +1,84 @@
+import csv
+import io
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from map.importer import BATCH_SIZE, LocationImporter
+from map.models import Location
+
+
+# Synthetic points are spread over roughly the area of Israel
+AREA = (34.2, 29.5, 35.9, 33.3)
+
+CITIES = ('tel aviv-yafo', 'Jerusalem', 'haifa', 'Beer Sheva', 'ramat  gan')
+
+
+class Rollback(Exception):
+    """Raised to discard benchmark rows."""
+
+
+class Command(BaseCommand):
+    help = "Benchmark import_locations against saving locations one at a time (rows are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10_000, help="Rows imported in bulk")
+        parser.add_argument('--single-rows', type=int, default=500, help="Rows saved one at a time for comparison")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--without-coordinates', type=float, default=0.2, help="Share of rows left for geocoding")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        data = self.synthetic_csv(rng, options['rows'], options['without_coordinates'])
+
+        def bulk():
+            result = LocationImporter(batch_size=options['batch_size']).run(io.StringIO(data), 'csv')
+            return result.created
+
+        def single():
+            reader = csv.DictReader(io.StringIO(data))
+            count = 0
+            for row, _ in zip(reader, range(options['single_rows'])):
+                Location.objects.create(**{name: value or None for name, value in row.items()})
+                count += 1
+            return count
+
+        rates = {}
+        for name, run in (('save() per row', single), ('import_locations', bulk)):
+            rows, seconds = self.timed(run)
+            rates[name] = rows / seconds
+            self.stdout.write(f"  {name:<17} {rows:8,} rows in {seconds:7.2f}s   {rates[name]:10,.0f} rows/s")
+        self.stdout.write(f"  speedup {rates['import_locations'] / rates['save() per row']:.1f}x")
+
+    def timed(self, run):
+        """Run inside a transaction that is rolled back. Returns (rows, seconds)."""
+        try:
+            with transaction.atomic():
+                started = time.perf_counter()
+                rows = run()
+                seconds = time.perf_counter() - started
+                raise Rollback
+        except Rollback:
+            pass
+        return rows, seconds
+
+    def synthetic_csv(self, rng, rows, without_coordinates):
+        west, south, east, north = AREA
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(['name', 'location_type', 'category', 'address', 'city', 'country', 'latitude', 'longitude'])
+        for i in range(rows):
+            coordinates = ['', ''] if rng.random() < without_coordinates else [
+                f"{rng.uniform(south, north):.6f}", f"{rng.uniform(west, east):.6f}",
+            ]
+            writer.writerow([
+                f"Benchmark {i}",
+                rng.choice([choice for choice, _ in Location.TYPE_CHOICES]),
+                rng.choice([choice for choice, _ in Location.CATEGORY_CHOICES]),
+                f"  shderot   Rothschild {rng.randint(1, 200)} ",
+                rng.choice(CITIES),
+                'israel',
+                *coordinates,
+            ])
+        return out.getvalue()
@@ -0,0 +1,74 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from map.normalization import get_normalizer
+
+
+STREETS = (
+    'Shderot Rothschild', 'SHDEROT Ben-Gurion', 'sderot chen', 'Rechov Herzel', 'Dizengof', 'Ibn Gabirol',
+    'Jabotinski', 'Weizman', 'Allenby', 'King George', 'Derekh Menachem Begin', 'Sd. Yerushalayim', 'Hayarkon',
+)
+CITIES = (
+    'Tel Aviv', 'tel-aviv', 'TEL AVIV YAFO', 'Tel Aviv - Jaffa', 'jerusalem', 'Yerushalayim', 'haifa',
+    'Beer Sheva', 'beersheba', 'Petach Tikva', 'rishon le zion', 'Ramat Gan', 'natanya',
+)
+COUNTRIES = ('Israel', 'israel', 'IL', '', 'ISRAEL ')
+
+
+def legacy_normalize(address, city, country):
+    """The hardcoded normalization the rule tables replaced, as a baseline."""
+    if address:
+        address = ' '.join(address.split()).strip()
+        address = address.replace('Shderot', 'Sderot')
+        address = address.replace('SHDEROT', 'Sderot')
+    if city:
+        city_lower = city.lower()
+        if 'tel' in city_lower and 'aviv' in city_lower:
+            city = 'Tel Aviv'
+        else:
+            city = ' '.join(word.capitalize() for word in city.split())
+    if country:
+        country = country.strip().capitalize()
+    return address, city, country
+
+
+class Command(BaseCommand):
+    help = "Benchmark address normalization (compiled rule tables, memoized and batched) on synthetic addresses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1_000_000, help="Addresses normalized")
+        parser.add_argument('--distinct', type=int, default=50_000, help="Distinct addresses among them")
+        parser.add_argument('--batch-size', type=int, default=500, help="Rows per normalize_many call")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        pool = [
+            (f"{rng.choice(STREETS)} {rng.randint(1, 250)}", rng.choice(CITIES), rng.choice(COUNTRIES))
+            for _ in range(options['distinct'])
+        ]
+        rows = [rng.choice(pool) for _ in range(options['count'])]
+        normalizer = get_normalizer()
+        self.stdout.write(f"{len(rows):,} addresses, {len(set(rows)):,} distinct")
+
+        def measure(label, run):
+            started = time.perf_counter()
+            results = run()
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"  {label:<28} {elapsed:7.2f}s  {len(rows) / elapsed:12,.0f} rows/s  "
+                f"{len(set(results)):,} distinct results"
+            )
+
+        measure("legacy (hardcoded)", lambda: [legacy_normalize(*row) for row in rows])
+        measure("rules, no memo", lambda: [normalizer._normalize(*row) for row in rows])
+        normalizer.normalize.cache_clear()
+        measure("rules, memoized", lambda: [normalizer.normalize(*row) for row in rows])
+        normalizer.normalize.cache_clear()
+        batch_size = options['batch_size']
+        measure("rules, normalize_many", lambda: [
+            result
+            for start in range(0, len(rows), batch_size)
+            for result in normalizer.normalize_many(rows[start:start + batch_size])
+        ])
+        self.stdout.write(self.style.SUCCESS("Done"))
@@ -0,0 +1,123 @@
+import random
+import time
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from map.models import Location
+from map.spatial import GeohashIndex, haversine_m, radius_bbox, encode_geohash
+
+
+# Synthetic points are spread over roughly the area of Israel
+AREA = (34.2, 29.5, 35.9, 33.3)
+
+
+class Rollback(Exception):
+    """Raised to discard benchmark rows."""
+
+
+class Command(BaseCommand):
+    help = "Benchmark geohash-indexed spatial queries against naive filtering"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000], help="Dataset sizes")
+        parser.add_argument('--queries', type=int, default=50, help="Queries per measurement")
+        parser.add_argument('--radius', type=float, default=2000.0, help="Radius query size in metres")
+        parser.add_argument('--k', type=int, default=10, help="Neighbours for k-nearest queries")
+        parser.add_argument('--db', action='store_true', help="Also benchmark ORM queries on rows inserted in a rolled-back transaction")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        radius = options['radius']
+        k = options['k']
+
+        for size in options['sizes']:
+            west, south, east, north = AREA
+            points = [(i, rng.uniform(south, north), rng.uniform(west, east)) for i in range(size)]
+            centers = [(rng.uniform(south, north), rng.uniform(west, east)) for _ in range(options['queries'])]
+
+            started = time.perf_counter()
+            index = GeohashIndex(points)
+            build = time.perf_counter() - started
+            self.stdout.write(f"\n{size:,} points (index build {build:.2f}s)")
+
+            results = {}
+            for name, query in self._queries(points, index, radius, k).items():
+                started = time.perf_counter()
+                for lat, lng in centers:
+                    query(lat, lng)
+                results[name] = (time.perf_counter() - started) / len(centers) * 1000
+
+            for kind in ('bbox', 'radius', 'knn'):
+                naive, indexed = results[f'{kind}/naive'], results[f'{kind}/indexed']
+                self.stdout.write(
+                    f"  {kind:<7} naive {naive:9.3f} ms   indexed {indexed:9.3f} ms   speedup {naive / indexed:7.1f}x"
+                )
+
+            if options['db']:
+                self._benchmark_db(points, centers, radius, k)
+
+    def _queries(self, points, index, radius, k):
+        """Naive full scans and their indexed counterparts, keyed 'kind/variant'."""
+        def bbox_naive(lat, lng):
+            west, south, east, north = radius_bbox(lat, lng, radius)
+            return [p for p in points if south <= p[1] <= north and west <= p[2] <= east]
+
+        def bbox_indexed(lat, lng):
+            return index.in_bbox(*radius_bbox(lat, lng, radius))
+
+        def radius_naive(lat, lng):
+            return sorted(
+                (d, pk) for pk, plat, plng in points
+                if (d := haversine_m(lat, lng, plat, plng)) <= radius
+            )
+
+        def knn_naive(lat, lng):
+            return sorted((haversine_m(lat, lng, plat, plng), pk) for pk, plat, plng in points)[:k]
+
+        return {
+            'bbox/naive': bbox_naive,
+            'bbox/indexed': bbox_indexed,
+            'radius/naive': radius_naive,
+            'radius/indexed': lambda lat, lng: index.within_radius(lat, lng, radius),
+            'knn/naive': knn_naive,
+            'knn/indexed': lambda lat, lng: index.nearest(lat, lng, k),
+        }
+
+    def _benchmark_db(self, points, centers, radius, k):
+        """Time LocationQuerySet lookups against plain lat/lng filtering inside a rolled-back transaction."""
+        try:
+            with transaction.atomic():
+                Location.objects.bulk_create(
+                    (
+                        Location(
+                            name=f"Benchmark {pk}",
+                            latitude=Decimal(f"{lat:.6f}"), longitude=Decimal(f"{lng:.6f}"),
+                            geohash=encode_geohash(lat, lng),
+                        )
+                        for pk, lat, lng in points
+                    ),
+                    batch_size=5000,
+                )
+                queries = {
+                    'bbox/naive': lambda lat, lng: list(self._naive_bbox(lat, lng, radius)),
+                    'bbox/indexed': lambda lat, lng: list(Location.objects.in_bbox(*radius_bbox(lat, lng, radius)).values_list('id', flat=True)),
+                    'radius/indexed': lambda lat, lng: list(Location.objects.within_radius(lat, lng, radius).values_list('id', flat=True)),
+                    'knn/indexed': lambda lat, lng: list(Location.objects.nearest(lat, lng, k).values_list('id', flat=True)),
+                }
+                for name, query in queries.items():
+                    started = time.perf_counter()
+                    for lat, lng in centers:
+                        query(lat, lng)
+                    elapsed = (time.perf_counter() - started) / len(centers) * 1000
+                    self.stdout.write(f"  db {name:<15} {elapsed:9.3f} ms")
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _naive_bbox(self, lat, lng, radius):
+        west, south, east, north = radius_bbox(lat, lng, radius)
+        return Location.objects.filter(
+            latitude__gte=south, latitude__lte=north,
+            longitude__gte=west, longitude__lte=east,
+        ).values_list('id', flat=True)
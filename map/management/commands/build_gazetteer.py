@@ -0,0 +1,60 @@
+import csv
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from map.gazetteer import build_index
+
+
+# Accepted header names per field
+COLUMNS = {
+    'street': ('street', 'address', 'addr:street'),
+    'number': ('housenumber', 'house_number', 'number', 'addr:housenumber'),
+    'city': ('city', 'addr:city'),
+    'country': ('country', 'addr:country'),
+    'latitude': ('latitude', 'lat'),
+    'longitude': ('longitude', 'lon', 'lng'),
+}
+
+
+class Command(BaseCommand):
+    help = "Compile a CSV gazetteer extract (street, house number, city, country, latitude, longitude) into the offline geocoder index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV extract with a header row")
+        parser.add_argument('--output', default=None, help="Index file (default settings.GEOCODER_GAZETTEER)")
+
+    def handle(self, *args, **options):
+        output = options['output'] or getattr(settings, 'GEOCODER_GAZETTEER', None)
+        if not output:
+            raise CommandError("Set GEOCODER_GAZETTEER or pass --output")
+        started = time.monotonic()
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                reader = csv.DictReader(f)
+                header = {name.strip().lower(): name for name in reader.fieldnames or ()}
+                columns = {
+                    field: next((header[name] for name in names if name in header), None)
+                    for field, names in COLUMNS.items()
+                }
+                missing = [field for field in ('street', 'city', 'latitude', 'longitude') if columns[field] is None]
+                if missing:
+                    raise CommandError(f"Missing columns: {', '.join(missing)}")
+
+                def rows():
+                    for row in reader:
+                        try:
+                            float(row[columns['latitude']]), float(row[columns['longitude']])
+                        except (TypeError, ValueError):
+                            continue
+                        yield tuple(
+                            row[columns[field]] or '' if columns[field] else ''
+                            for field in ('street', 'number', 'city', 'country', 'latitude', 'longitude')
+                        )
+
+                written = build_index(rows(), output)
+        except OSError as e:
+            raise CommandError(f"Cannot read {options['path']}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {written} addresses into {output} in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+from collections import Counter
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, connections, transaction
+from map.models import Location
+
+
+LOADTEST_PREFIX = 'loadtest-'
+
+# Synthetic points are spread over roughly the area of Israel
+AREA = (34.2, 29.5, 35.9, 33.3)
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent read/write load test against the configured database. "
+        "Run it with different DATABASE_URL / DB_SQLITE_TUNING / DB_POOL settings to compare them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help="Concurrent clients")
+        parser.add_argument('--seconds', type=float, default=10.0, help="Test duration")
+        parser.add_argument('--write-ratio', type=float, default=0.5, help="Share of operations that write")
+        parser.add_argument('--rows', type=int, default=200, help="Temporary locations written to")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.describe_database()
+        west, south, east, north = AREA
+        rng = random.Random(options['seed'])
+        Location.objects.bulk_create([
+            Location(
+                name=f"{LOADTEST_PREFIX}{i}",
+                latitude=round(rng.uniform(south, north), 6),
+                longitude=round(rng.uniform(west, east), 6),
+            )
+            for i in range(options['rows'])
+        ])
+        ids = list(Location.objects.filter(name__startswith=LOADTEST_PREFIX).values_list('id', flat=True))
+
+        self.lock = threading.Lock()
+        self.latencies = {'read': [], 'write': []}
+        self.errors = Counter()
+        deadline = time.monotonic() + options['seconds']
+        threads = [
+            threading.Thread(target=self.client, args=(ids, options['write_ratio'], deadline, options['seed'] + n))
+            for n in range(options['threads'])
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            # Signals keep clusters and caches in sync while the rows go away
+            for location in Location.objects.filter(name__startswith=LOADTEST_PREFIX):
+                location.delete()
+
+        self.report(options['seconds'])
+
+    def describe_database(self):
+        settings = connection.settings_dict
+        line = f"{connection.vendor} {settings['NAME']}"
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                journal = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+                busy = cursor.execute("PRAGMA busy_timeout").fetchone()[0]
+            mode = settings.get('OPTIONS', {}).get('transaction_mode') or 'DEFERRED'
+            line += f" (journal_mode={journal}, busy_timeout={busy}ms, transactions={mode})"
+        else:
+            pool = settings.get('OPTIONS', {}).get('pool')
+            line += f" (pool={pool})" if pool else f" (CONN_MAX_AGE={settings['CONN_MAX_AGE']})"
+        self.stdout.write(line)
+
+    def client(self, ids, write_ratio, deadline, seed):
+        """One simulated client: admin-style saves mixed with viewport reads."""
+        rng = random.Random(seed)
+        west, south, east, north = AREA
+        try:
+            while time.monotonic() < deadline:
+                write = rng.random() < write_ratio
+                started = time.perf_counter()
+                try:
+                    if write:
+                        with transaction.atomic():
+                            location = Location.objects.get(pk=rng.choice(ids))
+                            location.name = f"{LOADTEST_PREFIX}{rng.randrange(10 ** 6)}"
+                            location.save()
+                    else:
+                        lng, lat = rng.uniform(west, east), rng.uniform(south, north)
+                        list(Location.objects.in_bbox(lng - 0.05, lat - 0.05, lng + 0.05, lat + 0.05).values('id', 'name')[:500])
+                except DatabaseError as e:
+                    with self.lock:
+                        self.errors[str(e).splitlines()[0][:80]] += 1
+                    continue
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.latencies['write' if write else 'read'].append(elapsed)
+        finally:
+            connections.close_all()
+
+    def report(self, seconds):
+        for kind, values in self.latencies.items():
+            if not values:
+                self.stdout.write(f"  {kind:<5} no successful operations")
+                continue
+            values.sort()
+            p50 = values[len(values) // 2] * 1000
+            p95 = values[int(len(values) * 0.95)] * 1000
+            self.stdout.write(
+                f"  {kind:<5} {len(values) / seconds:8.1f} ops/s   p50 {p50:8.2f} ms   p95 {p95:8.2f} ms   max {values[-1] * 1000:8.2f} ms"
+            )
+        total_errors = sum(self.errors.values())
+        style = self.style.ERROR if total_errors else self.style.SUCCESS
+        self.stdout.write(style(f"  errors: {total_errors}"))
+        for message, count in self.errors.most_common():
+            self.stdout.write(f"    {count:6d} × {message}")
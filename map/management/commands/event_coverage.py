@@ -0,0 +1,38 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from map.analytics import EventCoverage, catchment_radius
+from map.models import Event
+
+
+class Command(BaseCommand):
+    help = "Report the business catchment (by category) around the holders of each event"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--event', type=int, action='append', help="Event id (repeatable; default: all events)")
+        parser.add_argument('--radius', type=float, default=None, help="Catchment radius in metres (default settings.EVENT_CATCHMENT_RADIUS)")
+        parser.add_argument('--json', action='store_true', help="Print the full summaries as JSON Lines")
+
+    def handle(self, *args, **options):
+        radius = options['radius'] or catchment_radius()
+        events = Event.objects.select_related('buyer').order_by('id')
+        if options['event']:
+            events = events.filter(id__in=options['event'])
+            if not events.exists():
+                raise CommandError("No matching events")
+
+        for event in events.iterator():
+            summary = EventCoverage.get(event, radius)
+            if options['json']:
+                self.stdout.write(json.dumps(summary))
+                continue
+            self.stdout.write(f"\n{event.name} (#{event.id}): {summary['businesses']} businesses within {radius:g} m "
+                              f"of {len(summary['holders'])} holders")
+            if summary['unlocated_holders']:
+                self.stdout.write(f"  holders without coordinates: {summary['unlocated_holders']}")
+            for category, count in summary['categories'].items():
+                self.stdout.write(f"  {category or '(none)':<16} {count:6d}")
+            if summary['distances']:
+                self.stdout.write(f"  distance to holder (m): {summary['distances']}")
+                self.stdout.write(f"  distribution: {summary['distance_buckets']}")
+            if summary['buyer_distances']:
+                self.stdout.write(f"  buyer to holder (m): {summary['buyer_distances']}")
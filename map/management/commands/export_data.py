@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from map.export import DATASETS, EXPORT_CHUNK_SIZE, FORMATS, stream_export
+
+
+class Command(BaseCommand):
+    help = "Stream locations or events (one row per holder) as CSV, JSON Lines or GeoJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=list(DATASETS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', default='-', help="File to write ('-' writes standard output)")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help="Rows fetched from the database at a time")
+
+    def handle(self, *args, **options):
+        pieces = stream_export(options['dataset'], options['format'], chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            for piece in pieces:
+                self.stdout.write(piece, ending='')
+            return
+        with open(options['output'], 'w', newline='', encoding='utf-8') as out:
+            for piece in pieces:
+                out.write(piece)
+        self.stderr.write(self.style.SUCCESS(f"Wrote {options['dataset']} to {options['output']}"))
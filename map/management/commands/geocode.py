@@ -0,0 +1,157 @@
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from map.clustering import cluster_key, update_clusters
+from map.facets import LocationFacets
+from map.geocache import GeocodeCache, forward_query
+from map.geocoders import get_geocoder
+from map.models import GeocodingJob, Location
+from map.realtime import LiveUpdates
+from map.recommendations import HolderRecommender
+from map.snapshots import SnapshotBuilder
+from map.tiles import invalidate_tiles
+from map.utils import GeocodeRateLimiter
+
+
+class Command(BaseCommand):
+    help = "Bulk-geocode locations without coordinates using a pipelined, rate-limited geocoder"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', default=None, help="Geocoder dotted path (default settings.GEOCODER_BACKEND)")
+        parser.add_argument('--rate', type=float, default=None, help="Max requests per second (default: backend limit, 0 = unlimited)")
+        parser.add_argument('--workers', type=int, default=4, help="Concurrent in-flight requests")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Locations read and written per batch")
+        parser.add_argument('--limit', type=int, default=None, help="Stop after this many locations")
+        parser.add_argument('--no-cache', action='store_true', help="Ignore cached answers")
+
+    def handle(self, *args, **options):
+        geocoder = get_geocoder(options['backend'])
+        rate = options['rate'] if options['rate'] is not None else (geocoder.default_rate or 0)
+        # Own interval for this run; other users of the limiter in the process keep theirs
+        limiter = GeocodeRateLimiter.with_rate(rate) if rate else None
+        self.use_cache = not options['no_cache']
+        self.totals = defaultdict(int)
+        started = time.monotonic()
+        GeocodeCache.reset_stats()
+
+        pending = Location.objects.filter(latitude__isnull=True, longitude__isnull=True).exclude(address='')
+        rows = pending.values_list('id', 'address', 'city', 'country').order_by('id')
+        if options['limit']:
+            rows = rows[:options['limit']]
+
+        try:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                chunk = []
+                for row in rows.iterator(chunk_size=options['chunk_size']):
+                    chunk.append(row)
+                    if len(chunk) >= options['chunk_size']:
+                        self.process_chunk(chunk, geocoder, executor, limiter, options['workers'])
+                        chunk = []
+                if chunk:
+                    self.process_chunk(chunk, geocoder, executor, limiter, options['workers'])
+        finally:
+            geocoder.close()
+
+        elapsed = time.monotonic() - started
+        stats = GeocodeCache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"Locations: {self.totals['locations']}, unique addresses: {self.totals['unique']}, "
+            f"geocoded: {self.totals['geocoded']}, not found: {self.totals['not_found']}, "
+            f"errors: {self.totals['errors']}, cache hits: {stats['hits']}, "
+            f"requests: {self.totals['requests']} in {elapsed:.1f}s"
+        ))
+
+    def process_chunk(self, chunk, geocoder, executor, limiter, workers):
+        """Geocode one chunk: dedupe addresses, resolve cache hits, pipeline the rest, write back."""
+        by_query = defaultdict(list)
+        parts = {}
+        for location_id, address, city, country in chunk:
+            query = forward_query(address, city, country)
+            by_query[query].append(location_id)
+            parts[query] = (address, city, country)
+        self.totals['locations'] += len(chunk)
+        self.totals['unique'] += len(by_query)
+
+        results = {}
+        misses = []
+        for query in by_query:
+            cached = GeocodeCache.get_forward(query) if self.use_cache else GeocodeCache.MISS
+            if cached is GeocodeCache.MISS:
+                misses.append(query)
+            else:
+                results[query] = cached
+
+        # Pipeline requests: the rate limit spaces out dispatches while responses overlap
+        in_flight = {}
+        for query in misses:
+            if len(in_flight) >= workers:
+                self._collect(wait(in_flight, return_when=FIRST_COMPLETED).done, in_flight, results)
+            if limiter:
+                limiter.wait_if_needed()
+            in_flight[executor.submit(geocoder.geocode, *parts[query])] = query
+            self.totals['requests'] += 1
+        self._collect(wait(in_flight).done, in_flight, results)
+
+        self.write_results(by_query, results)
+
+    def _collect(self, done, in_flight, results):
+        for future in done:
+            query = in_flight.pop(future)
+            try:
+                coords = future.result()
+            except Exception as e:
+                self.totals['errors'] += 1
+                self.stderr.write(f"❌ Geocoding error for '{query}': {e}")
+                continue
+            results[query] = coords
+            if self.use_cache:
+                GeocodeCache.set_forward(query, coords)
+
+    def write_results(self, by_query, results):
+        """Save coordinates with bulk_update and settle their queued jobs."""
+        now = timezone.now()
+        updated = []
+        for query, coords in results.items():
+            if coords is None:
+                self.totals['not_found'] += len(by_query[query])
+                continue
+            for location_id in by_query[query]:
+                location = Location(
+                    id=location_id,
+                    latitude=Decimal(f"{coords[0]:.6f}"),
+                    longitude=Decimal(f"{coords[1]:.6f}"),
+                    updated_at=now,
+                )
+                location.geohash = location.compute_geohash()
+                updated.append(location)
+        if not updated:
+            return
+
+        ids = [location.id for location in updated]
+        with transaction.atomic():
+            Location.objects.bulk_update(updated, ['latitude', 'longitude', 'geohash', 'updated_at'])
+            GeocodingJob.objects.filter(
+                location_id__in=ids, status__in=GeocodingJob.ACTIVE_STATUSES
+            ).update(status=GeocodingJob.STATUS_DONE, updated_at=now)
+            # bulk_update skips signals, so add the new coordinates to the clusters here
+            filter_values = set()
+            holder_ids, business_points = [], []
+            for location in Location.objects.filter(id__in=ids).only(
+                'latitude', 'longitude', 'country', 'location_type', 'category'
+            ):
+                update_clusters(None, cluster_key(location))
+                filter_values.add((location.country, location.location_type, location.category))
+                if location.location_type == Location.TYPE_HOLDER:
+                    holder_ids.append(location.id)
+                elif location.location_type == Location.TYPE_BUSINESS:
+                    business_points.append((location.latitude, location.longitude))
+        LocationFacets.invalidate()
+        HolderRecommender.refresh_bulk(holder_ids, business_points)
+        invalidate_tiles([(location.latitude, location.longitude) for location in updated])
+        LiveUpdates.record('location', ids)
+        SnapshotBuilder.mark_stale(filter_values)
+        self.totals['geocoded'] += len(updated)
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Q
+from django.utils import timezone
+from map.geocache import GeocodeCache
+from map.models import GeocodeCacheEntry
+
+
+class Command(BaseCommand):
+    help = "Show geocode cache statistics and purge expired or all entries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--purge-expired', action='store_true', help="Delete expired entries")
+        parser.add_argument('--clear', action='store_true', help="Delete every entry")
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            deleted, _ = GeocodeCacheEntry.objects.all().delete()
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} cache entries"))
+        elif options['purge_expired']:
+            self.stdout.write(self.style.SUCCESS(f"Purged {GeocodeCache.purge_expired()} expired entries"))
+
+        now = timezone.now()
+        for row in GeocodeCacheEntry.objects.values('kind').annotate(
+            total=Count('id'),
+            negative=Count('id', filter=Q(found=False)),
+            expired=Count('id', filter=Q(expires_at__lte=now)),
+        ).order_by('kind'):
+            self.stdout.write(
+                f"{row['kind']:<8} entries: {row['total']}  negative: {row['negative']}  expired: {row['expired']}"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from map.tasks import GeocodingQueue, default_worker_id
+
+
+class Command(BaseCommand):
+    help = "Run the geocoding worker that processes queued GeocodingJob rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Drain due jobs and exit instead of polling")
+        parser.add_argument('--poll-interval', type=float, default=5.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument('--worker-id', default=None, help="Name recorded on claimed jobs (default host:pid)")
+        parser.add_argument('--concurrency', type=int, default=4, help="Jobs in flight at once on the event loop")
+
+    def handle(self, *args, **options):
+        worker_id = options['worker_id'] or default_worker_id()
+        if options['once']:
+            result = GeocodingQueue.process_queue(worker_id, concurrency=options['concurrency'])
+            self.stdout.write(self.style.SUCCESS(
+                f"Processed: {result['processed']}, Failed: {result['failed']}"
+            ))
+            return
+
+        self.stdout.write(f"Geocoding worker {worker_id} started")
+        try:
+            GeocodingQueue.run_worker(worker_id, poll_interval=options['poll_interval'], concurrency=options['concurrency'])
+        except KeyboardInterrupt:
+            self.stdout.write("Geocoding worker stopped")
@@ -0,0 +1,43 @@
+import csv
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from map.importer import BATCH_SIZE, FORMATS, LocationImporter, detect_format
+
+
+class Command(BaseCommand):
+    help = "Bulk import locations from a CSV or JSON Lines file (one object per line)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import ('-' reads standard input)")
+        parser.add_argument('--format', choices=FORMATS, default=None, help="File format (default: from the extension)")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Rows per INSERT transaction")
+        parser.add_argument('--dry-run', action='store_true', help="Validate only, write nothing")
+        parser.add_argument('--show-errors', type=int, default=20, help="Invalid rows listed in the output")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path == '-' else detect_format(path))
+        importer = LocationImporter(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        try:
+            if path == '-':
+                result = importer.run(sys.stdin, fmt)
+            else:
+                with open(path, newline='', encoding='utf-8-sig') as stream:
+                    result = importer.run(stream, fmt)
+        except OSError as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+        except (UnicodeDecodeError, csv.Error) as e:
+            result = importer.result
+            raise CommandError(f"Cannot read {path} after line {result.rows}: {e} ({result.created} rows imported before it)")
+
+        for line_number, message in result.errors[:options['show_errors']]:
+            self.stdout.write(self.style.ERROR(f"  line {line_number}: {message}"))
+        if len(result.errors) > options['show_errors']:
+            self.stdout.write(f"  ... {len(result.errors) - options['show_errors']} more invalid rows")
+
+        verb = "Validated" if options['dry_run'] else "Imported"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {result.created} of {result.rows} rows in {result.seconds:.2f}s "
+            f"({result.rows_per_second:,.0f} rows/s), invalid: {len(result.errors)}, "
+            f"geocoding queued: {result.geocoding_queued}, image URLs registered: {result.images_registered}"
+        ))
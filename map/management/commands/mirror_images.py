@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from map.mirror import RemoteImageFetcher, RemoteImageMirror
+
+
+class Command(BaseCommand):
+    help = "Download external logo/photo URLs once, optimize them and serve the local copy"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Concurrent downloads")
+        parser.add_argument('--processes', type=int, default=None, help="Encoder processes (default: CPU count)")
+        parser.add_argument('--limit', type=int, default=None, help="URLs downloaded or re-validated per run")
+        parser.add_argument('--max-bytes', type=int, default=None, help="Reject bodies larger than this (default settings.REMOTE_IMAGE_MAX_BYTES)")
+        parser.add_argument('--watch', action='store_true', help="Keep running and pick up new URLs")
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds between polls with --watch")
+
+    def handle(self, *args, **options):
+        fetcher = RemoteImageFetcher(max_bytes=options['max_bytes'], pool_size=options['workers'])
+        while True:
+            mirror = RemoteImageMirror(workers=options['workers'], processes=options['processes'], fetcher=fetcher)
+            stats = mirror.run(limit=options['limit'])
+            if not options['watch'] or any(stats.values()):
+                self.stdout.write(self.style.SUCCESS(
+                    f"Downloaded: {stats['downloaded']}, not modified: {stats['not_modified']}, "
+                    f"locations updated: {stats['applied']}, failed: {stats['failed']}"
+                ))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,39 @@
+import time
+from django.core.management.base import BaseCommand
+from map.images import IMAGE_SPECS, ImagePipeline
+from map.models import Location
+
+
+class Command(BaseCommand):
+    help = "Optimize pending Location logos and product photos in a pool of worker processes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+        parser.add_argument('--batch-size', type=int, default=50, help="Images read per batch")
+        parser.add_argument('--limit', type=int, default=None, help="Stop after about this many images")
+        parser.add_argument('--all', action='store_true', help="Re-check every uploaded image (legacy media gets optimized, outputs are kept; mirrored URLs are left to mirror_images)")
+        parser.add_argument('--watch', action='store_true', help="Keep running and pick up new uploads")
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds between polls with --watch")
+
+    def handle(self, *args, **options):
+        if options['all']:
+            # Only uploads: the hash of a mirrored external URL is its content hash, and clearing it
+            # would make mirror_images download and encode every URL again
+            reset = sum(
+                Location.objects.exclude(**{field_name: ''}).filter(**{f'{field_name}__isnull': False}).update(
+                    **{f'{field_name}_hash': ''}
+                )
+                for field_name in IMAGE_SPECS
+            )
+            self.stdout.write(f"Marked {reset} uploaded images for reprocessing")
+
+        while True:
+            pipeline = ImagePipeline(workers=options['workers'], batch_size=options['batch_size'])
+            stats = pipeline.run(limit=options['limit'])
+            if not options['watch'] or any(stats.values()):
+                self.stdout.write(self.style.SUCCESS(
+                    f"Optimized: {stats['optimized']}, reused: {stats['reused']}, failed: {stats['failed']}"
+                ))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from map.clustering import rebuild_clusters
+
+
+class Command(BaseCommand):
+    help = "Recompute all precomputed map clusters from the Location table"
+
+    def handle(self, *args, **options):
+        written = rebuild_clusters()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} cluster cells"))
@@ -0,0 +1,12 @@
+import time
+from django.core.management.base import BaseCommand
+from map.recommendations import HolderRecommender
+
+
+class Command(BaseCommand):
+    help = "Recompute the recommendation features (nearby businesses per category) of every holder"
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        written = HolderRecommender.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt features of {written} holders in {time.perf_counter() - started:.2f}s"))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from map.snapshots import SnapshotBuilder
+
+
+class Command(BaseCommand):
+    help = "Rebuild the pre-serialized map snapshots (every one on disk and the unfiltered one)"
+
+    def handle(self, *args, **options):
+        written = SnapshotBuilder.rebuild_all()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {written} snapshots"))
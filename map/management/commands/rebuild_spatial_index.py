@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from map.models import Location
+
+
+class Command(BaseCommand):
+    help = "Recompute the geohash spatial index key of every Location"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows per bulk update")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        batch = []
+        updated = 0
+        rows = Location.objects.only('id', 'latitude', 'longitude', 'geohash').order_by('id')
+        for location in rows.iterator(chunk_size=batch_size):
+            geohash = location.compute_geohash()
+            if geohash != location.geohash:
+                location.geohash = geohash
+                batch.append(location)
+            if len(batch) >= batch_size:
+                Location.objects.bulk_update(batch, ['geohash'])
+                updated += len(batch)
+                batch = []
+        if batch:
+            Location.objects.bulk_update(batch, ['geohash'])
+            updated += len(batch)
+        self.stdout.write(self.style.SUCCESS(f"Updated geohash for {updated} locations"))
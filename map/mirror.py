@@ -0,0 +1,238 @@
+"""Local mirror of external logo/photo URLs (company_logo_url / product_photo_url).
+
+The mirror_images worker downloads each distinct URL once, runs it through the
+same optimization as uploads and records the source hash on every location
+using it, so the map serves the local copy instead of hot-linking. Mirrored
+URLs are re-validated with ETag / Last-Modified every REMOTE_IMAGE_REFRESH
+seconds; bodies above REMOTE_IMAGE_MAX_BYTES are rejected.
+"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import httpx
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .images import (
+    available_variant_formats, content_hash, load_manifest, optimize_task, report_image_update, store_outputs,
+)
+from .models import Location, RemoteImage
+
+
+# Defaults (override with settings.REMOTE_IMAGE_MAX_BYTES / REMOTE_IMAGE_REFRESH / REMOTE_IMAGE_TIMEOUT)
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_REFRESH = 7 * 24 * 3600
+DEFAULT_TIMEOUT = 10
+
+# Failed downloads wait RETRY_BASE_DELAY * 2**(failures-1) seconds, capped at RETRY_MAX_DELAY
+RETRY_BASE_DELAY = 300
+RETRY_MAX_DELAY = 7 * 24 * 3600
+
+# External URL column of each image field
+URL_FIELDS = {
+    'company_logo': 'company_logo_url',
+    'product_photo': 'product_photo_url',
+}
+
+
+class RemoteImageTooLarge(Exception):
+    """The remote body exceeds the size cap."""
+
+
+class RemoteImageFetcher:
+    """Conditional, size-capped downloads over a pooled async HTTP client."""
+    user_agent = 'FreeCups-Django-App/1.0'
+
+    def __init__(self, timeout=None, max_bytes=None, pool_size=4):
+        self.timeout = timeout or getattr(settings, 'REMOTE_IMAGE_TIMEOUT', DEFAULT_TIMEOUT)
+        self.max_bytes = max_bytes or getattr(settings, 'REMOTE_IMAGE_MAX_BYTES', DEFAULT_MAX_BYTES)
+        self.pool_size = pool_size
+
+    def client(self) -> httpx.AsyncClient:
+        """Keep-alive client for one batch of downloads (use as an async context manager)."""
+        return httpx.AsyncClient(
+            timeout=self.timeout,
+            follow_redirects=True,
+            headers={'User-Agent': self.user_agent},
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+        )
+
+    async def fetch(self, client: httpx.AsyncClient, url: str, etag: str = '', last_modified: str = ''):
+        """Download url. Returns None if unchanged (304), else (body, etag, last_modified); raises on errors."""
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 304:
+                return None
+            response.raise_for_status()
+            length = response.headers.get('Content-Length', '')
+            if length.isdigit() and int(length) > self.max_bytes:
+                raise RemoteImageTooLarge(f"{length} bytes (limit {self.max_bytes})")
+            body = bytearray()
+            async for chunk in response.aiter_bytes(64 * 1024):
+                body.extend(chunk)
+                if len(body) > self.max_bytes:
+                    raise RemoteImageTooLarge(f"more than {self.max_bytes} bytes")
+        return bytes(body), response.headers.get('ETag', ''), response.headers.get('Last-Modified', '')
+
+
+def _without_upload(field_name: str) -> Q:
+    return Q(**{field_name: ''}) | Q(**{f'{field_name}__isnull': True})
+
+
+def pending_remote_images(field_name: str):
+    """Locations showing an external URL in field_name that has no local mirror yet."""
+    url_field = URL_FIELDS[field_name]
+    return Location.objects.filter(
+        _without_upload(field_name), **{f'{field_name}_hash': ''}
+    ).exclude(**{url_field: ''}).exclude(**{f'{url_field}__isnull': True})
+
+
+class RemoteImageMirror:
+    """Downloads due RemoteImage rows concurrently on an event loop and encodes them in a process pool."""
+
+    def __init__(self, workers: int = 4, processes: int = None, fetcher: RemoteImageFetcher = None):
+        self.workers = workers
+        self.processes = processes
+        self.fetcher = fetcher or RemoteImageFetcher(pool_size=workers)
+        self.formats = available_variant_formats()
+        self.refresh = getattr(settings, 'REMOTE_IMAGE_REFRESH', DEFAULT_REFRESH)
+        self.stats = {'downloaded': 0, 'not_modified': 0, 'applied': 0, 'failed': 0}
+
+    def discover(self) -> dict:
+        """Register external URLs still lacking a mirror. Returns {url: fields needing it}."""
+        pending = {}
+        for field_name, url_field in URL_FIELDS.items():
+            for url in pending_remote_images(field_name).values_list(url_field, flat=True).distinct():
+                pending.setdefault(url, set()).add(field_name)
+        RemoteImage.objects.bulk_create([RemoteImage(url=url) for url in pending], ignore_conflicts=True)
+        return pending
+
+    def apply(self, remote: RemoteImage) -> bool:
+        """Point locations using remote.url (without an upload) at the mirrored copy.
+
+        Returns False if some field using the URL has not been encoded for this content yet.
+        """
+        complete = True
+        for field_name, url_field in URL_FIELDS.items():
+            rows = Location.objects.filter(_without_upload(field_name), **{url_field: remote.url}).exclude(
+                **{f'{field_name}_hash': remote.content_hash}
+            ).values_list('id', 'image_variants', 'country', 'location_type', 'category')
+            rows = list(rows)
+            if not rows:
+                continue
+            manifest = load_manifest(field_name, remote.content_hash)
+            if manifest is None:
+                complete = False
+                continue
+            for location_id, image_variants, *filter_values in rows:
+                image_variants = dict(image_variants or {})
+                image_variants[field_name] = manifest
+                # Conditional on the URL so an edit made meanwhile is not overwritten
+                updated = Location.objects.filter(
+                    _without_upload(field_name), id=location_id, **{url_field: remote.url}
+                ).update(**{
+                    f'{field_name}_hash': remote.content_hash,
+                    'image_variants': image_variants,
+                    'updated_at': timezone.now(),
+                })
+                if updated:
+                    report_image_update(location_id, tuple(filter_values))
+                self.stats['applied'] += updated
+        return complete
+
+    def _failed(self, remote: RemoteImage, error):
+        print(f"❌ Mirroring failed for {remote.url}: {error}")
+        self.stats['failed'] += 1
+        remote.failures += 1
+        remote.last_error = str(error)[:1000]
+        if not remote.content_hash:
+            remote.status = RemoteImage.STATUS_FAILED
+        delay = min(RETRY_BASE_DELAY * 2 ** (remote.failures - 1), RETRY_MAX_DELAY)
+        remote.check_after = timezone.now() + timedelta(seconds=delay)
+        remote.save()
+
+    async def _fetch_all(self, due):
+        """Download every due URL, at most `workers` at a time. Returns [(remote, result, error)]."""
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async with self.fetcher.client() as client:
+            async def fetch(remote):
+                async with semaphore:
+                    try:
+                        return remote, await self.fetcher.fetch(client, remote.url, remote.etag, remote.last_modified), None
+                    except Exception as e:
+                        return remote, None, f"{type(e).__name__}: {e}"
+
+            return await asyncio.gather(*(fetch(remote) for remote in due))
+
+    def run(self, limit: int = None) -> dict:
+        """Mirror new URLs and refresh those due for re-validation."""
+        pending = self.discover()
+
+        # URLs already mirrored (e.g. reused by a new location) only need to be applied
+        for remote in RemoteImage.objects.filter(url__in=list(pending), status=RemoteImage.STATUS_OK):
+            if not self.apply(remote):
+                # Needed for another field than it was encoded for: download it again in full
+                RemoteImage.objects.filter(id=remote.id).update(etag='', last_modified='', check_after=timezone.now())
+
+        due = list(RemoteImage.objects.filter(check_after__lte=timezone.now()).order_by('check_after')[:limit])
+        if not due:
+            return self.stats
+
+        # Slow hosts only hold a socket each, not a thread
+        fetched = asyncio.run(self._fetch_all(due))
+
+        # Encode every field that uses a downloaded URL, once per (field, content)
+        downloaded = []
+        tasks = {}
+        now = timezone.now()
+        for remote, result, error in fetched:
+            if error:
+                self._failed(remote, error)
+                continue
+            if result is None:
+                self.stats['not_modified'] += 1
+                remote.failures = 0
+                remote.fetched_at = now
+                remote.check_after = now + timedelta(seconds=self.refresh)
+                remote.save(update_fields=['failures', 'fetched_at', 'check_after'])
+                self.apply(remote)
+                continue
+            data, etag, last_modified = result
+            source_hash = content_hash(data)
+            for field_name, url_field in URL_FIELDS.items():
+                in_use = Location.objects.filter(_without_upload(field_name), **{url_field: remote.url}).exists()
+                if in_use and load_manifest(field_name, source_hash) is None:
+                    tasks[(field_name, source_hash)] = (field_name, source_hash, data, True, self.formats)
+            downloaded.append((remote, source_hash, len(data), etag, last_modified))
+
+        errors = {}
+        if tasks:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                for field_name, source_hash, main, variants, error in pool.map(optimize_task, tasks.values()):
+                    if error:
+                        errors[source_hash] = error
+                    else:
+                        store_outputs(field_name, source_hash, main, variants)
+
+        for remote, source_hash, size, etag, last_modified in downloaded:
+            if source_hash in errors:
+                self._failed(remote, errors[source_hash])
+                continue
+            remote.status = RemoteImage.STATUS_OK
+            remote.content_hash = source_hash
+            remote.size = size
+            remote.etag = etag[:255]
+            remote.last_modified = last_modified[:64]
+            remote.failures = 0
+            remote.last_error = ''
+            remote.fetched_at = now
+            remote.check_after = now + timedelta(seconds=self.refresh)
+            remote.save()
+            self.stats['downloaded'] += 1
+            self.apply(remote)
+        return self.stats
@@ -1,7 +1,58 @@
+import math
 from django.db import models
-from django.core.files.base import ContentFile
-from PIL import Image, ImageOps
-from io import BytesIO
+from django.db.models import ExpressionWrapper, FloatField, Q, Value
+from django.db.models.fields.files import FieldFile
+from django.db.models.functions import ASin, Cast, Cos, Power, Radians, Sin, Sqrt
+from django.utils import timezone
+from .normalization import get_normalizer
+from .spatial import EARTH_RADIUS_M, encode_geohash, geohash_ranges, radius_bbox
+
+
+class LocationQuerySet(models.QuerySet):
+    """Spatial lookups backed by the indexed geohash column."""
+    
+    def in_bbox(self, west, south, east, north):
+        """Locations inside a bounding box (west > east crosses the antimeridian)."""
+        if west > east:
+            return self.in_bbox(west, south, 180.0, north) | self.in_bbox(-180.0, south, east, north)
+        cells = Q()
+        for low, high in geohash_ranges(west, south, east, north):
+            cells |= Q(geohash__gte=low, geohash__lt=high)
+        return self.filter(
+            cells,
+            latitude__gte=south, latitude__lte=north,
+            longitude__gte=west, longitude__lte=east,
+        )
+    
+    def with_distance(self, latitude, longitude):
+        """Annotate `distance`: great-circle metres from the given point (haversine)."""
+        lat = Radians(Cast('latitude', FloatField()))
+        lng = Radians(Cast('longitude', FloatField()))
+        origin_lat = math.radians(latitude)
+        origin_lng = math.radians(longitude)
+        a = (
+            Power(Sin((lat - Value(origin_lat)) / 2), 2)
+            + Value(math.cos(origin_lat)) * Cos(lat) * Power(Sin((lng - Value(origin_lng)) / 2), 2)
+        )
+        return self.annotate(distance=ExpressionWrapper(
+            Value(2 * EARTH_RADIUS_M) * ASin(Sqrt(a)),
+            output_field=FloatField(),
+        ))
+    
+    def within_radius(self, latitude, longitude, meters):
+        """Locations within `meters` of a point, annotated with `distance`."""
+        return self.in_bbox(*radius_bbox(latitude, longitude, meters)).with_distance(
+            latitude, longitude
+        ).filter(distance__lte=meters)
+    
+    def nearest(self, latitude, longitude, k=10, start_radius=500.0):
+        """The k nearest locations to a point, nearest first, annotated with `distance`."""
+        radius = start_radius
+        while True:
+            candidates = self.within_radius(latitude, longitude, radius)
+            if radius >= math.pi * EARTH_RADIUS_M or candidates.count() >= k:
+                return candidates.order_by('distance')[:k]
+            radius *= 2
 
 
 class Location(models.Model):
@@ -23,11 +74,14 @@ class Location(models.Model):
     
     # Company/Business branding
     company_logo = models.ImageField(upload_to='company_logos/', blank=True, null=True, help_text="Company/Business logo (auto-optimized to 100x100)")
-    company_logo_url = models.URLField(blank=True, null=True, help_text="External company logo URL (alternative to upload)")
+    company_logo_url = models.URLField(blank=True, null=True, help_text="External company logo URL (alternative to upload, mirrored locally by mirror_images)")
+    company_logo_hash = models.CharField(max_length=64, blank=True, editable=False, help_text="SHA-256 of the source image once optimized (empty = pending)")
     
     # Product/Service offering
     product_photo = models.ImageField(upload_to='product_photos/', blank=True, null=True, help_text="Product/Service photo being offered or distributed (auto-optimized to 300x300)")
-    product_photo_url = models.URLField(blank=True, null=True, help_text="External product photo URL (alternative to upload)")
+    product_photo_url = models.URLField(blank=True, null=True, help_text="External product photo URL (alternative to upload, mirrored locally by mirror_images)")
+    product_photo_hash = models.CharField(max_length=64, blank=True, editable=False, help_text="SHA-256 of the source image once optimized (empty = pending)")
+    image_variants = models.JSONField(default=dict, blank=True, editable=False, help_text="Responsive variant manifests per image field (written by process_images)")
     
     # Business category (for TYPE_BUSINESS)
     CATEGORY_OFFICE_WORKERS = 'office_workers'
@@ -60,6 +114,7 @@ class Location(models.Model):
     # Coordinates
     latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, help_text="Auto-filled via geocoding if empty")
     longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True, help_text="Auto-filled via geocoding if empty")
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False, help_text="Spatial index key, derived from coordinates")
     
     # Address details
     address = models.CharField(max_length=255, blank=True)
@@ -70,6 +125,14 @@ class Location(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = LocationQuerySet.as_manager()
+    
+    # Fields whose stored values drive save-time decisions (images, geocoding, clusters)
+    TRACKED_FIELDS = (
+        'address', 'city', 'country', 'latitude', 'longitude', 'location_type', 'category',
+        'company_logo', 'company_logo_url', 'product_photo', 'product_photo_url',
+    )
+    
     class Meta:
         verbose_name = "location"
         verbose_name_plural = "locations"
@@ -77,129 +140,137 @@ class Location(models.Model):
             models.Index(fields=['latitude', 'longitude']),
             models.Index(fields=['location_type']),
             models.Index(fields=['country']),
+            # Delta sync reads changes in (updated_at, id) order
+            models.Index(fields=['updated_at', 'id']),
         ]
     
     def __str__(self):
         return f"{self.name} ({self.get_location_type_display()})"
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._snapshot_tracked_fields()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        # Values are copied from a fresh instance, so the stored values must be taken again here
+        self._snapshot_tracked_fields(fields)
+
+    def _tracked_value(self, name):
+        value = getattr(self, name)
+        if isinstance(value, FieldFile):
+            return value.name or ''
+        return value
+    
+    def _snapshot_tracked_fields(self, names=None):
+        """Remember tracked values as stored in the database (skipping deferred fields)."""
+        if not hasattr(self, '_saved_values'):
+            self._saved_values = {}
+        deferred = self.get_deferred_fields()
+        for name in names or self.TRACKED_FIELDS:
+            if name in self.TRACKED_FIELDS and name not in deferred:
+                self._saved_values[name] = self._tracked_value(name)
+    
+    def saved_value(self, name):
+        """Value of a tracked field as last loaded from or saved to the database."""
+        saved_values = getattr(self, '_saved_values', {})
+        if name in saved_values:
+            return saved_values[name]
+        if name in self.get_deferred_fields():
+            # Never loaded nor assigned, so the stored value is the current one
+            return self._tracked_value(name)
+        # Not snapshotted (e.g. assigned after a partial load): ask the database
+        return Location._base_manager.filter(pk=self.pk).values_list(name, flat=True).first()
+    
+    def has_changed(self, name):
+        """Whether a tracked field differs from its stored value (always True for unsaved locations)."""
+        if self._state.adding:
+            return True
+        if name in self.get_deferred_fields():
+            return False
+        return self._tracked_value(name) != self.saved_value(name)
+    
+    @staticmethod
+    def normalize_address(address, city, country):
+        """Return sanitized (address, city, country) for better geocoding (rules in map/address_rules.json)."""
+        return get_normalizer().normalize(address, city, country)
+    
     def clean_address(self):
         """Sanitize address fields for better geocoding."""
-        if self.address:
-            # Remove excess whitespace and capitalize properly
-            self.address = ' '.join(self.address.split()).strip()
-            # Fix common street type misspellings
-            self.address = self.address.replace('Shderot', 'Sderot')
-            self.address = self.address.replace('SHDEROT', 'Sderot')
-        
-        if self.city:
-            # Fix Tel Aviv variations first
-            city_lower = self.city.lower()
-            if 'tel' in city_lower and 'aviv' in city_lower:
-                self.city = 'Tel Aviv'
-            else:
-                # Proper case for other city names
-                self.city = ' '.join(word.capitalize() for word in self.city.split())
-        
-        if self.country:
-            # Capitalize country properly
-            self.country = self.country.strip().capitalize()
+        self.address, self.city, self.country = self.normalize_address(self.address, self.city, self.country)
     
     def save(self, *args, **kwargs):
-        """Sanitize address and optimize company logo and product photo on save."""
+        """Sanitize address and queue company logo and product photo for optimization on save."""
         # Clean address fields
         self.clean_address()
         
-        # Check if company_logo is a new upload (not just a path to existing file)
-        logo_changed = False
-        old_logo = None
-        if self.pk:
-            try:
-                old_instance = Location.objects.get(pk=self.pk)
-                logo_changed = old_instance.company_logo != self.company_logo
-                if logo_changed and old_instance.company_logo:
-                    old_logo = old_instance.company_logo
-            except Location.DoesNotExist:
-                logo_changed = bool(self.company_logo)
-        else:
-            logo_changed = bool(self.company_logo)
-        
-        # Only process company_logo if it's a new file upload
-        if logo_changed and self.company_logo and hasattr(self.company_logo, 'file'):
-            self._optimize_image(self.company_logo, 100, 100)
-            # Delete old logo file if it exists
-            if old_logo:
-                old_logo.delete(save=False)
+        # Keep the spatial index key in sync with the coordinates
+        self.geohash = self.compute_geohash()
         
-        # Check if product_photo is a new upload
-        product_changed = False
-        old_photo = None
-        if self.pk:
-            try:
-                old_instance = Location.objects.get(pk=self.pk)
-                product_changed = old_instance.product_photo != self.product_photo
-                if product_changed and old_instance.product_photo:
-                    old_photo = old_instance.product_photo
-            except Location.DoesNotExist:
-                product_changed = bool(self.product_photo)
-        else:
-            product_changed = bool(self.product_photo)
+        # Decide from the values loaded with the instance; no extra SELECT
+        old_logo = ''
+        if self.has_changed('company_logo') or self.has_changed('company_logo_url'):
+            # New images are optimized in the background (process_images, mirror_images for external URLs);
+            # the original is served until then
+            self.company_logo_hash = ''
+            if not self._state.adding and self.has_changed('company_logo'):
+                old_logo = self.saved_value('company_logo')
         
-        # Only process product_photo if it's a new file upload
-        if product_changed and self.product_photo and hasattr(self.product_photo, 'file'):
-            self._optimize_image(self.product_photo, 300, 300)
-            # Delete old photo file if it exists
-            if old_photo:
-                old_photo.delete(save=False)
+        old_photo = ''
+        if self.has_changed('product_photo') or self.has_changed('product_photo_url'):
+            self.product_photo_hash = ''
+            if not self._state.adding and self.has_changed('product_photo'):
+                old_photo = self.saved_value('product_photo')
         
         super().save(*args, **kwargs)
+        self._snapshot_tracked_fields(kwargs.get('update_fields'))
+        
+        # Delete replaced files once nothing points at them (optimized files can be shared)
+        from .images import delete_if_unreferenced
+        if old_logo and self.company_logo:
+            delete_if_unreferenced(old_logo)
+        if old_photo and self.product_photo:
+            delete_if_unreferenced(old_photo)
     
-    def _optimize_image(self, image_field, width, height):
-        """Helper method to optimize images."""
-        try:
-            # Check if file has actual content
-            image_field.file.seek(0)
-            img = Image.open(image_field.file)
-            
-            # Fix orientation based on EXIF data (phone photos)
-            img = ImageOps.exif_transpose(img)
-            
-            # Convert to RGB if necessary
-            if img.mode in ('RGBA', 'LA', 'P'):
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            
-            # Resize to specified dimensions for fast loading
-            img.thumbnail((width, height), Image.Resampling.LANCZOS)
-            
-            # Save optimized
-            output = BytesIO()
-            img.save(output, format='JPEG', quality=85, optimize=True)
-            output.seek(0)
-            
-            # Replace file
-            image_field.save(
-                image_field.name,
-                ContentFile(output.read()),
-                save=False
-            )
-        except Exception as e:
-            # If image processing fails, just skip it
-            pass
+    def compute_geohash(self):
+        """Geohash of the current coordinates ('' without coordinates)."""
+        if self.latitude is None or self.longitude is None:
+            return ''
+        return encode_geohash(float(self.latitude), float(self.longitude))
     
     def get_company_logo_url(self):
-        """Get company logo URL (uploaded file or external URL)."""
-        if self.company_logo:
-            return self.company_logo.url
-        return self.company_logo_url or ''
+        """Get company logo URL (uploaded file, local mirror of the external URL, or the external URL)."""
+        from .images import image_url
+        return image_url('company_logo', self.company_logo.name, self.company_logo_url, self.company_logo_hash)
     
     def get_product_photo_url(self):
-        """Get product photo URL (uploaded file or external URL)."""
-        if self.product_photo:
-            return self.product_photo.url
-        return self.product_photo_url or ''
+        """Get product photo URL (uploaded file, local mirror of the external URL, or the external URL)."""
+        from .images import image_url
+        return image_url('product_photo', self.product_photo.name, self.product_photo_url, self.product_photo_hash)
+    
+    def get_company_logo_variant_url(self, width=64, fmt='webp'):
+        """Smallest logo variant at least `width` pixels wide, falling back to the logo itself."""
+        from .images import current_manifest, variant_url
+        manifest = current_manifest(self.image_variants, 'company_logo', self.company_logo_hash)
+        return variant_url('company_logo', manifest, width, fmt) or self.get_company_logo_url()
+    
+    def get_company_logo_srcset(self, fmt='webp'):
+        """srcset of the logo variants ('' until they are generated)."""
+        from .images import current_manifest, variant_srcset
+        return variant_srcset('company_logo', current_manifest(self.image_variants, 'company_logo', self.company_logo_hash), fmt)
+    
+    def get_product_photo_variant_url(self, width=300, fmt='webp'):
+        """Smallest product photo variant at least `width` pixels wide, falling back to the photo itself."""
+        from .images import current_manifest, variant_url
+        manifest = current_manifest(self.image_variants, 'product_photo', self.product_photo_hash)
+        return variant_url('product_photo', manifest, width, fmt) or self.get_product_photo_url()
+    
+    def get_product_photo_srcset(self, fmt='webp'):
+        """srcset of the product photo variants ('' until they are generated)."""
+        from .images import current_manifest, variant_srcset
+        return variant_srcset('product_photo', current_manifest(self.image_variants, 'product_photo', self.product_photo_hash), fmt)
     
     def has_coordinates(self):
         """Check if location has valid coordinates."""
@@ -257,3 +328,202 @@ class Event(models.Model):
         return f"{self.name} (by {self.buyer.name})"
 
 
+
+
+class LocationCluster(models.Model):
+    """Precomputed grid cluster: Location count per zoom level, grid cell and filter combination."""
+    
+    zoom = models.PositiveSmallIntegerField()
+    cell_x = models.PositiveIntegerField()
+    cell_y = models.PositiveIntegerField()
+    
+    # Filter dimensions, so clusters can be served per map filter
+    country = models.CharField(max_length=100, blank=True)
+    location_type = models.CharField(max_length=10, choices=Location.TYPE_CHOICES)
+    category = models.CharField(max_length=20, blank=True)
+    
+    # Aggregates (sums give the centroid without touching Location)
+    count = models.PositiveIntegerField(default=0)
+    latitude_sum = models.FloatField(default=0)
+    longitude_sum = models.FloatField(default=0)
+    
+    class Meta:
+        verbose_name = "location cluster"
+        verbose_name_plural = "location clusters"
+        constraints = [
+            models.UniqueConstraint(
+                fields=['zoom', 'cell_x', 'cell_y', 'country', 'location_type', 'category'],
+                name='unique_location_cluster_cell',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['zoom', 'cell_x', 'cell_y']),
+        ]
+    
+    def __str__(self):
+        return f"z{self.zoom} ({self.cell_x}, {self.cell_y}): {self.count}"
+
+
+class GeocodeCacheEntry(models.Model):
+    """Persisted geocoding answer (including 'not found') keyed on the normalized query."""
+    
+    KIND_FORWARD = 'forward'
+    KIND_REVERSE = 'reverse'
+    KIND_CHOICES = [
+        (KIND_FORWARD, 'Address → coordinates'),
+        (KIND_REVERSE, 'Coordinates → address'),
+    ]
+    
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    key = models.CharField(max_length=64, help_text="SHA-256 of the normalized query")
+    query = models.CharField(max_length=500, help_text="Normalized query, for inspection")
+    
+    # found=False is a cached negative answer
+    found = models.BooleanField(default=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True, help_text="Reverse geocoding payload")
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    
+    class Meta:
+        verbose_name = "geocode cache entry"
+        verbose_name_plural = "geocode cache entries"
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key'], name='unique_geocode_cache_key'),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()}: {self.query}"
+
+
+class GeocodingJob(models.Model):
+    """Durable geocoding work item, claimed by the geocode_worker process."""
+    
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = (STATUS_PENDING, STATUS_RUNNING)
+    
+    location = models.ForeignKey(Location, on_delete=models.CASCADE, related_name='geocoding_jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(help_text="Not claimed before this time (retry backoff)")
+    
+    # Claim bookkeeping
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "geocoding job"
+        verbose_name_plural = "geocoding jobs"
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
+        constraints = [
+            # At most one queued or running job per location
+            models.UniqueConstraint(
+                fields=['location'],
+                condition=Q(status__in=['pending', 'running']),
+                name='unique_active_geocoding_job',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"Geocode {self.location_id} ({self.status})"
+
+
+class RateLimit(models.Model):
+    """Named rate limit slot shared by every process through the database."""
+    
+    name = models.CharField(max_length=50, primary_key=True)
+    next_allowed_at = models.DateTimeField()
+    
+    class Meta:
+        verbose_name = "rate limit"
+        verbose_name_plural = "rate limits"
+    
+    def __str__(self):
+        return self.name
+
+
+class RemoteImage(models.Model):
+    """External logo/photo URL mirrored locally by the mirror_images worker."""
+    
+    STATUS_PENDING = 'pending'
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_OK, 'Mirrored'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    
+    url = models.URLField(max_length=500, unique=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    content_hash = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the last downloaded body")
+    size = models.PositiveIntegerField(null=True, blank=True)
+    
+    # HTTP validators for conditional refreshes
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    
+    failures = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    check_after = models.DateTimeField(default=timezone.now, db_index=True, help_text="Next download or refresh")
+    
+    class Meta:
+        verbose_name = "remote image"
+        verbose_name_plural = "remote images"
+    
+    def __str__(self):
+        return self.url
+
+
+class HolderFeatures(models.Model):
+    """Precomputed recommendation features of a holder: businesses per category around it."""
+    
+    holder = models.OneToOneField(Location, on_delete=models.CASCADE, primary_key=True, related_name='features')
+    # {category: business count} within the feature radius ('' = uncategorized)
+    category_counts = models.JSONField(default=dict)
+    businesses = models.PositiveIntegerField(default=0)
+    radius = models.FloatField(help_text="Metres the counts were taken within")
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        verbose_name = "holder features"
+        verbose_name_plural = "holder features"
+    
+    def __str__(self):
+        return f"Features of {self.holder_id}: {self.businesses} businesses"
+
+
+class LocationTombstone(models.Model):
+    """Record that a location left the map (deleted, or moved out of a filter), for delta sync clients."""
+    
+    location_id = models.BigIntegerField()
+    # Filter values the location had, so filtered clients only receive their own removals
+    country = models.CharField(max_length=100, blank=True)
+    location_type = models.CharField(max_length=10, choices=Location.TYPE_CHOICES)
+    category = models.CharField(max_length=20, blank=True)
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    class Meta:
+        verbose_name = "location tombstone"
+        verbose_name_plural = "location tombstones"
+    
+    def __str__(self):
+        return f"Location {self.location_id} removed at {self.deleted_at}"
@@ -0,0 +1,121 @@
+"""Rules-driven address normalization, used by Location.normalize_address.
+
+The rule tables are data (map/address_rules.json, or settings.ADDRESS_RULES_FILE):
+"countries" maps country spellings to one name, and each case-folded country
+(plus "*" for every country) lists street-line "abbreviations" and
+"transliterations" and "city_aliases". Adding a spelling variant is a data
+change.
+
+For each country the street-line rules are compiled into one case-insensitive
+alternation, so an address is rewritten in a single regex pass whatever the
+number of rules. Results are memoized per (address, city, country), and
+normalize_many serves the repeated rows of an import batch from one call.
+Addresses without a country use the rules of settings.ADDRESS_DEFAULT_COUNTRY.
+"""
+import json
+import re
+import threading
+from functools import lru_cache
+from pathlib import Path
+from django.conf import settings
+
+
+DEFAULT_RULES_FILE = Path(__file__).resolve().parent / 'address_rules.json'
+DEFAULT_COUNTRY = 'Israel'
+
+# Distinct (address, city, country) triples kept memoized
+MEMO_SIZE = 65536
+
+WORD_TABLES = ('abbreviations', 'transliterations')
+CITY_PUNCTUATION = re.compile(r"[^\w\s']|_")
+
+
+def _city_key(city: str) -> str:
+    return ' '.join(CITY_PUNCTUATION.sub(' ', city).split()).casefold()
+
+
+class AddressNormalizer:
+    """Normalizes (address, city, country) triples with one rule set."""
+
+    def __init__(self, rules: dict, default_country: str = DEFAULT_COUNTRY):
+        self.rules = rules
+        self.country_aliases = {key.casefold(): name for key, name in rules.get('countries', {}).items()}
+        self.default_country = default_country
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.normalize = lru_cache(maxsize=MEMO_SIZE)(self._normalize)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f), **kwargs)
+
+    def _table(self, country_key: str):
+        """(compiled word pattern or None, {word: replacement}, {city key: city}) of a country."""
+        table = self._tables.get(country_key)
+        if table is None:
+            words, cities = {}, {}
+            for section in ('*', country_key):
+                rules = self.rules.get(section, {})
+                for name in WORD_TABLES:
+                    words.update({word.casefold(): value for word, value in rules.get(name, {}).items()})
+                cities.update({_city_key(alias): value for alias, value in rules.get('city_aliases', {}).items()})
+            pattern = None
+            if words:
+                # Longest first, so multi-word rules win over their first word
+                alternatives = '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+                pattern = re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE)
+            table = (pattern, words, cities)
+            with self._lock:
+                self._tables[country_key] = table
+        return table
+
+    def normalize_country(self, country):
+        if not country:
+            return country
+        country = ' '.join(country.split())
+        return self.country_aliases.get(country.casefold(), country.capitalize())
+
+    def _normalize(self, address, city, country):
+        country = self.normalize_country(country)
+        pattern, words, cities = self._table((country or self.default_country).casefold())
+
+        if address:
+            address = ' '.join(address.split())
+            if pattern is not None:
+                address = pattern.sub(lambda match: words[match.group().casefold()], address)
+
+        if city:
+            city = cities.get(_city_key(city)) or ' '.join(word.capitalize() for word in city.split())
+
+        return address, city, country
+
+    def normalize_many(self, rows) -> list:
+        """Normalize (address, city, country) rows, each distinct row once."""
+        done = {}
+        results = []
+        for row in rows:
+            row = tuple(row)
+            result = done.get(row)
+            if result is None:
+                result = done[row] = self.normalize(*row)
+            results.append(result)
+        return results
+
+
+_normalizer = None
+_normalizer_lock = threading.Lock()
+
+
+def get_normalizer() -> AddressNormalizer:
+    """Process-wide normalizer for the configured rules file."""
+    global _normalizer
+    if _normalizer is not None:
+        return _normalizer
+    with _normalizer_lock:
+        if _normalizer is None:
+            _normalizer = AddressNormalizer.from_file(
+                getattr(settings, 'ADDRESS_RULES_FILE', None) or DEFAULT_RULES_FILE,
+                default_country=getattr(settings, 'ADDRESS_DEFAULT_COUNTRY', DEFAULT_COUNTRY),
+            )
+        return _normalizer
@@ -0,0 +1,285 @@
+"""Live map updates pushed to open pages over Server-Sent Events.
+
+map.signals report Location and Event changes here once their transaction
+commits (bulk code paths report their ids themselves). Changes are coalesced
+for REALTIME_BATCH_INTERVAL seconds, so a bulk geocode touching thousands of
+rows becomes a few batched diffs instead of one message per row:
+
+    event: patch
+    data: {"locations": {"changed": [<row as in locations_api>], "deleted": [ids]},
+           "events": {"changed": [{id, name, buyer_id, buyer, holders, created}], "deleted": [ids]}}
+
+Locations that lost their coordinates are listed as deleted. A batch too big
+to be worth patching (more than MAX_PATCH_LOCATIONS, or an import) is sent as
+`event: reload` and pages reload their current view instead.
+
+Event details name buyers and holders, so the "events" section is only sent
+to staff streams; other streams get the location changes alone and skip
+batches that only touched events.
+
+Batches go through the broker named by settings.REALTIME_BROKER.
+InProcessBroker fans out to the streams open in this process, which is enough
+for a single ASGI worker; RedisBroker goes through Redis pub/sub so changes
+made by management commands and other workers reach every stream. Streams are
+long-lived requests and need the ASGI entry point (freecups/asgi.py).
+"""
+import asyncio
+import json
+import threading
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+from .models import Event, Location
+
+
+DEFAULT_REALTIME_BROKER = 'map.realtime.InProcessBroker'
+
+# Seconds changes are collected before a batch is sent (override with settings.REALTIME_BATCH_INTERVAL)
+DEFAULT_BATCH_INTERVAL = 0.5
+
+# Larger location batches are sent as a reload
+MAX_PATCH_LOCATIONS = 500
+
+# Batches queued for one stream before it is told to reload instead (slow clients)
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Comment line sent on idle streams so proxies keep them open
+KEEPALIVE_SECONDS = 15
+
+# Browser reconnect delay after a dropped stream
+RECONNECT_MS = 5000
+
+RELOAD = {'type': 'reload'}
+
+
+class InProcessBroker:
+    """Delivers batches to the streams subscribed in this process."""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    @property
+    def listening(self) -> bool:
+        """Whether a published batch can reach any stream."""
+        return bool(self._subscribers)
+
+    def publish(self, message: dict):
+        """Send a batch to every stream (callable from any thread)."""
+        self.deliver(message)
+
+    def deliver(self, message: dict):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._put, queue, message)
+            except RuntimeError:
+                # Event loop already closed
+                self.unsubscribe((loop, queue))
+
+    @staticmethod
+    def _put(queue, message):
+        if queue.full():
+            # The client missed batches: drop them and make it reload
+            while not queue.empty():
+                queue.get_nowait()
+            message = RELOAD
+        queue.put_nowait(message)
+
+    def subscribe(self):
+        """Register a stream of the running event loop. Returns a handle whose queue receives batches."""
+        subscription = (asyncio.get_running_loop(), asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE))
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+
+class RedisBroker(InProcessBroker):
+    """Publishes batches on a Redis channel; each process relays the channel to its own streams."""
+
+    def __init__(self, url: str = None, channel: str = 'freecups:map-updates'):
+        super().__init__()
+        # Imported here so the in-process broker works without the redis package
+        import redis
+        self.url = url or getattr(settings, 'REALTIME_REDIS_URL', None) or settings.CACHE_URL
+        self.channel = channel
+        self._client = redis.Redis.from_url(self.url)
+        self._listener = None
+
+    @property
+    def listening(self) -> bool:
+        # Streams may be open in other processes
+        return True
+
+    def publish(self, message: dict):
+        self._client.publish(self.channel, json.dumps(message))
+
+    def subscribe(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        return super().subscribe()
+
+    async def _listen(self):
+        import redis.asyncio
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(self.channel)
+        try:
+            async for item in pubsub.listen():
+                self.deliver(json.loads(item['data']))
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker() -> InProcessBroker:
+    """Process-wide instance of settings.REALTIME_BROKER."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(getattr(settings, 'REALTIME_BROKER', DEFAULT_REALTIME_BROKER))()
+        return _broker
+
+
+class LiveUpdates:
+    """Coalesces model changes into batches and streams them to pages."""
+
+    _lock = threading.Lock()
+    # {(kind, id): 'created' | 'changed' | 'deleted'}
+    _pending = {}
+    _reload = False
+    _timer = None
+
+    @classmethod
+    def record(cls, kind: str, ids, action: str = 'changed'):
+        """Queue changes of 'location' or 'event' ids for the next batch."""
+        if not ids or not get_broker().listening:
+            return
+        with cls._lock:
+            for pk in ids:
+                previous = cls._pending.get((kind, pk))
+                if action != 'deleted' and previous == 'created':
+                    continue
+                cls._pending[(kind, pk)] = action
+            cls._schedule()
+
+    @classmethod
+    def record_on_commit(cls, kind: str, ids, action: str = 'changed'):
+        """record() once the current transaction commits (nothing is registered while no stream listens)."""
+        if ids and get_broker().listening:
+            transaction.on_commit(lambda: cls.record(kind, ids, action))
+
+    @classmethod
+    def reload(cls):
+        """Ask pages to reload their view (after changes too large to list)."""
+        if not get_broker().listening:
+            return
+        with cls._lock:
+            cls._reload = True
+            cls._schedule()
+
+    @classmethod
+    def _schedule(cls):
+        if cls._timer is None:
+            cls._timer = threading.Timer(
+                getattr(settings, 'REALTIME_BATCH_INTERVAL', DEFAULT_BATCH_INTERVAL), cls._flush_in_timer
+            )
+            cls._timer.start()
+
+    @classmethod
+    def _flush_in_timer(cls):
+        try:
+            cls.flush()
+        finally:
+            # Timer threads do not keep a database connection
+            connection.close()
+
+    @classmethod
+    def flush(cls):
+        """Publish the pending changes as one batch."""
+        with cls._lock:
+            pending, reload = cls._pending, cls._reload
+            cls._pending, cls._reload, cls._timer = {}, False, None
+        location_ids = {pk: action for (kind, pk), action in pending.items() if kind == 'location'}
+        event_ids = {pk: action for (kind, pk), action in pending.items() if kind == 'event'}
+        if reload or len(location_ids) > MAX_PATCH_LOCATIONS:
+            get_broker().publish(RELOAD)
+        elif pending:
+            get_broker().publish(cls.build_patch(location_ids, event_ids))
+
+    @staticmethod
+    def build_patch(locations: dict, events: dict) -> dict:
+        """Patch message for {id: action} maps of locations and events."""
+        # Imported here: views depends on this module
+        from .views import API_LOCATION_FIELDS, serialize_location
+
+        changed = [
+            serialize_location(row) for row in Location.objects.filter(
+                id__in=[pk for pk, action in locations.items() if action != 'deleted'],
+                latitude__isnull=False, longitude__isnull=False,
+            ).values(*API_LOCATION_FIELDS).order_by('id')
+        ]
+        shown = {row['id'] for row in changed}
+
+        event_rows = list(Event.objects.filter(
+            id__in=[pk for pk, action in events.items() if action != 'deleted']
+        ).values('id', 'name', 'buyer_id', 'buyer__name').order_by('id'))
+        holders = {}
+        for event_id, holder_id in Event.holders.through.objects.filter(
+            event_id__in=[row['id'] for row in event_rows]
+        ).values_list('event_id', 'location_id'):
+            holders.setdefault(event_id, []).append(holder_id)
+        found = {row['id'] for row in event_rows}
+
+        return {
+            'type': 'patch',
+            'locations': {
+                'changed': changed,
+                'deleted': sorted(pk for pk in locations if pk not in shown),
+            },
+            'events': {
+                'changed': [{
+                    'id': row['id'],
+                    'name': row['name'],
+                    'buyer_id': row['buyer_id'],
+                    'buyer': row['buyer__name'],
+                    'holders': sorted(holders.get(row['id'], [])),
+                    'created': events[row['id']] == 'created',
+                } for row in event_rows],
+                'deleted': sorted(pk for pk in events if pk not in found),
+            },
+        }
+
+    @staticmethod
+    async def stream(include_events: bool = False):
+        """Server-Sent Events body: one event per batch, keepalive comments in between.
+
+        include_events adds the events section of patches (staff streams only).
+        """
+        broker = get_broker()
+        subscription = broker.subscribe()
+        _, queue = subscription
+        try:
+            yield f"retry: {RECONNECT_MS}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if not include_events and 'events' in message:
+                    message = {key: value for key, value in message.items() if key != 'events'}
+                    if not any(message['locations'].values()):
+                        continue
+                yield f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
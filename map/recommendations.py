@@ -0,0 +1,220 @@
+"""Holder recommendations for a buyer's next event.
+
+Each holder has a precomputed HolderFeatures row: how many businesses of each
+category lie within HOLDER_FEATURE_RADIUS metres of it. Ranking a buyer's
+candidates therefore needs one geohash-indexed query (holders near the buyer,
+joined to their features) and arithmetic on a few hundred rows, however many
+locations exist. Features are refreshed incrementally by map.signals: a
+holder when it moves, and the holders around a business when it is added,
+moved, recategorized or deleted; bulk writes call refresh_bulk(). rebuild()
+recomputes all of them.
+"""
+import math
+from collections import Counter
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from .models import Event, HolderFeatures, Location
+from .spatial import GeohashIndex
+
+
+# Defaults (override with settings.HOLDER_FEATURE_RADIUS / RECOMMENDATION_SEARCH_RADIUS /
+# RECOMMENDATION_RECENT_DAYS / RECOMMENDATION_CATEGORY_WEIGHTS)
+DEFAULT_FEATURE_RADIUS = 1000
+DEFAULT_SEARCH_RADIUS = 10_000
+DEFAULT_RECENT_DAYS = 30
+DEFAULT_CATEGORY_WEIGHTS = {
+    Location.CATEGORY_OFFICE_WORKERS: 1.0,
+    Location.CATEGORY_STUDENTS: 1.0,
+    Location.CATEGORY_SHOPPERS: 1.0,
+    Location.CATEGORY_TOURISTS: 1.0,
+    Location.CATEGORY_MEDICAL: 0.8,
+    Location.CATEGORY_GOVERNMENT: 0.8,
+    Location.CATEGORY_TRANSPORT: 1.0,
+    Location.CATEGORY_RESIDENTIAL: 0.6,
+    Location.CATEGORY_OTHER: 0.5,
+    '': 0.5,
+}
+
+# The search radius doubles up to this until enough candidates are found
+MAX_SEARCH_RADIUS = 200_000
+
+# Score = PROXIMITY_WEIGHT * proximity + (1 - PROXIMITY_WEIGHT) * normalized business density;
+# proximity halves at PROXIMITY_SCALE metres
+PROXIMITY_WEIGHT = 0.5
+PROXIMITY_SCALE = 2000.0
+
+REBUILD_BATCH_SIZE = 1000
+
+# Above this many changed holders and businesses in one bulk write, rebuild() is cheaper than refreshing around each
+REFRESH_REBUILD_THRESHOLD = 200
+
+
+def feature_radius() -> float:
+    return getattr(settings, 'HOLDER_FEATURE_RADIUS', DEFAULT_FEATURE_RADIUS)
+
+
+def category_weights() -> dict:
+    return {**DEFAULT_CATEGORY_WEIGHTS, **getattr(settings, 'RECOMMENDATION_CATEGORY_WEIGHTS', {})}
+
+
+class HolderRecommender:
+    """Maintains holder features and ranks holders for a buyer."""
+
+    @staticmethod
+    def count_businesses(latitude, longitude, radius) -> dict:
+        """{category: count} of businesses within radius of a point."""
+        rows = Location.objects.filter(location_type=Location.TYPE_BUSINESS).within_radius(
+            float(latitude), float(longitude), radius
+        ).values('category').annotate(count=Count('id')).order_by()
+        return {row['category'] or '': row['count'] for row in rows}
+
+    @classmethod
+    def refresh(cls, holder_ids):
+        """Recompute the features of some holders (dropping them for non-holders or missing coordinates)."""
+        radius = feature_radius()
+        holders = Location.objects.filter(
+            id__in=holder_ids, location_type=Location.TYPE_HOLDER,
+            latitude__isnull=False, longitude__isnull=False,
+        ).values_list('id', 'latitude', 'longitude')
+        refreshed = set()
+        for holder_id, latitude, longitude in holders:
+            counts = cls.count_businesses(latitude, longitude, radius)
+            HolderFeatures.objects.update_or_create(holder_id=holder_id, defaults={
+                'category_counts': counts, 'businesses': sum(counts.values()), 'radius': radius,
+            })
+            refreshed.add(holder_id)
+        HolderFeatures.objects.filter(holder_id__in=set(holder_ids) - refreshed).delete()
+        return len(refreshed)
+
+    @classmethod
+    def refresh_around(cls, points):
+        """Refresh the holders whose feature radius contains any of the (latitude, longitude) points."""
+        radius = feature_radius()
+        holder_ids = set()
+        for latitude, longitude in points:
+            holder_ids.update(
+                Location.objects.filter(location_type=Location.TYPE_HOLDER).within_radius(
+                    float(latitude), float(longitude), radius
+                ).values_list('id', flat=True)
+            )
+        if holder_ids:
+            cls.refresh(holder_ids)
+
+    @classmethod
+    def refresh_bulk(cls, holder_ids, business_points):
+        """Refresh after a bulk write that skipped the signals: the holders it placed and those around its businesses."""
+        if len(holder_ids) + len(business_points) > REFRESH_REBUILD_THRESHOLD:
+            cls.rebuild()
+            return
+        if holder_ids:
+            cls.refresh(holder_ids)
+        if business_points:
+            cls.refresh_around(business_points)
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """Recompute every holder's features in memory. Returns the number of holders."""
+        radius = feature_radius()
+        located = Location.objects.filter(latitude__isnull=False, longitude__isnull=False)
+        categories = {}
+        points = []
+        for pk, latitude, longitude, category in located.filter(location_type=Location.TYPE_BUSINESS).values_list(
+            'id', 'latitude', 'longitude', 'category'
+        ).iterator(chunk_size=REBUILD_BATCH_SIZE):
+            categories[pk] = category or ''
+            points.append((pk, float(latitude), float(longitude)))
+        index = GeohashIndex(points)
+
+        features = []
+        for pk, latitude, longitude in located.filter(location_type=Location.TYPE_HOLDER).values_list(
+            'id', 'latitude', 'longitude'
+        ).iterator(chunk_size=REBUILD_BATCH_SIZE):
+            counts = Counter(categories[business_id] for _, business_id in index.within_radius(
+                float(latitude), float(longitude), radius
+            ))
+            features.append(HolderFeatures(
+                holder_id=pk, category_counts=dict(counts), businesses=sum(counts.values()), radius=radius,
+            ))
+
+        with transaction.atomic():
+            HolderFeatures.objects.all().delete()
+            HolderFeatures.objects.bulk_create(features, batch_size=REBUILD_BATCH_SIZE)
+        return len(features)
+
+    @staticmethod
+    def recently_used(days: int):
+        """Ids of holders taking part in events created in the last `days` days."""
+        cutoff = timezone.now() - timedelta(days=days)
+        return Event.holders.through.objects.filter(event__created_at__gte=cutoff).values('location_id')
+
+    @classmethod
+    def _candidates(cls, latitude, longitude, radius, exclude):
+        return list(
+            Location.objects.filter(location_type=Location.TYPE_HOLDER)
+            .within_radius(latitude, longitude, radius)
+            .exclude(id__in=exclude)
+            .values('id', 'name', 'city', 'latitude', 'longitude', 'distance',
+                    'features__category_counts', 'features__radius')
+        )
+
+    @classmethod
+    def recommend(cls, buyer: Location, limit: int = 10, categories=None, radius: float = None, recent_days: int = None) -> list:
+        """Best holders for the buyer, best first.
+
+        categories restricts the density score to those business categories
+        (default: every category with the configured weights).
+        """
+        if buyer.latitude is None or buyer.longitude is None:
+            raise ValueError("The buyer has no coordinates")
+        latitude, longitude = float(buyer.latitude), float(buyer.longitude)
+        if radius is None:
+            radius = getattr(settings, 'RECOMMENDATION_SEARCH_RADIUS', DEFAULT_SEARCH_RADIUS)
+        if not (math.isfinite(radius) and radius > 0):
+            raise ValueError("radius must be a positive number of metres")
+        recent_days = getattr(settings, 'RECOMMENDATION_RECENT_DAYS', DEFAULT_RECENT_DAYS) if recent_days is None else recent_days
+        weights = category_weights()
+        if categories:
+            weights = {category: weights.get(category, 1.0) for category in categories}
+
+        exclude = cls.recently_used(recent_days) if recent_days else []
+        candidates = cls._candidates(latitude, longitude, radius, exclude)
+        while len(candidates) < limit and radius < MAX_SEARCH_RADIUS:
+            radius *= 2
+            candidates = cls._candidates(latitude, longitude, radius, exclude)
+
+        # Features not computed yet (or for another radius) are filled in now
+        current_radius = feature_radius()
+        stale = [row['id'] for row in candidates if row['features__radius'] != current_radius]
+        if stale:
+            cls.refresh(stale)
+            counts = dict(HolderFeatures.objects.filter(holder_id__in=stale).values_list('holder_id', 'category_counts'))
+            for row in candidates:
+                if row['id'] in counts:
+                    row['features__category_counts'] = counts[row['id']]
+
+        scored = []
+        for row in candidates:
+            counts = row['features__category_counts'] or {}
+            density = math.fsum(weights.get(category, 0.0) * count for category, count in counts.items())
+            scored.append((row, counts, density))
+        max_density = max((density for _, _, density in scored), default=0.0) or 1.0
+
+        results = []
+        for row, counts, density in scored:
+            proximity = 1.0 / (1.0 + row['distance'] / PROXIMITY_SCALE)
+            score = PROXIMITY_WEIGHT * proximity + (1 - PROXIMITY_WEIGHT) * density / max_density
+            results.append({
+                'id': row['id'],
+                'name': row['name'],
+                'city': row['city'],
+                'lat': float(row['latitude']),
+                'lng': float(row['longitude']),
+                'distance': round(row['distance'], 1),
+                'businesses': counts,
+                'score': round(score, 4),
+            })
+        results.sort(key=lambda result: (-result['score'], result['distance']))
+        return results[:limit]
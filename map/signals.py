@@ -0,0 +1,217 @@
+from types import SimpleNamespace
+from django.db import transaction
+from django.db.models.signals import m2m_changed, pre_save, post_save, post_delete
+from django.dispatch import receiver
+from .models import Event, Location, LocationTombstone
+from .analytics import EventCoverage
+from .realtime import LiveUpdates
+from .recommendations import HolderRecommender
+from .snapshots import SnapshotBuilder
+from .sync import prune_tombstones
+from .tiles import invalidate_tiles
+from .clustering import cluster_key, update_clusters
+from .facets import FACET_FIELDS, LocationFacets
+
+
+# Location fields read by cluster_key
+CLUSTER_FIELDS = ('latitude', 'longitude', 'country', 'location_type', 'category')
+
+# Location fields the map filters (and sync tombstones) use
+FILTER_FIELDS = ('country', 'location_type', 'category')
+
+# Location fields holder recommendation features depend on
+FEATURE_FIELDS = ('latitude', 'longitude', 'location_type', 'category')
+
+
+@receiver(pre_save, sender=Location)
+def remember_cluster_key(sender, instance, **kwargs):
+    """Remember which clusters the stored row counts in before it is overwritten."""
+    instance._old_cluster_key = None
+    if not instance._state.adding:
+        # Built from the values tracked since the instance was loaded (see Location.saved_value)
+        instance._old_cluster_key = cluster_key(SimpleNamespace(**{
+            name: instance.saved_value(name) for name in CLUSTER_FIELDS
+        }))
+
+
+@receiver(post_save, sender=Location)
+def update_location_clusters(sender, instance, **kwargs):
+    """Move the location between precomputed clusters if its position or filters changed."""
+    update_clusters(getattr(instance, '_old_cluster_key', None), cluster_key(instance))
+
+
+@receiver(post_delete, sender=Location)
+def remove_location_from_clusters(sender, instance, **kwargs):
+    """Drop a deleted location from its clusters."""
+    update_clusters(cluster_key(instance), None)
+
+
+@receiver(post_save, sender=Location)
+def invalidate_map_cache_on_save(sender, instance, created, **kwargs):
+    """Drop the cached map page and facets when a field they show changed."""
+    if created or any(instance.has_changed(name) for name in FACET_FIELDS):
+        LocationFacets.invalidate()
+
+
+@receiver(post_delete, sender=Location)
+def invalidate_map_cache_on_delete(sender, instance, **kwargs):
+    LocationFacets.invalidate()
+
+
+@receiver(m2m_changed, sender=Event.holders.through)
+def remember_cleared_events(sender, instance, action, reverse, **kwargs):
+    """post_clear has no pk_set, so note the events a holder's clear() removes it from beforehand."""
+    if action == 'pre_clear' and reverse:
+        instance._cleared_event_ids = list(Event.objects.filter(holders=instance).values_list('id', flat=True))
+
+
+def changed_event_ids(instance, action, reverse, pk_set) -> list:
+    """Ids of the events whose holders an m2m_changed signal reports a change of."""
+    if not reverse:
+        return [instance.pk]
+    if action == 'post_clear':
+        return getattr(instance, '_cleared_event_ids', [])
+    return list(pk_set)
+
+
+@receiver(m2m_changed, sender=Event.holders.through)
+def refresh_event_coverage(sender, instance, action, reverse, pk_set, **kwargs):
+    """Recompute coverage of events whose holders changed (only new holders are queried)."""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        event_ids = changed_event_ids(instance, action, reverse, pk_set)
+        events = list(Event.objects.filter(pk__in=event_ids).select_related('buyer'))
+    else:
+        events = [instance]
+    transaction.on_commit(lambda: [EventCoverage.get(event) for event in events])
+
+
+def _business_point(location_type, latitude, longitude):
+    if location_type == Location.TYPE_BUSINESS and latitude is not None and longitude is not None:
+        return latitude, longitude
+    return None
+
+
+@receiver(post_save, sender=Location)
+def refresh_holder_features_on_save(sender, instance, created, **kwargs):
+    """Refresh the features of a moved holder, or of the holders around a changed business."""
+    if not created and not any(instance.has_changed(name) for name in FEATURE_FIELDS):
+        return
+    holder_ids = set()
+    points = []
+    if instance.location_type == Location.TYPE_HOLDER:
+        holder_ids.add(instance.id)
+    new_point = _business_point(instance.location_type, instance.latitude, instance.longitude)
+    if new_point:
+        points.append(new_point)
+    if not created:
+        old_type = instance.saved_value('location_type')
+        if old_type == Location.TYPE_HOLDER:
+            # No longer a holder: refresh drops its features
+            holder_ids.add(instance.id)
+        old_point = _business_point(old_type, instance.saved_value('latitude'), instance.saved_value('longitude'))
+        if old_point:
+            points.append(old_point)
+
+    def refresh():
+        if holder_ids:
+            HolderRecommender.refresh(holder_ids)
+        if points:
+            HolderRecommender.refresh_around(points)
+    transaction.on_commit(refresh)
+
+
+@receiver(post_delete, sender=Location)
+def refresh_holder_features_on_delete(sender, instance, **kwargs):
+    """Holders around a deleted business lose it from their counts."""
+    point = _business_point(instance.location_type, instance.latitude, instance.longitude)
+    if point:
+        transaction.on_commit(lambda: HolderRecommender.refresh_around([point]))
+
+
+@receiver(post_save, sender=Location)
+def invalidate_tiles_on_save(sender, instance, created, **kwargs):
+    """Drop the cached point tiles at the old and new position of a moved or refiltered location."""
+    if not created and not any(instance.has_changed(name) for name in CLUSTER_FIELDS):
+        return
+    points = []
+    if instance.latitude is not None and instance.longitude is not None:
+        points.append((instance.latitude, instance.longitude))
+    if not created:
+        old = (instance.saved_value('latitude'), instance.saved_value('longitude'))
+        if None not in old:
+            points.append(old)
+    if points:
+        transaction.on_commit(lambda: invalidate_tiles(points))
+
+
+@receiver(post_delete, sender=Location)
+def invalidate_tiles_on_delete(sender, instance, **kwargs):
+    if instance.latitude is not None and instance.longitude is not None:
+        point = (instance.latitude, instance.longitude)
+        transaction.on_commit(lambda: invalidate_tiles([point]))
+
+
+@receiver(post_save, sender=Location)
+def record_tombstone_on_save(sender, instance, created, **kwargs):
+    """Tell filtered sync clients a location left their view (new filter values or coordinates removed)."""
+    if created or None in (instance.saved_value('latitude'), instance.saved_value('longitude')):
+        return
+    if instance.latitude is None or instance.longitude is None or any(
+        instance.has_changed(name) for name in FILTER_FIELDS
+    ):
+        LocationTombstone.objects.create(location_id=instance.pk, **{
+            name: instance.saved_value(name) or '' for name in FILTER_FIELDS
+        })
+
+
+@receiver(post_delete, sender=Location)
+def record_tombstone_on_delete(sender, instance, **kwargs):
+    if instance.latitude is not None and instance.longitude is not None:
+        LocationTombstone.objects.create(location_id=instance.pk, **{
+            name: getattr(instance, name) or '' for name in FILTER_FIELDS
+        })
+        transaction.on_commit(prune_tombstones)
+
+
+@receiver(post_save, sender=Location)
+def push_location_on_save(sender, instance, created, **kwargs):
+    """Send the change to open map pages (coalesced, see map.realtime)."""
+    LiveUpdates.record_on_commit('location', [instance.pk], 'created' if created else 'changed')
+
+
+@receiver(post_delete, sender=Location)
+def push_location_on_delete(sender, instance, **kwargs):
+    LiveUpdates.record_on_commit('location', [instance.pk], 'deleted')
+
+
+@receiver(post_save, sender=Event)
+def push_event_on_save(sender, instance, created, **kwargs):
+    LiveUpdates.record_on_commit('event', [instance.pk], 'created' if created else 'changed')
+
+
+@receiver(post_delete, sender=Event)
+def push_event_on_delete(sender, instance, **kwargs):
+    LiveUpdates.record_on_commit('event', [instance.pk], 'deleted')
+
+
+@receiver(m2m_changed, sender=Event.holders.through)
+def push_event_holders(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    LiveUpdates.record_on_commit('event', changed_event_ids(instance, action, reverse, pk_set))
+
+
+@receiver(post_save, sender=Location)
+def refresh_snapshots_on_save(sender, instance, created, **kwargs):
+    """Rebuild (debounced, in the background) the snapshots listing the location before or after the save."""
+    values = {tuple(getattr(instance, name) for name in FILTER_FIELDS)}
+    if not created:
+        values.add(tuple(instance.saved_value(name) for name in FILTER_FIELDS))
+    SnapshotBuilder.mark_stale_on_commit(values)
+
+
+@receiver(post_delete, sender=Location)
+def refresh_snapshots_on_delete(sender, instance, **kwargs):
+    SnapshotBuilder.mark_stale_on_commit({tuple(getattr(instance, name) for name in FILTER_FIELDS)})
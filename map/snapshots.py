@@ -0,0 +1,211 @@
+"""Pre-serialized map snapshots: the whole filtered location layer as gzipped JSON.
+
+A snapshot is built the first time a filter combination is requested and
+written to SNAPSHOT_DIR/<filter key>.json.gz:
+
+    {"generated_at": iso, "cursor": sync cursor, "count": n, "locations": [<row as in locations_api>]}
+
+next to a small <filter key>.meta.json holding the filters, count and extent.
+Files are written to a temporary name and swapped in with os.replace, so
+readers always get a complete snapshot, the previous one while a rebuild runs.
+
+map.signals report the filter values of changed locations here after commit;
+once no change has arrived for SNAPSHOT_DEBOUNCE seconds (or SNAPSHOT_MAX_DELAY
+after the first one) the snapshots matching them are rebuilt in a background
+thread. Clients can load a snapshot, then keep it current with map.sync from
+its cursor.
+"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import Location
+from .sync import next_cursor
+from .tiles import filter_key
+
+
+# Defaults (override with settings.SNAPSHOT_DEBOUNCE / SNAPSHOT_MAX_DELAY)
+DEFAULT_SNAPSHOT_DEBOUNCE = 5
+DEFAULT_SNAPSHOT_MAX_DELAY = 60
+
+SNAPSHOT_BATCH_SIZE = 2000
+
+# Filter values matching every snapshot (bulk changes)
+ANY = None
+
+
+def snapshot_dir() -> Path:
+    return Path(getattr(settings, 'SNAPSHOT_DIR', Path(settings.BASE_DIR) / 'snapshots'))
+
+
+def snapshot_path(key: str) -> Path:
+    return snapshot_dir() / f"{key}.json.gz"
+
+
+def meta_path(key: str) -> Path:
+    return snapshot_dir() / f"{key}.meta.json"
+
+
+def _write_atomic(path: Path, write):
+    """Call write(file) on a temporary file, then swap it in place of path."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            write(out)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def build_snapshot(country='', location_type='', category='') -> dict:
+    """Write the snapshot of one filter combination. Returns its metadata."""
+    # Imported here: views depends on this module
+    from .views import API_LOCATION_FIELDS, filter_locations, serialize_location
+
+    key = filter_key(country, location_type, category)
+    # Changes committed from now on are picked up by syncing from this cursor
+    cursor = next_cursor(None, None, 0, False)
+    rows = filter_locations(
+        Location.objects.filter(latitude__isnull=False, longitude__isnull=False),
+        country, location_type, category,
+    ).values(*API_LOCATION_FIELDS).order_by('id')
+    meta = {
+        'filters': {'country': country, 'type': location_type, 'category': category},
+        'generated_at': timezone.now().isoformat(),
+        'cursor': cursor,
+        'count': 0,
+        'extent': None,
+    }
+
+    def write(out):
+        south = west = float('inf')
+        north = east = float('-inf')
+        with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6, mtime=0) as data:
+            data.write(f'{{"generated_at": "{meta["generated_at"]}", "cursor": "{cursor}", "locations": ['.encode())
+            for row in rows.iterator(chunk_size=SNAPSHOT_BATCH_SIZE):
+                location = serialize_location(row)
+                data.write((', ' if meta['count'] else '').encode() + json.dumps(location).encode())
+                meta['count'] += 1
+                south, north = min(south, location['lat']), max(north, location['lat'])
+                west, east = min(west, location['lng']), max(east, location['lng'])
+            data.write(f'], "count": {meta["count"]}}}'.encode())
+        if meta['count']:
+            meta['extent'] = {'south': south, 'north': north, 'west': west, 'east': east}
+
+    _write_atomic(snapshot_path(key), write)
+    _write_atomic(meta_path(key), lambda out: out.write(json.dumps(meta).encode()))
+    return meta
+
+
+def load_snapshot(country='', location_type='', category='') -> Path:
+    """Path of the snapshot file of a filter combination, building it first if missing."""
+    key = filter_key(country, location_type, category)
+    path = snapshot_path(key)
+    if not (path.exists() and meta_path(key).exists()):
+        build_snapshot(country, location_type, category)
+    return path
+
+
+def has_snapshots() -> bool:
+    root = snapshot_dir()
+    return root.is_dir() and any(root.glob('*.meta.json'))
+
+
+def existing_snapshots() -> list:
+    """Metadata of every snapshot on disk."""
+    root = snapshot_dir()
+    if not root.is_dir():
+        return []
+    metas = []
+    for path in root.glob('*.meta.json'):
+        try:
+            metas.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return metas
+
+
+def matches(filters: dict, values) -> bool:
+    """Whether a location with (country, location_type, category) values is part of a snapshot."""
+    if values is ANY:
+        return True
+    country, location_type, category = values
+    return (
+        (not filters['country'] or filters['country'].lower() == (country or '').lower())
+        and (not filters['type'] or filters['type'] == location_type)
+        and (not filters['category'] or filters['category'] == (category or ''))
+    )
+
+
+class SnapshotBuilder:
+    """Debounced background rebuilds of the snapshots touched by Location changes."""
+
+    _lock = threading.Lock()
+    _pending = set()
+    _first_change = None
+    _timer = None
+
+    @classmethod
+    def mark_stale_on_commit(cls, values):
+        """mark_stale() once the current transaction commits."""
+        if has_snapshots():
+            transaction.on_commit(lambda: cls.mark_stale(values))
+
+    @classmethod
+    def mark_stale(cls, values):
+        """Schedule a rebuild of the snapshots containing any (country, type, category) (or ANY)."""
+        if not has_snapshots():
+            # Snapshots are built on first request, from current data
+            return
+        with cls._lock:
+            cls._pending.update(values)
+            now = time.monotonic()
+            if cls._first_change is None:
+                cls._first_change = now
+            if cls._timer is not None:
+                cls._timer.cancel()
+            debounce = getattr(settings, 'SNAPSHOT_DEBOUNCE', DEFAULT_SNAPSHOT_DEBOUNCE)
+            max_delay = getattr(settings, 'SNAPSHOT_MAX_DELAY', DEFAULT_SNAPSHOT_MAX_DELAY)
+            delay = max(0, min(debounce, cls._first_change + max_delay - now))
+            cls._timer = threading.Timer(delay, cls._rebuild_in_timer)
+            cls._timer.start()
+
+    @classmethod
+    def _rebuild_in_timer(cls):
+        try:
+            cls.rebuild_pending()
+        finally:
+            # Timer threads do not keep a database connection
+            connection.close()
+
+    @classmethod
+    def rebuild_pending(cls) -> int:
+        """Rebuild the snapshots affected by the changes recorded so far. Returns how many were rebuilt."""
+        with cls._lock:
+            pending = cls._pending
+            cls._pending, cls._first_change, cls._timer = set(), None, None
+        rebuilt = 0
+        for meta in existing_snapshots():
+            if any(matches(meta['filters'], values) for values in pending):
+                build_snapshot(meta['filters']['country'], meta['filters']['type'], meta['filters']['category'])
+                rebuilt += 1
+        return rebuilt
+
+    @staticmethod
+    def rebuild_all() -> int:
+        """Rebuild every snapshot on disk and the unfiltered one."""
+        filters = {('', '', '')} | {
+            (meta['filters']['country'], meta['filters']['type'], meta['filters']['category'])
+            for meta in existing_snapshots()
+        }
+        for country, location_type, category in filters:
+            build_snapshot(country, location_type, category)
+        return len(filters)
@@ -0,0 +1,176 @@
+"""Geohash spatial index helpers for Location lookups.
+
+Every Location stores the geohash of its coordinates. Nearby points share
+geohash prefixes, so a bounding box becomes a handful of string ranges that
+an ordinary B-tree index on the geohash column can answer directly.
+"""
+import bisect
+import math
+from typing import List, Tuple
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 12
+
+# Upper bound on grid cells a bounding box is split into (one index range each, before merging)
+MAX_COVER_CELLS = 32
+
+# Mean Earth radius in metres
+EARTH_RADIUS_M = 6371008.8
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """Encode a coordinate as a geohash string."""
+    lat_lo, lat_hi = -90.0, 90.0
+    lng_lo, lng_hi = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if longitude >= mid:
+                value = (value << 1) | 1
+                lng_lo = mid
+            else:
+                value <<= 1
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                value = (value << 1) | 1
+                lat_lo = mid
+            else:
+                value <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """Return (lat_degrees, lng_degrees) covered by one geohash cell of the given precision."""
+    total_bits = precision * 5
+    lng_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lng_bits)
+
+
+def _next_prefix(prefix: str) -> str:
+    """Return the smallest geohash string greater than every string starting with prefix."""
+    chars = list(prefix)
+    while chars:
+        index = BASE32.index(chars[-1])
+        if index < len(BASE32) - 1:
+            chars[-1] = BASE32[index + 1]
+            return ''.join(chars)
+        chars.pop()
+    # Past the last cell on the planet
+    return '{'
+
+
+def cover_prefixes(west: float, south: float, east: float, north: float, max_cells: int = MAX_COVER_CELLS) -> List[str]:
+    """Return geohash prefixes of the cells covering a bounding box (west <= east)."""
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        lat_step, lng_step = cell_size(precision)
+        lat_first = math.floor((south + 90.0) / lat_step)
+        lat_last = math.floor((min(north, 90.0 - 1e-9) + 90.0) / lat_step)
+        lng_first = math.floor((west + 180.0) / lng_step)
+        lng_last = math.floor((min(east, 180.0 - 1e-9) + 180.0) / lng_step)
+        if (lat_last - lat_first + 1) * (lng_last - lng_first + 1) <= max_cells or precision == 1:
+            break
+
+    prefixes = set()
+    for lat_index in range(lat_first, lat_last + 1):
+        for lng_index in range(lng_first, lng_last + 1):
+            prefixes.add(encode_geohash(
+                (lat_index + 0.5) * lat_step - 90.0,
+                (lng_index + 0.5) * lng_step - 180.0,
+                precision,
+            ))
+    return sorted(prefixes)
+
+
+def geohash_ranges(west: float, south: float, east: float, north: float) -> List[Tuple[str, str]]:
+    """Return merged [low, high) geohash ranges covering a bounding box (west <= east)."""
+    ranges = []
+    for prefix in cover_prefixes(west, south, east, north):
+        low, high = prefix, _next_prefix(prefix)
+        if ranges and ranges[-1][1] == low:
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((low, high))
+    return ranges
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two coordinates in metres."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def radius_bbox(latitude: float, longitude: float, meters: float) -> Tuple[float, float, float, float]:
+    """Return (west, south, east, north) enclosing a circle; west > east when it crosses the antimeridian."""
+    dlat = math.degrees(meters / EARTH_RADIUS_M)
+    south, north = latitude - dlat, latitude + dlat
+    if south <= -90.0 or north >= 90.0:
+        return -180.0, max(-90.0, south), 180.0, min(90.0, north)
+    dlng = math.degrees(meters / (EARTH_RADIUS_M * math.cos(math.radians(latitude))))
+    if dlng >= 180.0:
+        return -180.0, south, 180.0, north
+    west, east = longitude - dlng, longitude + dlng
+    if west < -180.0:
+        west += 360.0
+    if east > 180.0:
+        east -= 360.0
+    return west, south, east, north
+
+
+class GeohashIndex:
+    """In-memory sorted geohash index mirroring the DB column (used by benchmarks)."""
+
+    def __init__(self, points):
+        """Build from an iterable of (id, latitude, longitude)."""
+        entries = sorted((encode_geohash(lat, lng), pk, lat, lng) for pk, lat, lng in points)
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+
+    def in_bbox(self, west, south, east, north):
+        """Return (id, latitude, longitude) of points in a bounding box (west <= east)."""
+        found = []
+        for low, high in geohash_ranges(west, south, east, north):
+            start = bisect.bisect_left(self.keys, low)
+            stop = bisect.bisect_left(self.keys, high, start)
+            for _, pk, lat, lng in self.entries[start:stop]:
+                if south <= lat <= north and west <= lng <= east:
+                    found.append((pk, lat, lng))
+        return found
+
+    def within_radius(self, latitude, longitude, meters):
+        """Return (distance, id) of points within a radius, nearest first."""
+        west, south, east, north = radius_bbox(latitude, longitude, meters)
+        boxes = [(west, south, east, north)] if west <= east else [(west, south, 180.0, north), (-180.0, south, east, north)]
+        found = []
+        for box in boxes:
+            for pk, lat, lng in self.in_bbox(*box):
+                distance = haversine_m(latitude, longitude, lat, lng)
+                if distance <= meters:
+                    found.append((distance, pk))
+        return sorted(found)
+
+    def nearest(self, latitude, longitude, k, start_radius=500.0):
+        """Return (distance, id) of the k nearest points by expanding the search radius."""
+        radius = start_radius
+        while True:
+            found = self.within_radius(latitude, longitude, radius)
+            if len(found) >= k or radius >= math.pi * EARTH_RADIUS_M:
+                return found[:k]
+            radius *= 2
@@ -0,0 +1,89 @@
+"""Delta sync of map locations for returning clients.
+
+A client keeps the cursor of its last sync and sends it back; it receives
+the locations changed since then (keyset-paginated on (updated_at, id)) and
+the ids removed from its view since then (LocationTombstone, written by
+map.signals on delete or when a location leaves a filter). Clients apply
+`deleted` before `changes`. Transactions may commit after rows with a later
+updated_at were read, so a finished sync returns a cursor SYNC_LAG seconds in
+the past and the last moments are sent again; applying a change twice is
+harmless. Cursors older than SYNC_TOMBSTONE_DAYS get a full reset.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.conf import settings
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+from .models import LocationTombstone
+
+
+# Defaults (override with settings.SYNC_LAG / SYNC_TOMBSTONE_DAYS)
+DEFAULT_SYNC_LAG = 5
+DEFAULT_TOMBSTONE_DAYS = 30
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def tombstone_retention() -> timedelta:
+    return timedelta(days=getattr(settings, 'SYNC_TOMBSTONE_DAYS', DEFAULT_TOMBSTONE_DAYS))
+
+
+def encode_cursor(moment: datetime, last_id: int = 0) -> str:
+    """Opaque cursor: microseconds since the epoch and the last id at that instant."""
+    return f"{(moment - EPOCH) // timedelta(microseconds=1)}.{last_id}"
+
+
+def decode_cursor(value: str):
+    """(datetime, last id) of a cursor, or None if malformed."""
+    try:
+        micros, last_id = value.split('.')
+        return EPOCH + timedelta(microseconds=int(micros)), int(last_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def filter_tombstones(queryset, country='', location_type='', category=''):
+    """Apply the map filters to a LocationTombstone queryset (same semantics as filter_locations)."""
+    if country:
+        queryset = queryset.filter(country__iexact=country)
+    if location_type:
+        queryset = queryset.filter(location_type=location_type)
+    if category:
+        queryset = queryset.filter(category=category)
+    return queryset
+
+
+def changed_since(locations, since, last_id):
+    """Locations after the (updated_at, id) position, in cursor order."""
+    if since is not None:
+        locations = locations.filter(Q(updated_at__gt=since) | Q(updated_at=since, id__gt=last_id))
+    return locations.order_by('updated_at', 'id')
+
+
+def next_cursor(last_row, since, last_id, more: bool) -> str:
+    """Cursor to send back after a page of changes (see the module docstring for the lag)."""
+    if last_row is not None:
+        since, last_id = last_row['updated_at'], last_row['id']
+    if more:
+        return encode_cursor(since, last_id)
+    settled = timezone.now() - timedelta(seconds=getattr(settings, 'SYNC_LAG', DEFAULT_SYNC_LAG))
+    if since is None or since > settled:
+        return encode_cursor(settled)
+    return encode_cursor(since, last_id)
+
+
+async def avalidators(locations, tombstones=None):
+    """(ETag, last modified datetime or None) of a filtered view, from its newest change, size and newest removal."""
+    state = await locations.aaggregate(updated=Max('updated_at'), count=Count('id'))
+    moments = [state['updated']]
+    if tombstones is not None:
+        moments.append((await tombstones.aaggregate(deleted=Max('deleted_at')))['deleted'])
+    moments = [moment for moment in moments if moment is not None]
+    if not moments:
+        return f'"empty-{state["count"]}"', None
+    newest = max(moments)
+    return f'"{encode_cursor(newest)}-{state["count"]}"', newest
+
+
+def prune_tombstones():
+    """Forget removals older than the retention period."""
+    LocationTombstone.objects.filter(deleted_at__lt=timezone.now() - tombstone_retention()).delete()
@@ -1,65 +1,186 @@
-"""Background tasks for geocoding locations."""
-import time
-import threading
+"""Background tasks for geocoding locations.
+
+Work is stored as GeocodingJob rows and processed by a single dedicated
+worker (``manage.py geocode_worker``), so nothing is lost on restart and all
+processes share one Nominatim rate limit (see GeocodeRateLimiter). The worker
+runs jobs on an asyncio event loop with the async geocoding client, so slow
+upstream responses wait on sockets rather than on threads.
+"""
+import asyncio
+import os
+import socket
+from datetime import timedelta
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .models import Location
-from .utils import geocode_address
+from django.utils import timezone
+from .models import GeocodingJob, Location
+from .geocoders import get_default_geocoder
+from .utils import ageocode_address
+
+
+# Retries: attempt n waits RETRY_BASE_DELAY * 2**(n-1) seconds, capped at RETRY_MAX_DELAY
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 3600
+
+# Running jobs whose worker died are handed out again after this many seconds
+JOB_LEASE_SECONDS = 600
+
+# Location columns written by a finished job (geohash and updated_at follow the coordinates)
+LOCATION_RESULT_FIELDS = ['latitude', 'longitude', 'geohash', 'updated_at']
+
+# Location fields whose change re-queues a location without coordinates
+GEOCODE_TRIGGER_FIELDS = ('address', 'city', 'country', 'latitude', 'longitude')
+
+
+def default_worker_id():
+    """Identify a worker process in GeocodingJob.locked_by."""
+    return f"{socket.gethostname()}:{os.getpid()}"
 
 
 class GeocodingQueue:
-    """Simple in-memory queue for geocoding with rate limiting."""
-    _queue = []
-    _processing = False
-    
+    """Durable geocoding queue backed by GeocodingJob rows."""
+
     @classmethod
     def add_to_queue(cls, location_id: int):
-        """Add location to geocoding queue."""
-        if location_id not in cls._queue:
-            cls._queue.append(location_id)
-    
-    @classmethod
-    def process_queue(cls):
-        """Process all queued geocoding requests with rate limiting."""
-        if cls._processing:
+        """Add location to geocoding queue (no-op if it already has an active job)."""
+        if GeocodingJob.objects.filter(location_id=location_id, status__in=GeocodingJob.ACTIVE_STATUSES).exists():
             return
-        
-        cls._processing = True
-        processed = 0
-        failed = 0
-        
-        while cls._queue:
-            location_id = cls._queue.pop(0)
-            
-            try:
-                location = Location.objects.get(id=location_id)
-                
-                if location.latitude and location.longitude:
+        try:
+            with transaction.atomic():
+                GeocodingJob.objects.create(location_id=location_id, run_after=timezone.now())
+        except IntegrityError:
+            # Another process queued it concurrently
+            pass
+
+    @classmethod
+    async def arelease_stale(cls):
+        """Return jobs of crashed workers to the queue."""
+        cutoff = timezone.now() - timedelta(seconds=JOB_LEASE_SECONDS)
+        return await GeocodingJob.objects.filter(
+            status=GeocodingJob.STATUS_RUNNING, locked_at__lt=cutoff
+        ).aupdate(status=GeocodingJob.STATUS_PENDING, locked_by='', locked_at=None)
+
+    @classmethod
+    async def aclaim(cls, worker_id: str):
+        """Claim the next due job for this worker, or return None.
+
+        The conditional UPDATE only succeeds for one worker per row, so claiming
+        is safe across processes on every database backend.
+        """
+        now = timezone.now()
+        due = GeocodingJob.objects.filter(
+            status=GeocodingJob.STATUS_PENDING, run_after__lte=now
+        ).order_by('run_after', 'id').values_list('id', flat=True)[:10]
+        async for job_id in due:
+            claimed = await GeocodingJob.objects.filter(id=job_id, status=GeocodingJob.STATUS_PENDING).aupdate(
+                status=GeocodingJob.STATUS_RUNNING,
+                locked_by=worker_id,
+                locked_at=now,
+                updated_at=now,
+            )
+            if claimed:
+                return await GeocodingJob.objects.select_related('location').aget(id=job_id)
+        return None
+
+    @classmethod
+    async def arun_job(cls, job: GeocodingJob) -> bool:
+        """Geocode the job's location. Returns True if coordinates were found."""
+        location = job.location
+        job.attempts += 1
+
+        if location.latitude and location.longitude:
+            job.status = GeocodingJob.STATUS_DONE
+            await job.asave(update_fields=['status', 'attempts', 'updated_at'])
+            return True
+
+        try:
+            coords = await ageocode_address(location.address, location.city, location.country, raise_errors=True)
+        except Exception as e:
+            # Transient failure: retry with exponential backoff
+            job.last_error = str(e)[:1000]
+            if job.attempts >= MAX_ATTEMPTS:
+                job.status = GeocodingJob.STATUS_FAILED
+            else:
+                delay = min(RETRY_BASE_DELAY * 2 ** (job.attempts - 1), RETRY_MAX_DELAY)
+                job.status = GeocodingJob.STATUS_PENDING
+                job.run_after = timezone.now() + timedelta(seconds=delay)
+            job.locked_by = ''
+            job.locked_at = None
+            await job.asave()
+            print(f"❌ Error geocoding location {location.id} (attempt {job.attempts}): {e}")
+            return False
+
+        if coords:
+            location.latitude = coords[0]
+            location.longitude = coords[1]
+            # Only the coordinates: an admin edit made while the request was in flight is kept
+            await location.asave(update_fields=LOCATION_RESULT_FIELDS)
+            job.status = GeocodingJob.STATUS_DONE
+            print(f"✅ Geocoded: {location.name} → {coords}")
+        else:
+            # Nominatim answered but found nothing; retrying will not help
+            job.status = GeocodingJob.STATUS_FAILED
+            job.last_error = 'Address not found'
+            print(f"❌ Failed to geocode: {location.name}")
+        await job.asave()
+        return bool(coords)
+
+    @classmethod
+    async def aprocess_queue(cls, worker_id: str = None, limit: int = None, concurrency: int = 1):
+        """Process due jobs until the queue is drained (or `limit` jobs ran).
+
+        Up to `concurrency` jobs wait on the geocoder at once; all of them share
+        one event loop instead of holding a thread each.
+        """
+        worker_id = worker_id or default_worker_id()
+        result = {'processed': 0, 'failed': 0}
+        claimed = 0
+        running = set()
+
+        await cls.arelease_stale()
+        while True:
+            while len(running) < concurrency and (limit is None or claimed < limit):
+                job = await cls.aclaim(worker_id)
+                if job is None:
+                    break
+                claimed += 1
+                running.add(asyncio.ensure_future(cls.arun_job(job)))
+            if not running:
+                break
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    found = task.result()
+                except Location.DoesNotExist:
                     continue
-                
-                coords = geocode_address(location.address, location.city, location.country)
-                
-                if coords:
-                    location.latitude = coords[0]
-                    location.longitude = coords[1]
-                    location.save()
-                    processed += 1
-                    print(f"✅ Geocoded: {location.name} → {coords}")
-                else:
-                    failed += 1
-                    print(f"❌ Failed to geocode: {location.name}")
-                
-                if cls._queue:
-                    time.sleep(1)
-                    
-            except Location.DoesNotExist:
-                continue
-            except Exception as e:
-                failed += 1
-                print(f"❌ Error geocoding location {location_id}: {e}")
-        
-        cls._processing = False
-        return {'processed': processed, 'failed': failed}
+                result['processed' if found else 'failed'] += 1
+
+        return result
+
+    @classmethod
+    def process_queue(cls, worker_id: str = None, limit: int = None, concurrency: int = 1):
+        """Blocking aprocess_queue() for management commands and the admin."""
+        return async_to_sync(cls.aprocess_queue)(worker_id, limit, concurrency)
+
+    @classmethod
+    async def arun_worker(cls, worker_id: str = None, poll_interval: float = 5.0, concurrency: int = 1):
+        """Process jobs forever, sleeping when the queue is empty."""
+        worker_id = worker_id or default_worker_id()
+        try:
+            while True:
+                result = await cls.aprocess_queue(worker_id, concurrency=concurrency)
+                if not result['processed'] and not result['failed']:
+                    await asyncio.sleep(poll_interval)
+        finally:
+            await get_default_geocoder().aclose()
+
+    @classmethod
+    def run_worker(cls, worker_id: str = None, poll_interval: float = 5.0, concurrency: int = 1):
+        asyncio.run(cls.arun_worker(worker_id, poll_interval, concurrency))
 
 
 def geocode_location_async(location_id: int):
@@ -77,26 +198,25 @@ def auto_queue_geocoding(sender, instance, created, **kwargs):
     """Automatically queue new locations for geocoding if they don't have coordinates."""
     # Only geocode if address exists and BOTH coordinates are missing
     # Don't run if updating existing location with coordinates
-    if instance.address and not instance.latitude and not instance.longitude:
-        GeocodingQueue.add_to_queue(instance.id)
-        thread = threading.Thread(target=GeocodingQueue.process_queue)
-        thread.daemon = True
-        thread.start()
+    if not instance.address or instance.latitude or instance.longitude:
+        return
+    # On updates only an edited address or cleared coordinates warrant a new lookup (no extra SELECT)
+    if created or any(instance.has_changed(name) for name in GEOCODE_TRIGGER_FIELDS):
+        location_id = instance.id
+        transaction.on_commit(lambda: GeocodingQueue.add_to_queue(location_id))
 
 
 def geocode_selected_locations(modeladmin, request, queryset):
-    """Django admin action to geocode selected locations."""
+    """Django admin action to queue selected locations for geocoding (returns immediately)."""
     count = 0
-    for location in queryset:
-        if not location.latitude or not location.longitude:
-            GeocodingQueue.add_to_queue(location.id)
-            count += 1
-    
-    result = GeocodingQueue.process_queue()
+    for location_id in queryset.filter(Q(latitude__isnull=True) | Q(longitude__isnull=True)).values_list('id', flat=True):
+        GeocodingQueue.add_to_queue(location_id)
+        count += 1
     
     modeladmin.message_user(
         request,
-        f"Queued {count} locations. Processed: {result['processed']}, Failed: {result['failed']}"
+        f"Queued {count} locations for geocoding. They are processed by the geocode_worker "
+        f"command (or in bulk with 'manage.py geocode')."
     )
 
 geocode_selected_locations.short_description = "Geocode selected locations"
@@ -1,3 +1,1506 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import csv
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from unittest.mock import patch
+from PIL import Image
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from freecups.database import SQLITE_INIT_COMMAND, database_config
+from .analytics import EventCoverage
+from .caching import bump_generation, generation, versioned_key
+from .clustering import CLUSTER_MAX_ZOOM, rebuild_clusters
+from .facets import LocationFacets
+from .gazetteer import build_index
+from .heatmap import HEATMAP_DETAIL
+from .importer import LocationImporter
+from .geocache import DEFAULT_NEGATIVE_TTL, DEFAULT_TTL, GeocodeCache, reverse_query
+from .geocoders import BaseGeocoder, FallbackGeocoder, GazetteerGeocoder, StaticGeocoder
+from .images import ImagePipeline
+from .mirror import RemoteImageFetcher, RemoteImageMirror
+from .models import Event, GeocodeCacheEntry, GeocodingJob, HolderFeatures, Location, LocationCluster, RemoteImage
+from .normalization import DEFAULT_RULES_FILE, AddressNormalizer
+from .realtime import RELOAD, InProcessBroker, LiveUpdates, get_broker
+from .recommendations import HolderRecommender
+from .snapshots import SnapshotBuilder, snapshot_dir
+from .spatial import GeohashIndex, encode_geohash, haversine_m
+from .sync import encode_cursor
+from .tasks import JOB_LEASE_SECONDS, MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, GeocodingQueue
+from .tiles import TILE_MIN_ZOOM, invalidate_tiles, render_tile, tile_cache_dir, tile_for
+from .views import VARIANT_CACHE_CONTROL
+from .utils import GeocodeRateLimiter, ageocode_address, geocode_address
 
-# Create your tests here.
+
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'map-tests'}}
+
+
+class MapTestCase(TestCase):
+    """Runs against a private cache and temporary media, tile and snapshot directories."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.media_root = f"{directory}/media"
+        storage = override_settings(
+            MEDIA_ROOT=self.media_root,
+            TILE_CACHE_DIR=Path(directory) / 'tiles',
+            SNAPSHOT_DIR=Path(directory) / 'snapshots',
+            CACHES=TEST_CACHES,
+        )
+        storage.enable()
+        self.addCleanup(storage.disable)
+        cache.clear()
+
+
+def png_bytes(color, size=(400, 400)):
+    output = BytesIO()
+    Image.new('RGB', size, color).save(output, format='PNG')
+    return output.getvalue()
+
+
+class ImageServer(ThreadingHTTPServer):
+    """Local stand-in for a third-party image host."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ImageHandler)
+        self.files = {}
+        self.requests = []
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[self.path]
+        etag = f'"{len(body)}-{hash(body)}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RemoteImageMirrorTests(MapTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = ImageServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def mirror(self, **fetcher_options):
+        return RemoteImageMirror(workers=2, processes=1, fetcher=RemoteImageFetcher(**fetcher_options))
+
+    def test_external_url_is_downloaded_once_and_served_locally(self):
+        self.server.files['/logo.png'] = png_bytes('red')
+        url = self.server.url('/logo.png')
+        first = Location.objects.create(name='A', company_logo_url=url)
+        second = Location.objects.create(name='B', company_logo_url=url)
+        self.assertEqual(first.get_company_logo_url(), url)
+
+        stats = self.mirror().run()
+
+        self.assertEqual(stats['downloaded'], 1)
+        self.assertEqual(len(self.server.requests), 1)
+        for location in (first, second):
+            location.refresh_from_db()
+            self.assertTrue(location.get_company_logo_url().startswith('/media/company_logos/'))
+            self.assertIn('company_logo', location.image_variants)
+
+    def test_refresh_revalidates_with_etag(self):
+        self.server.files['/logo.png'] = png_bytes('red')
+        Location.objects.create(name='A', company_logo_url=self.server.url('/logo.png'))
+        self.mirror().run()
+
+        RemoteImage.objects.update(check_after=timezone.now())
+        stats = self.mirror().run()
+
+        self.assertEqual(stats['not_modified'], 1)
+        self.assertIsNotNone(self.server.requests[-1][1])
+
+    def test_changed_remote_image_replaces_the_mirror(self):
+        self.server.files['/logo.png'] = png_bytes('red')
+        location = Location.objects.create(name='A', company_logo_url=self.server.url('/logo.png'))
+        self.mirror().run()
+        location.refresh_from_db()
+        old_hash = location.company_logo_hash
+
+        self.server.files['/logo.png'] = png_bytes('blue')
+        RemoteImage.objects.update(check_after=timezone.now())
+        self.mirror().run()
+
+        location.refresh_from_db()
+        self.assertNotEqual(location.company_logo_hash, old_hash)
+
+    def test_mirrored_images_reach_snapshots_and_open_pages(self):
+        self.server.files['/logo.png'] = png_bytes('red')
+        location = Location.objects.create(name='A', country='Israel', company_logo_url=self.server.url('/logo.png'))
+        with patch.object(SnapshotBuilder, 'mark_stale_on_commit') as mark_stale, \
+                patch.object(LiveUpdates, 'record_on_commit') as record:
+            self.mirror().run()
+        mark_stale.assert_called_once_with({('Israel', Location.TYPE_HOLDER, '')})
+        record.assert_called_once_with('location', [location.id])
+
+    def test_oversized_image_is_rejected(self):
+        self.server.files['/big.png'] = png_bytes('red', size=(1000, 1000))
+        url = self.server.url('/big.png')
+        location = Location.objects.create(name='A', company_logo_url=url)
+
+        stats = self.mirror(max_bytes=1024).run()
+
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(RemoteImage.objects.get(url=url).status, RemoteImage.STATUS_FAILED)
+        location.refresh_from_db()
+        self.assertEqual(location.get_company_logo_url(), url)
+
+
+class ImagePipelineTests(MapTestCase):
+    """Background optimization of uploads in the process pool."""
+
+    def test_uploads_are_optimized_once_per_content(self):
+        first = Location.objects.create(name='A', company_logo=SimpleUploadedFile('a.png', png_bytes('red')))
+        second = Location.objects.create(name='B', company_logo=SimpleUploadedFile('b.png', png_bytes('red')))
+        self.assertEqual(first.company_logo_hash, '')
+
+        stats = ImagePipeline(workers=1).run()
+
+        self.assertEqual((stats['optimized'], stats['failed']), (1, 0))
+        for location in (first, second):
+            location.refresh_from_db()
+            self.assertEqual(location.company_logo.name, f"company_logos/{location.company_logo_hash}.jpg")
+            self.assertEqual(location.image_variants['company_logo']['hash'], location.company_logo_hash)
+        with Image.open(first.company_logo.path) as image:
+            self.assertLessEqual(max(image.size), 100)
+        # The originals are gone once nothing points at them
+        self.assertFalse(default_storage.exists('company_logos/a.png'))
+
+    def test_optimized_images_reach_snapshots_and_open_pages(self):
+        location = Location.objects.create(name='A', country='Israel', company_logo=SimpleUploadedFile('a.png', png_bytes('red')))
+        with patch.object(SnapshotBuilder, 'mark_stale_on_commit') as mark_stale, \
+                patch.object(LiveUpdates, 'record_on_commit') as record:
+            ImagePipeline(workers=1).run()
+        mark_stale.assert_called_once_with({('Israel', Location.TYPE_HOLDER, '')})
+        record.assert_called_once_with('location', [location.id])
+
+    def test_unreadable_images_are_not_retried_forever(self):
+        location = Location.objects.create(name='A', company_logo=SimpleUploadedFile('a.png', b'not an image'))
+        self.assertEqual(ImagePipeline(workers=1).run()['failed'], 1)
+        location.refresh_from_db()
+        self.assertEqual(location.company_logo.name, 'company_logos/a.png')
+        self.assertEqual(ImagePipeline(workers=1).run(), {'optimized': 0, 'reused': 0, 'failed': 0})
+
+    def test_reprocessing_all_images_keeps_mirrored_urls(self):
+        uploaded = Location.objects.create(name='A', company_logo=SimpleUploadedFile('a.png', png_bytes('red')))
+        ImagePipeline(workers=1).run()
+        mirrored = Location.objects.create(name='B', company_logo_url='https://example.com/logo.png')
+        Location.objects.filter(id=mirrored.id).update(company_logo_hash='f' * 64)
+
+        output = StringIO()
+        call_command('process_images', all=True, workers=1, stdout=output)
+
+        self.assertIn('Marked 1 uploaded images', output.getvalue())
+        self.assertIn('reused: 1', output.getvalue())
+        mirrored.refresh_from_db()
+        self.assertEqual(mirrored.company_logo_hash, 'f' * 64)
+        uploaded.refresh_from_db()
+        self.assertTrue(uploaded.company_logo_hash)
+
+
+class ImageVariantTests(MapTestCase):
+    """Responsive variants, their srcset and the immutable variant endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(
+            name='A',
+            company_logo=SimpleUploadedFile('a.png', png_bytes('red')),
+            product_photo=SimpleUploadedFile('b.png', png_bytes('blue')),
+        )
+        ImagePipeline(workers=1).run()
+        self.location.refresh_from_db()
+
+    def test_variants_never_upscale(self):
+        logo = self.location.image_variants['company_logo']
+        photo = self.location.image_variants['product_photo']
+        self.assertEqual(logo['widths'], [32, 64, 100, 200])
+        # The 400px source has no 600px variant
+        self.assertEqual(photo['widths'], [150, 300])
+        self.assertIn('webp', logo['formats'])
+        self.assertIn('jpeg', logo['formats'])
+
+    def test_variant_urls_and_srcset(self):
+        url = self.location.get_company_logo_variant_url(60)
+        self.assertEqual(url, f"/map/media/variants/company_logos/{self.location.company_logo_hash}/64.webp")
+        self.assertTrue(self.location.get_product_photo_variant_url(1000).endswith('/300.webp'))
+        srcset = self.location.get_company_logo_srcset('jpeg')
+        self.assertEqual(srcset.count(', '), 3)
+        self.assertTrue(srcset.endswith('/200.jpeg 200w'))
+
+        # Variants of a replaced image are not shown
+        self.location.company_logo_hash = 'x' * 64
+        self.assertEqual(self.location.get_company_logo_srcset(), '')
+        self.assertEqual(self.location.get_company_logo_variant_url(), self.location.get_company_logo_url())
+
+    def test_variant_endpoint(self):
+        path = self.location.get_company_logo_variant_url(64)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'], VARIANT_CACHE_CONTROL)
+        self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.client.get('/map/media/company_logos/a.png').status_code, 404)
+        self.assertEqual(self.client.get('/map/media/variants/../a.webp').status_code, 404)
+
+    def test_markers_use_the_icon_variant(self):
+        self.location.latitude, self.location.longitude = 32.08, 34.78
+        self.location.save()
+        marker = self.client.get('/map/api/locations', {'bbox': '34,31,36,34'}).json()['locations'][0]
+        self.assertTrue(marker['logo_icon'].endswith('/64.webp'))
+        self.assertIn('200w', marker['logo_srcset'])
+
+
+class LocationSaveQueryTests(MapTestCase):
+    """Pin the queries issued by Location.save (dirty tracking replaces the old per-save SELECTs)."""
+
+    def test_update_without_changes_is_a_single_query(self):
+        Location.objects.create(name='A', address='Dizengoff 1', city='Tel Aviv', latitude=32.08, longitude=34.78)
+        location = Location.objects.get(name='A')
+
+        with self.assertNumQueries(1):
+            location.save()
+
+    def test_updating_a_loaded_location_does_not_reselect_it(self):
+        Location.objects.create(name='A', latitude=32.08, longitude=34.78,
+                                company_logo=SimpleUploadedFile('logo.png', png_bytes('red')))
+        location = Location.objects.get(name='A')
+
+        location.name = 'B'
+        with self.assertNumQueries(1):
+            location.save()
+
+        location.refresh_from_db()
+        self.assertEqual(location.name, 'B')
+
+    def test_replacing_a_logo_only_checks_whether_the_old_file_is_shared(self):
+        location = Location.objects.create(name='A', company_logo=SimpleUploadedFile('a.png', png_bytes('red')))
+        location.company_logo_hash = 'x' * 64
+        location.save()
+
+        location.company_logo = SimpleUploadedFile('b.png', png_bytes('blue'))
+        with self.assertNumQueries(2):
+            location.save()
+
+        self.assertEqual(location.company_logo_hash, '')
+
+    def test_refreshed_locations_are_not_dirty(self):
+        location = Location.objects.create(name='A', company_logo=SimpleUploadedFile('a.png', png_bytes('red')))
+        Location.objects.filter(id=location.id).update(company_logo='company_logos/b.jpg', company_logo_hash='x' * 64)
+        location.refresh_from_db()
+        self.assertFalse(location.has_changed('company_logo'))
+
+        location.save()
+        location.refresh_from_db(fields=['company_logo_hash'])
+        self.assertEqual(location.company_logo_hash, 'x' * 64)
+
+    def test_geocoding_is_queued_only_when_the_address_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            location = Location.objects.create(name='A', address='Dizengoff 1', city='Tel Aviv')
+        self.assertEqual(GeocodingJob.objects.filter(location=location).count(), 1)
+        GeocodingJob.objects.update(status=GeocodingJob.STATUS_FAILED)
+
+        location.name = 'B'
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True) as callbacks:
+            location.save()
+        self.assertEqual(callbacks, [])
+
+        location.address = 'Dizengoff 2'
+        with self.captureOnCommitCallbacks(execute=True):
+            location.save()
+        self.assertEqual(GeocodingJob.objects.filter(location=location).count(), 2)
+
+
+class LocationsApiTests(MapTestCase):
+    """Viewport marker endpoint."""
+
+    def setUp(self):
+        super().setUp()
+        self.tel_aviv = Location.objects.create(name='TA', country='Israel', latitude=32.08, longitude=34.78)
+        self.haifa = Location.objects.create(
+            name='Haifa', country='Israel', location_type=Location.TYPE_BUSINESS, category=Location.CATEGORY_STUDENTS,
+            latitude=32.79, longitude=34.99,
+        )
+        Location.objects.create(name='No coordinates', country='Israel', address='Nowhere 1')
+
+    def ids(self, **params):
+        response = self.client.get('/map/api/locations', params)
+        self.assertEqual(response.status_code, 200)
+        return [location['id'] for location in response.json()['locations']]
+
+    def test_bbox_is_required(self):
+        self.assertEqual(self.client.get('/map/api/locations').status_code, 400)
+        self.assertEqual(self.client.get('/map/api/locations', {'bbox': '34,33,35,32'}).status_code, 400)
+
+    def test_only_locations_in_the_viewport_are_returned(self):
+        self.assertEqual(self.ids(bbox='34.5,31.5,35.5,33.5'), [self.tel_aviv.id, self.haifa.id])
+        self.assertEqual(self.ids(bbox='34.5,32.5,35.5,33.5'), [self.haifa.id])
+        self.assertEqual(self.ids(bbox='0,0,1,1'), [])
+
+    def test_filters_and_payload(self):
+        self.assertEqual(self.ids(bbox='34,31,36,34', type=Location.TYPE_BUSINESS), [self.haifa.id])
+        self.assertEqual(self.ids(bbox='34,31,36,34', category=Location.CATEGORY_STUDENTS), [self.haifa.id])
+        self.assertEqual(self.ids(bbox='34,31,36,34', country='france'), [])
+
+        location = self.client.get('/map/api/locations', {'bbox': '34,32.5,36,34'}).json()['locations'][0]
+        self.assertEqual((location['lat'], location['lng'], location['type']), (32.79, 34.99, Location.TYPE_BUSINESS))
+
+    @patch('map.views.MAX_API_LOCATIONS', 1)
+    def test_large_viewports_are_truncated(self):
+        data = self.client.get('/map/api/locations', {'bbox': '34,31,36,34'}).json()
+        self.assertEqual(len(data['locations']), 1)
+        self.assertTrue(data['truncated'])
+
+    async def test_async_requests(self):
+        response = await self.async_client.get('/map/api/locations', {'bbox': '34.5,32.5,35.5,33.5'})
+        self.assertEqual([location['id'] for location in response.json()['locations']], [self.haifa.id])
+        response = await self.async_client.get('/map/api/clusters/0/0/0')
+        self.assertEqual(sum(cluster['count'] for cluster in response.json()['clusters']), 2)
+
+
+def cluster_rows():
+    return sorted(
+        (row['zoom'], row['cell_x'], row['cell_y'], row['country'], row['location_type'], row['category'],
+         row['count'], round(row['latitude_sum'], 6), round(row['longitude_sum'], 6))
+        for row in LocationCluster.objects.values()
+    )
+
+
+class ClusterTests(MapTestCase):
+    """Incremental cluster maintenance matches a full rebuild."""
+
+    def assertClustersMatchRebuild(self):
+        incremental = cluster_rows()
+        rebuild_clusters()
+        self.assertEqual(incremental, cluster_rows())
+
+    def test_saves_and_deletes_update_clusters_incrementally(self):
+        first = Location.objects.create(name='A', country='Israel', latitude=32.08, longitude=34.78)
+        second = Location.objects.create(name='B', country='Israel', latitude=32.081, longitude=34.781)
+        Location.objects.create(name='No coordinates', address='Nowhere 1')
+        self.assertEqual(LocationCluster.objects.filter(zoom=0).get().count, 2)
+        self.assertClustersMatchRebuild()
+
+        # Moved, refiltered, stripped of coordinates and deleted
+        first.latitude, first.longitude = 31.77, 35.21
+        first.save()
+        self.assertClustersMatchRebuild()
+        second.location_type = Location.TYPE_BUSINESS
+        second.category = Location.CATEGORY_SHOPPERS
+        second.save()
+        self.assertClustersMatchRebuild()
+        second.latitude = second.longitude = None
+        second.save()
+        self.assertClustersMatchRebuild()
+        first.delete()
+        self.assertEqual(cluster_rows(), [])
+
+    def test_clusters_api(self):
+        Location.objects.create(name='A', country='Israel', latitude=32.08, longitude=34.78)
+        Location.objects.create(
+            name='B', country='Israel', location_type=Location.TYPE_BUSINESS, category=Location.CATEGORY_MEDICAL,
+            latitude=32.09, longitude=34.79,
+        )
+        clusters = self.client.get('/map/api/clusters/0/0/0').json()['clusters']
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(clusters[0]['count'], 2)
+        self.assertEqual(clusters[0]['types'], {Location.TYPE_HOLDER: 1, Location.TYPE_BUSINESS: 1})
+        self.assertEqual(clusters[0]['categories'], {Location.CATEGORY_MEDICAL: 1})
+        self.assertAlmostEqual(clusters[0]['lat'], 32.085)
+
+        filtered = self.client.get('/map/api/clusters/0/0/0', {'type': Location.TYPE_BUSINESS}).json()['clusters']
+        self.assertEqual(filtered[0]['count'], 1)
+        x, y = tile_for(32.08, 34.78, CLUSTER_MAX_ZOOM)
+        # Separate cells at the deepest zoom
+        deepest = self.client.get(f'/map/api/clusters/{CLUSTER_MAX_ZOOM}/{x}/{y}').json()['clusters']
+        self.assertEqual(sorted(cluster['count'] for cluster in deepest), [1, 1])
+        self.assertEqual(self.client.get(f'/map/api/clusters/{CLUSTER_MAX_ZOOM + 1}/0/0').status_code, 404)
+
+
+class SpatialQueryTests(MapTestCase):
+    """Geohash-indexed lookups agree with a brute-force scan."""
+
+    def setUp(self):
+        super().setUp()
+        rng = random.Random(3)
+        points = [(rng.uniform(31, 33.5), rng.uniform(34, 36)) for _ in range(150)]
+        # Both sides of the antimeridian
+        points += [(-17.7, 179.9), (-17.8, -179.95), (-17.75, 178.5), (-17.7, -178.0)]
+        locations = [Location(name=str(i), latitude=round(lat, 6), longitude=round(lng, 6)) for i, (lat, lng) in enumerate(points)]
+        for location in locations:
+            location.geohash = location.compute_geohash()
+        Location.objects.bulk_create(locations)
+        self.points = {pk: (float(lat), float(lng)) for pk, lat, lng in Location.objects.values_list('id', 'latitude', 'longitude')}
+
+    def test_geohash_encoding(self):
+        self.assertEqual(encode_geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        self.assertEqual(Location.objects.create(name='A', latitude=57.64911, longitude=10.40744).geohash[:11], 'u4pruydqqvj')
+
+    def test_in_bbox(self):
+        for west, south, east, north in ((34.5, 31.5, 35.2, 32.3), (34, 31, 36, 34), (35.9, 33.4, 36, 33.5)):
+            expected = {pk for pk, (lat, lng) in self.points.items() if south <= lat <= north and west <= lng <= east}
+            found = set(Location.objects.in_bbox(west, south, east, north).values_list('id', flat=True))
+            self.assertEqual(found, expected)
+
+    def test_in_bbox_across_the_antimeridian(self):
+        found = set(Location.objects.in_bbox(179.0, -18, -179.0, -17).values_list('id', flat=True))
+        expected = {pk for pk, (lat, lng) in self.points.items() if lat < 0 and abs(lng) >= 179.0}
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(found, expected)
+
+    def test_within_radius_and_nearest(self):
+        origin = (32.0, 34.8)
+        distances = sorted((haversine_m(*origin, *point), pk) for pk, point in self.points.items())
+        within = {pk for distance, pk in distances if distance <= 20_000}
+        found = Location.objects.within_radius(*origin, 20_000)
+        self.assertEqual({location.id for location in found}, within)
+        for location in found:
+            self.assertAlmostEqual(location.distance, haversine_m(*origin, *self.points[location.id]), delta=1)
+
+        nearest = [location.id for location in Location.objects.nearest(*origin, k=5)]
+        self.assertEqual(nearest, [pk for _, pk in distances[:5]])
+
+        # Nearest neighbours across the antimeridian
+        nearest = [location.id for location in Location.objects.nearest(-17.75, 179.99, k=2)]
+        self.assertEqual(set(nearest), {pk for pk, (lat, lng) in self.points.items() if lat < 0 and abs(lng) > 179.8})
+
+    def test_in_memory_index_matches_the_database(self):
+        index = GeohashIndex((pk, lat, lng) for pk, (lat, lng) in self.points.items())
+        self.assertEqual(
+            {pk for pk, _, _ in index.in_bbox(34.5, 31.5, 35.2, 32.3)},
+            set(Location.objects.in_bbox(34.5, 31.5, 35.2, 32.3).values_list('id', flat=True)),
+        )
+        self.assertEqual(
+            [pk for _, pk in index.nearest(32.0, 34.8, 5)],
+            [location.id for location in Location.objects.nearest(32.0, 34.8, k=5)],
+        )
+
+
+class CountingGeocoder(StaticGeocoder):
+    def __init__(self, data):
+        super().__init__(data=data)
+        self.calls = []
+
+    def geocode(self, address, city=None, country=None):
+        self.calls.append((address, city, country))
+        return super().geocode(address, city, country)
+
+
+class SlowGeocoder(StaticGeocoder):
+    """Answers after a delay on the event loop and records how many lookups overlapped."""
+
+    def __init__(self, data):
+        super().__init__(data=data)
+        self.in_flight = self.peak = 0
+
+    async def ageocode(self, address, city=None, country=None):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.05)
+        self.in_flight -= 1
+        return self.geocode(address, city, country)
+
+
+class GeocodeCacheTests(MapTestCase):
+    """Persistent geocoding answers with TTLs and negative entries."""
+
+    def setUp(self):
+        super().setUp()
+        self.geocoder = CountingGeocoder({'Dizengoff 1, Tel Aviv, Israel': [32.08, 34.77]})
+        backend = patch('map.utils.get_default_geocoder', return_value=self.geocoder)
+        backend.start()
+        self.addCleanup(backend.stop)
+
+    def test_answers_are_cached_on_the_normalized_address(self):
+        self.assertEqual(geocode_address('Dizengoff 1', 'Tel Aviv', 'Israel'), (32.08, 34.77))
+        self.assertEqual(geocode_address('  Dizengoff   1 ', 'tel-aviv', 'israel'), (32.08, 34.77))
+        self.assertEqual(len(self.geocoder.calls), 1)
+
+        entry = GeocodeCacheEntry.objects.get()
+        self.assertEqual(entry.query, 'dizengoff 1, tel aviv, israel')
+        self.assertAlmostEqual((entry.expires_at - timezone.now()).total_seconds(), DEFAULT_TTL, delta=60)
+
+    def test_not_found_is_cached_for_the_negative_ttl(self):
+        self.assertIsNone(geocode_address('Nowhere 1', 'Tel Aviv', 'Israel'))
+        self.assertIsNone(geocode_address('Nowhere 1', 'Tel Aviv', 'Israel'))
+        self.assertEqual(len(self.geocoder.calls), 1)
+        entry = GeocodeCacheEntry.objects.get()
+        self.assertFalse(entry.found)
+        self.assertAlmostEqual((entry.expires_at - timezone.now()).total_seconds(), DEFAULT_NEGATIVE_TTL, delta=60)
+
+        # Expired entries are looked up again and purged
+        GeocodeCacheEntry.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(geocode_address('Nowhere 1', 'Tel Aviv', 'Israel'))
+        self.assertEqual(len(self.geocoder.calls), 2)
+        GeocodeCacheEntry.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(GeocodeCache.purge_expired(), 1)
+
+    @override_settings(GEOCODE_CACHE_TTL=10)
+    def test_ttl_setting_and_cache_bypass(self):
+        geocode_address('Dizengoff 1', 'Tel Aviv', 'Israel')
+        entry = GeocodeCacheEntry.objects.get()
+        self.assertAlmostEqual((entry.expires_at - timezone.now()).total_seconds(), 10, delta=5)
+        geocode_address('Dizengoff 1', 'Tel Aviv', 'Israel', use_cache=False)
+        self.assertEqual(len(self.geocoder.calls), 2)
+
+    def test_errors_are_not_cached(self):
+        with patch('map.utils.get_default_geocoder', return_value=FailingGeocoder()):
+            self.assertIsNone(geocode_address('Dizengoff 1', 'Tel Aviv', 'Israel'))
+            with self.assertRaises(ConnectionError):
+                geocode_address('Dizengoff 1', 'Tel Aviv', 'Israel', raise_errors=True)
+        self.assertFalse(GeocodeCacheEntry.objects.exists())
+
+    async def test_async_lookups_share_the_cache(self):
+        self.assertEqual(await ageocode_address('Dizengoff 1', 'Tel Aviv', 'Israel'), (32.08, 34.77))
+        self.assertEqual(await ageocode_address('Dizengoff 1', 'Tel Aviv', 'Israel'), (32.08, 34.77))
+        self.assertEqual(len(self.geocoder.calls), 1)
+
+    def test_reverse_answers(self):
+        GeocodeCache.set_reverse(reverse_query(32.08, 34.77), {'city': 'Tel Aviv'})
+        self.assertEqual(GeocodeCache.get_reverse(reverse_query('32.080000', '34.770000')), {'city': 'Tel Aviv'})
+        GeocodeCache.set_reverse(reverse_query(0, 0), None)
+        self.assertIsNone(GeocodeCache.get_reverse(reverse_query(0, 0)))
+        self.assertIs(GeocodeCache.get_reverse(reverse_query(1, 1)), GeocodeCache.MISS)
+
+
+class GeocodingJobTests(MapTestCase):
+    """Durable job queue: claiming, retries with backoff and the worker's write-back."""
+
+    def setUp(self):
+        super().setUp()
+        self.geocoder = CountingGeocoder({'Dizengoff 1, Tel Aviv, Israel': [32.08, 34.77]})
+        backend = patch('map.utils.get_default_geocoder', return_value=self.geocoder)
+        backend.start()
+        self.addCleanup(backend.stop)
+        self.location = Location.objects.create(name='A', address='Dizengoff 1', city='Tel Aviv', country='Israel')
+        GeocodingQueue.add_to_queue(self.location.id)
+
+    def test_a_job_is_claimed_by_one_worker(self):
+        GeocodingQueue.add_to_queue(self.location.id)
+        self.assertEqual(GeocodingJob.objects.count(), 1)
+        job = async_to_sync(GeocodingQueue.aclaim)('worker-1')
+        self.assertEqual((job.status, job.locked_by), (GeocodingJob.STATUS_RUNNING, 'worker-1'))
+        self.assertIsNone(async_to_sync(GeocodingQueue.aclaim)('worker-2'))
+
+        # A dead worker's lease runs out
+        GeocodingJob.objects.update(locked_at=timezone.now() - timedelta(seconds=JOB_LEASE_SECONDS + 1))
+        self.assertEqual(async_to_sync(GeocodingQueue.arelease_stale)(), 1)
+        self.assertEqual(async_to_sync(GeocodingQueue.aclaim)('worker-2').locked_by, 'worker-2')
+
+    def test_processing_writes_coordinates(self):
+        self.assertEqual(GeocodingQueue.process_queue('worker-1'), {'processed': 1, 'failed': 0})
+        self.location.refresh_from_db()
+        self.assertEqual((float(self.location.latitude), float(self.location.longitude)), (32.08, 34.77))
+        self.assertEqual(self.location.geohash, encode_geohash(32.08, 34.77))
+        self.assertEqual(GeocodingJob.objects.get().status, GeocodingJob.STATUS_DONE)
+
+    def test_edits_made_during_the_request_are_kept(self):
+        job = async_to_sync(GeocodingQueue.aclaim)('worker-1')
+        edited = Location.objects.get(id=self.location.id)
+        edited.name = 'Edited'
+        edited.category = Location.CATEGORY_SHOPPERS
+        edited.save()
+
+        self.assertTrue(async_to_sync(GeocodingQueue.arun_job)(job))
+        edited.refresh_from_db()
+        self.assertEqual((edited.name, edited.category), ('Edited', Location.CATEGORY_SHOPPERS))
+        self.assertEqual(float(edited.latitude), 32.08)
+
+    def test_jobs_wait_on_the_geocoder_concurrently(self):
+        geocoder = SlowGeocoder({f'Dizengoff {number}, Tel Aviv, Israel': [32.08, 34.77] for number in range(1, 5)})
+        for number in range(2, 5):
+            location = Location.objects.create(name='B', address=f'Dizengoff {number}', city='Tel Aviv', country='Israel')
+            GeocodingQueue.add_to_queue(location.id)
+        with patch('map.utils.get_default_geocoder', return_value=geocoder):
+            self.assertEqual(GeocodingQueue.process_queue('worker-1', concurrency=4), {'processed': 4, 'failed': 0})
+        self.assertEqual(geocoder.peak, 4)
+
+    def test_transport_errors_are_retried_with_backoff(self):
+        with patch('map.utils.get_default_geocoder', return_value=FailingGeocoder()):
+            for attempt in range(1, MAX_ATTEMPTS + 1):
+                GeocodingJob.objects.update(run_after=timezone.now())
+                self.assertEqual(GeocodingQueue.process_queue('worker-1'), {'processed': 0, 'failed': 1})
+                job = GeocodingJob.objects.get()
+                self.assertEqual(job.attempts, attempt)
+                if attempt < MAX_ATTEMPTS:
+                    self.assertEqual(job.status, GeocodingJob.STATUS_PENDING)
+                    delay = (job.run_after - timezone.now()).total_seconds()
+                    self.assertAlmostEqual(delay, min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY), delta=5)
+                    # Not due yet
+                    self.assertEqual(GeocodingQueue.process_queue('worker-1'), {'processed': 0, 'failed': 0})
+        self.assertEqual(job.status, GeocodingJob.STATUS_FAILED)
+        self.assertEqual(job.last_error, 'service unavailable')
+
+    def test_addresses_not_found_fail_without_retry(self):
+        Location.objects.filter(id=self.location.id).update(address='Nowhere 1')
+        self.assertEqual(GeocodingQueue.process_queue('worker-1'), {'processed': 0, 'failed': 1})
+        job = GeocodingJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (GeocodingJob.STATUS_FAILED, 1))
+
+
+class GeocodeCommandTests(MapTestCase):
+    """Batch geocoding command and the shared rate limiter."""
+
+    def setUp(self):
+        super().setUp()
+        path = Path(self.media_root).parent / 'geocoder.json'
+        path.write_text(json.dumps({'Dizengoff 1, Tel Aviv, Israel': [32.08, 34.77]}))
+        static = override_settings(GEOCODER_STATIC_FILE=str(path))
+        static.enable()
+        self.addCleanup(static.disable)
+
+    def test_pending_locations_are_geocoded_once_per_address(self):
+        first = Location.objects.create(name='A', address='Dizengoff 1', city='Tel Aviv', country='Israel')
+        second = Location.objects.create(name='B', address='dizengoff  1', city='tel-aviv', country='israel')
+        missing = Location.objects.create(name='C', address='Nowhere 1', city='Tel Aviv', country='Israel')
+        GeocodingQueue.add_to_queue(first.id)
+
+        output = StringIO()
+        call_command('geocode', backend='map.geocoders.StaticGeocoder', rate=1000, stdout=output)
+
+        self.assertIn('unique addresses: 2, geocoded: 2, not found: 1', output.getvalue())
+        self.assertIn('requests: 2', output.getvalue())
+        for location in (first, second):
+            location.refresh_from_db()
+            self.assertEqual((float(location.latitude), float(location.longitude)), (32.08, 34.77))
+            self.assertEqual(location.geohash, encode_geohash(32.08, 34.77))
+        missing.refresh_from_db()
+        self.assertIsNone(missing.latitude)
+        self.assertEqual(GeocodingJob.objects.get().status, GeocodingJob.STATUS_DONE)
+        self.assertEqual(LocationCluster.objects.get(zoom=0).count, 2)
+
+    def test_geocoded_businesses_count_for_nearby_holders(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            holder = Location.objects.create(name='Hall', latitude=32.081, longitude=34.77)
+            Location.objects.create(name='Mall', location_type=Location.TYPE_BUSINESS, category=Location.CATEGORY_SHOPPERS,
+                                    address='Dizengoff 1', city='Tel Aviv', country='Israel')
+        self.assertEqual(HolderFeatures.objects.get(holder=holder).businesses, 0)
+
+        call_command('geocode', backend='map.geocoders.StaticGeocoder', rate=1000, stdout=StringIO())
+        self.assertEqual(HolderFeatures.objects.get(holder=holder).category_counts, {Location.CATEGORY_SHOPPERS: 1})
+
+    def test_rate_override_does_not_leak(self):
+        Location.objects.create(name='A', address='Dizengoff 1', city='Tel Aviv', country='Israel')
+        call_command('geocode', backend='map.geocoders.StaticGeocoder', rate=1000, stdout=StringIO())
+        self.assertEqual(GeocodeRateLimiter.min_interval, 1.0)
+
+    def test_rate_limiter_spaces_out_requests(self):
+        limiter = GeocodeRateLimiter.with_rate(10)
+        self.assertEqual((limiter.name, limiter.min_interval, GeocodeRateLimiter.min_interval), ('nominatim', 0.1, 1.0))
+        started = time.monotonic()
+        for _ in range(3):
+            limiter.wait_if_needed()
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        async_to_sync(limiter.await_slot)()
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+
+
+class FacetTests(MapTestCase):
+    """Cached filter facets with location counts."""
+
+    def setUp(self):
+        super().setUp()
+        Location.objects.create(name='A', country='Israel', location_type=Location.TYPE_BUSINESS,
+                                category=Location.CATEGORY_SHOPPERS, latitude=32.08, longitude=34.78)
+        Location.objects.create(name='B', country='Israel', location_type=Location.TYPE_HOLDER,
+                                latitude=32.09, longitude=34.79)
+        # Listed without coordinates, but not counted
+        Location.objects.create(name='C', country='France', location_type=Location.TYPE_HOLDER)
+
+    def test_counts_only_mapped_locations(self):
+        facets = LocationFacets.compute()
+        self.assertEqual(facets['countries'], [('France', 0), ('Israel', 2)])
+        self.assertEqual(facets['types'], {Location.TYPE_BUSINESS: 1, Location.TYPE_HOLDER: 1})
+        self.assertEqual([(key, count) for key, label, count in facets['categories']], [(Location.CATEGORY_SHOPPERS, 1)])
+
+    def test_facets_are_cached_until_a_faceted_field_changes(self):
+        LocationFacets.get()
+        with self.assertNumQueries(0):
+            LocationFacets.get()
+
+        location = Location.objects.get(name='C')
+        location.name = 'D'
+        location.save()
+        with self.assertNumQueries(0):
+            LocationFacets.get()
+
+        location.latitude, location.longitude = 48.85, 2.35
+        location.save()
+        self.assertIn(('France', 1), LocationFacets.get()['countries'])
+
+    def test_facets_follow_deletes(self):
+        LocationFacets.get()
+        Location.objects.get(name='A').delete()
+        facets = LocationFacets.get()
+        self.assertEqual(facets['categories'], [])
+        self.assertEqual(facets['countries'], [('France', 0), ('Israel', 1)])
+
+
+class MapCacheTests(MapTestCase):
+    """Versioned cache keys and the cached map page."""
+
+    def test_bumping_the_generation_changes_every_key(self):
+        key = versioned_key('page', 'Israel', '', '')
+        self.assertEqual(versioned_key('page', 'Israel', '', ''), key)
+        self.assertNotEqual(versioned_key('page', 'France', '', ''), key)
+        before = generation()
+        bump_generation()
+        self.assertNotEqual(generation(), before)
+        self.assertNotEqual(versioned_key('page', 'Israel', '', ''), key)
+
+    def test_generation_survives_eviction(self):
+        before = generation()
+        cache.clear()
+        # Restarted from the clock, never an old generation
+        self.assertGreater(generation(), before)
+
+    def test_map_page_is_cached_until_a_shown_field_changes(self):
+        location = Location.objects.create(name='A', country='Israel', latitude=32.08, longitude=34.78)
+        self.assertContains(self.client.get('/map/'), 'Israel')
+        with self.assertNumQueries(0):
+            self.client.get('/map/')
+
+        location.name = 'B'
+        location.save()
+        with self.assertNumQueries(0):
+            self.client.get('/map/')
+
+        location.country = 'France'
+        location.save()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/map/')
+        self.assertTrue(queries.captured_queries)
+
+
+class DatabaseConfigTests(SimpleTestCase):
+    """DATABASES built from DATABASE_URL and the DB_* variables."""
+
+    def config(self, **environ):
+        with patch.dict('os.environ', environ, clear=True):
+            return database_config(Path('/srv/freecups'))
+
+    def test_sqlite_by_default_with_wal_tuning(self):
+        config = self.config()
+        self.assertEqual((config['ENGINE'], config['NAME']), ('django.db.backends.sqlite3', Path('/srv/freecups/db.sqlite3')))
+        self.assertEqual(config['OPTIONS']['init_command'], SQLITE_INIT_COMMAND)
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertNotIn('OPTIONS', self.config(DB_SQLITE_TUNING='False'))
+        self.assertEqual(self.config(DATABASE_URL='sqlite:////tmp/map.db')['NAME'], '/tmp/map.db')
+
+    def test_postgres_url(self):
+        config = self.config(DATABASE_URL='postgresql://cups:p%40ss@db:6432/freecups?sslmode=require')
+        self.assertEqual(config['ENGINE'], 'django.db.backends.postgresql')
+        self.assertEqual((config['NAME'], config['USER'], config['PASSWORD'], config['HOST'], config['PORT']),
+                         ('freecups', 'cups', 'p@ss', 'db', '6432'))
+        self.assertEqual(config['OPTIONS'], {'sslmode': 'require'})
+        self.assertEqual((config['CONN_MAX_AGE'], config['CONN_HEALTH_CHECKS']), (60, True))
+
+    def test_pool_replaces_persistent_connections(self):
+        config = self.config(DATABASE_URL='postgres://cups@db/freecups', DB_POOL='True', DB_PGBOUNCER='True')
+        self.assertEqual(config['CONN_MAX_AGE'], 0)
+        self.assertEqual(config['OPTIONS']['pool'], {'min_size': 2, 'max_size': 10, 'timeout': 10})
+        self.assertTrue(config['DISABLE_SERVER_SIDE_CURSORS'])
+
+    def test_unsupported_scheme(self):
+        with self.assertRaises(ValueError):
+            self.config(DATABASE_URL='mysql://cups@db/freecups')
+
+
+IMPORT_CSV = """name,type,category,address,city,country,lat,lng,logo_url
+Cafe,business,shoppers,,,Israel,32.08,34.78,https://example.com/logo.png
+Hall,holder,,Dizengoff 1,Tel Aviv,Israel,,,
+Shop,shop,,,,Israel,,,
+Far,holder,,,,Israel,95,34.78,
+Port,holder,,,,Israel,32.82,35.00,https://example.com/logo.png
+"""
+
+
+class ImporterTests(MapTestCase):
+    """Bulk import and the follow-up work bulk_create skips."""
+
+    def test_csv_import(self):
+        result = LocationImporter(batch_size=2).run(StringIO(IMPORT_CSV), 'csv')
+        self.assertEqual((result.rows, result.created), (5, 3))
+        self.assertEqual([line for line, message in result.errors], [4, 5])
+        self.assertIn('location_type: Value', result.errors[0][1])
+
+        cafe = Location.objects.get(name='Cafe')
+        self.assertEqual((cafe.location_type, cafe.category), (Location.TYPE_BUSINESS, Location.CATEGORY_SHOPPERS))
+        self.assertEqual(cafe.geohash, encode_geohash(32.08, 34.78))
+        counted = cluster_rows()
+        rebuild_clusters()
+        self.assertEqual(counted, cluster_rows())
+        self.assertEqual(list(GeocodingJob.objects.values_list('location__name', flat=True)), ['Hall'])
+        self.assertEqual(list(RemoteImage.objects.values_list('url', flat=True)), ['https://example.com/logo.png'])
+        self.assertEqual((result.geocoding_queued, result.images_registered), (1, 1))
+
+    def test_jsonl_import_and_dry_run(self):
+        lines = '{"name": "A", "lat": 32.08, "lng": 34.78}\nnot json\n[1]\n\n{"name": "B"}\n'
+        result = LocationImporter(dry_run=True).run(StringIO(lines), 'jsonl')
+        self.assertEqual((result.rows, result.created), (4, 2))
+        self.assertEqual([line for line, message in result.errors], [2, 3])
+        self.assertFalse(Location.objects.exists())
+
+        self.assertEqual(LocationImporter().run(StringIO(lines), 'jsonl').created, 2)
+        self.assertEqual(sorted(Location.objects.values_list('name', flat=True)), ['A', 'B'])
+
+    def test_committed_batches_are_finished_when_reading_fails(self):
+        rows = IMPORT_CSV.splitlines()[:3] + [f'Huge,holder,,,,Israel,,,{"x" * 200000}']
+        importer = LocationImporter(batch_size=2)
+        with self.assertRaises(csv.Error):
+            importer.run(StringIO('\n'.join(rows)), 'csv')
+        self.assertEqual(importer.result.created, 2)
+        self.assertEqual(LocationCluster.objects.filter(zoom=0).get().count, 1)
+        self.assertEqual(GeocodingJob.objects.count(), 1)
+        self.assertEqual(RemoteImage.objects.count(), 1)
+
+    def test_command(self):
+        path = Path(self.media_root).parent / 'locations.csv'
+        path.write_text(IMPORT_CSV)
+        out = StringIO()
+        call_command('import_locations', str(path), stdout=out)
+        self.assertIn('Imported 3 of 5 rows', out.getvalue())
+        self.assertIn('line 4: location_type', out.getvalue())
+
+    def test_admin_upload(self):
+        admin = get_user_model().objects.create_superuser(email='admin@example.com', password='secret')
+        self.client.force_login(admin)
+        upload = SimpleUploadedFile('locations.csv', IMPORT_CSV.encode())
+        response = self.client.post('/admin/map/location/import/', {'file': upload})
+        self.assertContains(response, 'Invalid rows (2)')
+        self.assertEqual(Location.objects.count(), 3)
+
+    def test_admin_upload_of_an_unreadable_file(self):
+        admin = get_user_model().objects.create_superuser(email='admin@example.com', password='secret')
+        self.client.force_login(admin)
+        upload = SimpleUploadedFile('locations.csv', 'name\nCaf\u00e9\n'.encode('latin-1'))
+        response = self.client.post('/admin/map/location/import/', {'file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Cannot read the file')
+        self.assertFalse(Location.objects.exists())
+
+
+class ExportTests(MapTestCase):
+    """Streaming exports of locations and events."""
+
+    def setUp(self):
+        super().setUp()
+        self.buyer = Location.objects.create(name='Buyer', location_type=Location.TYPE_BUYER, country='Israel')
+        self.holder = Location.objects.create(name='Hall, "Main"', city='Tel Aviv', country='Israel', latitude=32.08, longitude=34.78)
+        self.paris = Location.objects.create(name='Paris', country='France', latitude=48.85, longitude=2.35)
+        self.event = Event.objects.create(name='Launch', buyer=self.buyer)
+        self.event.holders.add(self.holder, self.paris)
+        Event.objects.create(name='Empty', buyer=self.buyer)
+        self.staff = get_user_model().objects.create_user(email='staff@example.com', password='secret', is_staff=True)
+
+    def export(self, path, **params):
+        self.client.force_login(self.staff)
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_locations_csv(self):
+        rows = list(csv.DictReader(StringIO(self.export('/map/api/export/locations.csv'))))
+        self.assertEqual([row['name'] for row in rows], ['Buyer', 'Hall, "Main"', 'Paris'])
+        self.assertEqual((rows[1]['latitude'], rows[0]['latitude']), ('32.08', ''))
+
+    def test_filtered_locations_jsonl(self):
+        rows = [json.loads(line) for line in self.export('/map/api/export/locations.jsonl', country='france').splitlines()]
+        self.assertEqual([(row['id'], row['latitude']) for row in rows], [(self.paris.id, 48.85)])
+
+    def test_events_have_one_row_per_holder(self):
+        features = json.loads(self.export('/map/api/export/events.geojson'))['features']
+        self.assertEqual(
+            [(feature['properties']['event_name'], feature['properties']['holder_name']) for feature in features],
+            [('Launch', 'Hall, "Main"'), ('Launch', 'Paris'), ('Empty', None)],
+        )
+        self.assertEqual(features[0]['geometry'], {'type': 'Point', 'coordinates': [34.78, 32.08]})
+        self.assertIsNone(features[2]['geometry'])
+
+    @patch('map.export.ROWS_PER_PIECE', 1)
+    def test_small_chunks_give_the_same_output(self):
+        whole = self.export('/map/api/export/events.csv')
+        out = StringIO()
+        call_command('export_data', 'events', '--chunk-size', '1', stdout=out)
+        self.assertEqual(out.getvalue(), whole)
+
+    def test_staff_only(self):
+        self.assertEqual(self.client.get('/map/api/export/locations.csv').status_code, 302)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/map/api/export/locations.xml').status_code, 404)
+
+
+class EventCoverageTests(MapTestCase):
+    """Business catchments of event holders."""
+
+    def setUp(self):
+        super().setUp()
+        business = {'location_type': Location.TYPE_BUSINESS, 'longitude': 34.78}
+        Location.objects.create(name='Office', category=Location.CATEGORY_OFFICE_WORKERS, latitude=32.081, **business)
+        Location.objects.create(name='Mall', category=Location.CATEGORY_SHOPPERS, latitude=32.0835, **business)
+        Location.objects.create(name='Far', category=Location.CATEGORY_SHOPPERS, latitude=32.2, **business)
+        self.buyer = Location.objects.create(name='Buyer', location_type=Location.TYPE_BUYER, latitude=32.08, longitude=34.79)
+        self.holder = Location.objects.create(name='Hall', latitude=32.08, longitude=34.78)
+        self.unlocated = Location.objects.create(name='Unlocated')
+        self.event = Event.objects.create(name='Launch', buyer=self.buyer)
+        self.event.holders.add(self.holder, self.unlocated)
+
+    def test_summary(self):
+        summary = EventCoverage.compute(self.event, radius=500)
+        self.assertEqual(summary['businesses'], 2)
+        self.assertEqual(summary['categories'], {Location.CATEGORY_OFFICE_WORKERS: 1, Location.CATEGORY_SHOPPERS: 1})
+        self.assertEqual(summary['unlocated_holders'], [self.unlocated.id])
+        self.assertEqual((summary['distance_buckets']['100-250m'], summary['distance_buckets']['250-500m']), (1, 1))
+        self.assertAlmostEqual(summary['holders'][0]['buyer_distance'], haversine_m(32.08, 34.79, 32.08, 34.78), delta=0.1)
+
+    def test_only_new_holders_are_queried(self):
+        # Created first: a Location save starts a new cache generation
+        other = Location.objects.create(name='Other', latitude=32.0835, longitude=34.781)
+        EventCoverage.get(self.event, radius=500)
+        with patch.object(EventCoverage, 'compute_catchment', wraps=EventCoverage.compute_catchment) as compute:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.event.holders.add(other)
+            EventCoverage.get(self.event, radius=500)
+        self.assertEqual(compute.call_count, 1)
+
+    def test_clearing_a_holders_events_refreshes_their_coverage(self):
+        with patch.object(EventCoverage, 'get') as get, self.captureOnCommitCallbacks(execute=True):
+            self.holder.events_received.clear()
+        self.assertEqual([call.args[0].id for call in get.call_args_list], [self.event.id])
+
+
+class RecommendationTests(MapTestCase):
+    """Holder features and ranking for a buyer."""
+
+    def setUp(self):
+        super().setUp()
+        self.buyer = Location.objects.create(name='Buyer', location_type=Location.TYPE_BUYER, latitude=32.08, longitude=34.78)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.near = Location.objects.create(name='Near', latitude=32.081, longitude=34.78)
+            self.busy = Location.objects.create(name='Busy', latitude=32.1, longitude=34.8)
+            for number in range(3):
+                Location.objects.create(name=f'Shop {number}', location_type=Location.TYPE_BUSINESS,
+                                        category=Location.CATEGORY_SHOPPERS, latitude=32.1, longitude=34.8 + number / 1000)
+
+    def test_features_follow_business_changes(self):
+        self.assertEqual(HolderFeatures.objects.get(holder=self.busy).category_counts, {Location.CATEGORY_SHOPPERS: 3})
+        self.assertEqual(HolderFeatures.objects.get(holder=self.near).businesses, 0)
+        shop = Location.objects.get(name='Shop 0')
+        shop.latitude, shop.longitude = 32.081, 34.781
+        with self.captureOnCommitCallbacks(execute=True):
+            shop.save()
+        self.assertEqual(HolderFeatures.objects.get(holder=self.busy).businesses, 2)
+        self.assertEqual(HolderFeatures.objects.get(holder=self.near).businesses, 1)
+
+    def test_density_outranks_distance(self):
+        ranked = HolderRecommender.recommend(self.buyer, recent_days=0)
+        self.assertEqual([holder['id'] for holder in ranked], [self.busy.id, self.near.id])
+        ranked = HolderRecommender.recommend(self.buyer, recent_days=0, categories=[Location.CATEGORY_STUDENTS])
+        self.assertEqual(ranked[0]['id'], self.near.id)
+
+    def test_recently_used_holders_are_skipped(self):
+        Event.objects.create(name='Launch', buyer=self.buyer).holders.add(self.busy)
+        self.assertEqual([holder['id'] for holder in HolderRecommender.recommend(self.buyer)], [self.near.id])
+
+    def test_imported_businesses_count_for_nearby_holders(self):
+        rows = 'name,type,category,lat,lng\nOffice,business,office_workers,32.081,34.781\nNew,holder,,32.1,34.8\n'
+        LocationImporter().run(StringIO(rows), 'csv')
+        self.assertEqual(HolderFeatures.objects.get(holder=self.near).category_counts, {Location.CATEGORY_OFFICE_WORKERS: 1})
+        new = Location.objects.get(name='New')
+        self.assertEqual(HolderFeatures.objects.get(holder=new).businesses, 3)
+
+    @patch('map.recommendations.REFRESH_REBUILD_THRESHOLD', 1)
+    def test_large_bulk_writes_rebuild(self):
+        with patch.object(HolderRecommender, 'rebuild') as rebuild:
+            HolderRecommender.refresh_bulk([self.near.id], [(32.1, 34.8)])
+        rebuild.assert_called_once_with()
+
+    def test_api(self):
+        staff = get_user_model().objects.create_user(email='staff@example.com', password='secret', is_staff=True)
+        self.client.force_login(staff)
+        data = self.client.get('/map/api/recommendations', {'buyer': self.buyer.id, 'limit': 1, 'recent_days': 0}).json()
+        self.assertEqual([holder['id'] for holder in data['holders']], [self.busy.id])
+        self.assertEqual(self.client.get('/map/api/recommendations', {'buyer': self.near.id}).status_code, 400)
+        for params in ({'radius': -100}, {'radius': 0}, {'radius': 'nan'}, {'radius': 'inf'}, {'limit': -5}, {'limit': 'x'}):
+            response = self.client.get('/map/api/recommendations', {'buyer': self.buyer.id, **params})
+            self.assertEqual(response.status_code, 400, params)
+            self.assertNotIn('NaN', response.json()['error'])
+
+    def test_radius_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            HolderRecommender.recommend(self.buyer, radius=-100)
+
+
+def decode_tile(data):
+    """(ids, types) of a binary point tile."""
+    assert data[:4] == b'FCT1'
+    count = int.from_bytes(data[4:8], 'little')
+    ids = [int.from_bytes(data[8 + 4 * index:12 + 4 * index], 'little') for index in range(count)]
+    types = list(data[8 + 8 * count:8 + 9 * count])
+    return ids, types
+
+
+class PointTileTests(MapTestCase):
+    """Binary point tiles cached on disk."""
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='A', country='Israel', latitude=32.08, longitude=34.78)
+        self.business = Location.objects.create(name='B', country='Israel', location_type=Location.TYPE_BUSINESS,
+                                                latitude=32.0801, longitude=34.7801)
+        self.zoom = TILE_MIN_ZOOM
+        self.x, self.y = tile_for(32.08, 34.78, self.zoom)
+        self.url = f'/map/tiles/{self.zoom}/{self.x}/{self.y}.bin'
+
+    def tile(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return decode_tile(b''.join(response.streaming_content))
+
+    def test_tiles_hold_the_filtered_locations(self):
+        self.assertEqual(self.tile(), ([self.location.id, self.business.id], [1, 2]))
+        self.assertEqual(self.tile(type=Location.TYPE_BUSINESS)[0], [self.business.id])
+        self.assertEqual(self.tile(country='ISRAEL')[0], [self.location.id, self.business.id])
+        self.assertEqual(self.client.get(f'/map/tiles/{self.zoom - 1}/0/0.bin').status_code, 404)
+
+    def test_tiles_are_served_from_disk_until_a_location_moves(self):
+        response = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.location.latitude = 40.0
+            self.location.save()
+        self.assertEqual(self.tile()[0], [self.business.id])
+
+    def test_unknown_filters_are_rejected(self):
+        for params in ({'country': 'Atlantis'}, {'type': 'shop'}, {'category': 'pirates'}):
+            self.assertEqual(self.client.get(self.url, params).status_code, 400)
+        self.assertFalse(tile_cache_dir().exists())
+
+    def test_tiles_invalidated_while_rendering_are_rendered_again(self):
+        stale = Location.objects.filter(id=self.location.id)
+
+        def render_during_a_change(zoom, x, y, queryset):
+            # The rows were read, then a change committed and invalidated the tile
+            data = render_tile(zoom, x, y, stale if render.call_count == 1 else queryset)
+            if render.call_count == 1:
+                invalidate_tiles([(32.08, 34.78)])
+            return data
+
+        with patch('map.tiles.render_tile', side_effect=render_during_a_change) as render:
+            self.assertEqual(self.tile()[0], [self.location.id, self.business.id])
+        self.assertEqual(render.call_count, 2)
+
+    def test_tiles_that_keep_being_invalidated_are_not_kept(self):
+        def render_during_a_change(zoom, x, y, queryset):
+            invalidate_tiles([(32.08, 34.78)])
+            return render_tile(zoom, x, y, queryset)
+
+        with patch('map.tiles.render_tile', side_effect=render_during_a_change):
+            response = self.client.get(self.url)
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+
+
+def decode_heatmap(data):
+    """(grid, scale, counts) of a binary heatmap tile."""
+    assert data[:4] == b'FCH1'
+    grid, scale = int.from_bytes(data[4:8], 'little'), int.from_bytes(data[8:12], 'little')
+    counts = [int.from_bytes(data[12 + 4 * index:16 + 4 * index], 'little') for index in range(grid * grid)]
+    return grid, scale, counts
+
+
+class HeatmapTests(MapTestCase):
+    """Business density tiles read from the cluster grid."""
+
+    def setUp(self):
+        super().setUp()
+        business = {'location_type': Location.TYPE_BUSINESS, 'country': 'Israel'}
+        Location.objects.create(name='A', category=Location.CATEGORY_SHOPPERS, latitude=32.08, longitude=34.78, **business)
+        Location.objects.create(name='B', category=Location.CATEGORY_SHOPPERS, latitude=32.08, longitude=34.78, **business)
+        Location.objects.create(name='C', category=Location.CATEGORY_MEDICAL, latitude=31.77, longitude=35.21, **business)
+        Location.objects.create(name='Holder', latitude=32.08, longitude=34.78)
+
+    def heatmap(self, url='/map/heatmap/0/0/0.bin', **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return decode_heatmap(response.content)
+
+    def test_counts_businesses_per_cell(self):
+        grid, scale, counts = self.heatmap()
+        self.assertEqual(grid, 4 << HEATMAP_DETAIL)
+        self.assertEqual(sum(counts), 3)
+        self.assertEqual(scale, max(counts))
+        self.assertEqual(sum(self.heatmap(category=Location.CATEGORY_MEDICAL)[2]), 1)
+        self.assertEqual(sum(self.heatmap(country='israel', category=Location.CATEGORY_SHOPPERS)[2]), 2)
+
+    def test_unknown_filters_are_rejected(self):
+        for params in ({'country': 'Atlantis'}, {'category': 'unknown'}):
+            self.assertEqual(self.client.get('/map/heatmap/0/0/0.bin', params).status_code, 400)
+
+    def test_deepest_tiles_share_the_layer_scale(self):
+        x, y = tile_for(31.77, 35.21, CLUSTER_MAX_ZOOM)
+        grid, scale, counts = self.heatmap(f'/map/heatmap/{CLUSTER_MAX_ZOOM}/{x}/{y}.bin')
+        self.assertEqual(grid, 4)
+        self.assertEqual((sum(counts), scale), (1, 2))
+        self.assertEqual(self.client.get(f'/map/heatmap/{CLUSTER_MAX_ZOOM + 1}/0/0.bin').status_code, 404)
+
+    def test_tiles_are_cached_until_a_business_changes(self):
+        response = self.client.get('/map/heatmap/0/0/0.bin')
+        with self.assertNumQueries(0):
+            cached = self.client.get('/map/heatmap/0/0/0.bin', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        Location.objects.filter(name='C').get().delete()
+        self.assertEqual(sum(self.heatmap()[2]), 2)
+
+
+@override_settings(SYNC_LAG=0)
+class SyncTests(MapTestCase):
+    """Delta sync with cursors, tombstones and conditional GET."""
+
+    def setUp(self):
+        super().setUp()
+        self.shop = Location.objects.create(name='Shop', country='Israel', location_type=Location.TYPE_BUSINESS,
+                                            category=Location.CATEGORY_SHOPPERS, latitude=32.08, longitude=34.78)
+        self.hall = Location.objects.create(name='Hall', country='Israel', latitude=32.09, longitude=34.79)
+
+    def sync(self, **params):
+        response = self.client.get('/map/api/sync', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cursor_pages_through_changes(self):
+        first = self.sync(limit=1)
+        self.assertEqual(([change['id'] for change in first['changes']], first['more']), ([self.shop.id], True))
+        second = self.sync(limit=1, since=first['cursor'])
+        self.assertEqual(([change['id'] for change in second['changes']], second['more']), ([self.hall.id], False))
+        self.assertEqual(self.sync(since=second['cursor'])['changes'], [])
+
+        self.hall.name = 'Big hall'
+        self.hall.save()
+        self.assertEqual([change['name'] for change in self.sync(since=second['cursor'])['changes']], ['Big hall'])
+
+    def test_filter_edits_keep_visible_locations(self):
+        cursor = self.sync()['cursor']
+        filtered = self.sync(category=Location.CATEGORY_SHOPPERS)['cursor']
+        self.hall.name = 'Big hall'
+        self.hall.save()
+        self.shop.category = Location.CATEGORY_STUDENTS
+        self.shop.save()
+
+        # Still on an unfiltered map: a change (on the next page), not a removal
+        data = self.sync(since=cursor, limit=1)
+        self.assertEqual((data['deleted'], [change['id'] for change in data['changes']]), ([], [self.hall.id]))
+        data = self.sync(since=data['cursor'])
+        self.assertEqual((data['deleted'], [change['id'] for change in data['changes']]), ([], [self.shop.id]))
+        data = self.sync(since=filtered, category=Location.CATEGORY_SHOPPERS)
+        self.assertEqual((data['deleted'], data['changes']), ([self.shop.id], []))
+
+    def test_deleted_and_unlocated_locations_are_removed(self):
+        cursor = self.sync()['cursor']
+        removed = sorted([self.shop.id, self.hall.id])
+        self.hall.delete()
+        self.shop.latitude = self.shop.longitude = None
+        self.shop.save()
+        self.assertEqual(sorted(self.sync(since=cursor)['deleted']), removed)
+
+    def test_bad_and_expired_cursors(self):
+        self.assertEqual(self.client.get('/map/api/sync', {'since': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.client.get('/map/api/sync', {'limit': 0}).status_code, 400)
+        data = self.sync(since=encode_cursor(timezone.now() - timedelta(days=365)))
+        self.assertTrue(data['reset'])
+        self.assertEqual(len(data['changes']), 2)
+
+    def test_unchanged_views_answer_304(self):
+        for url, params in (('/map/api/sync', {}), ('/map/api/locations', {'bbox': '34,31,36,34'})):
+            etag = self.client.get(url, params)['ETag']
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            Location.objects.create(name='New', latitude=32.1, longitude=34.8)
+            self.assertEqual(self.client.get(url, params, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class RecordingBroker:
+    listening = True
+
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, message):
+        self.messages.append(message)
+
+
+class LiveUpdateTests(MapTestCase):
+    """Batched change messages for open map pages."""
+
+    def setUp(self):
+        super().setUp()
+        self.broker = RecordingBroker()
+        for patcher in (patch('map.realtime.get_broker', return_value=self.broker),
+                        patch.object(LiveUpdates, '_schedule')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(LiveUpdates.flush)
+
+    def test_changes_are_coalesced_into_one_patch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            location = Location.objects.create(name='A', latitude=32.08, longitude=34.78)
+        with self.captureOnCommitCallbacks(execute=True):
+            location.name = 'B'
+            location.save()
+            gone = Location.objects.create(name='C', latitude=32.1, longitude=34.8)
+            gone.latitude = gone.longitude = None
+            gone.save()
+        LiveUpdates.flush()
+
+        [patch_message] = self.broker.messages
+        self.assertEqual([row['name'] for row in patch_message['locations']['changed']], ['B'])
+        # Without coordinates it is no longer on the map
+        self.assertEqual(patch_message['locations']['deleted'], [gone.id])
+
+    def test_event_holder_changes(self):
+        buyer = Location.objects.create(name='Buyer', location_type=Location.TYPE_BUYER)
+        holder = Location.objects.create(name='Hall', latitude=32.08, longitude=34.78)
+        event = Event.objects.create(name='Launch', buyer=buyer)
+        event.holders.add(holder)
+        LiveUpdates.flush()
+        self.broker.messages.clear()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            holder.events_received.clear()
+        LiveUpdates.flush()
+        [patch_message] = self.broker.messages
+        self.assertEqual(patch_message['events']['changed'][0]['id'], event.id)
+        self.assertEqual(patch_message['events']['changed'][0]['holders'], [])
+
+    @patch('map.realtime.MAX_PATCH_LOCATIONS', 1)
+    def test_large_batches_reload(self):
+        LiveUpdates.record('location', [1, 2])
+        LiveUpdates.flush()
+        self.assertEqual(self.broker.messages, [RELOAD])
+
+    def test_nothing_is_recorded_without_listeners(self):
+        self.broker.listening = False
+        with self.captureOnCommitCallbacks() as callbacks:
+            LiveUpdates.record_on_commit('location', [1])
+        self.assertEqual(callbacks, [])
+
+
+class LiveStreamTests(TestCase):
+    """Server-Sent Events stream fed by the in-process broker."""
+
+    async def test_batches_reach_open_streams(self):
+        stream = LiveUpdates.stream()
+        self.assertTrue((await stream.__anext__()).startswith('retry:'))
+        get_broker().publish({'type': 'patch', 'locations': {'changed': [], 'deleted': [1]}})
+        message = await stream.__anext__()
+        self.assertTrue(message.startswith('event: patch\ndata: '))
+        self.assertEqual(json.loads(message.split('data: ', 1)[1])['locations']['deleted'], [1])
+        await stream.aclose()
+        self.assertFalse(get_broker().listening)
+
+    async def test_only_staff_streams_get_events(self):
+        events = {'changed': [{'id': 1, 'name': 'Launch', 'buyer_id': 2, 'buyer': 'Buyer', 'holders': [3], 'created': True}],
+                  'deleted': []}
+        anonymous, staff = LiveUpdates.stream(), LiveUpdates.stream(include_events=True)
+        for stream in (anonymous, staff):
+            await stream.__anext__()
+        get_broker().publish({'type': 'patch', 'locations': {'changed': [], 'deleted': []}, 'events': events})
+        get_broker().publish({'type': 'patch', 'locations': {'changed': [], 'deleted': [1]}, 'events': events})
+
+        message = json.loads((await anonymous.__anext__()).split('data: ', 1)[1])
+        self.assertEqual(message, {'type': 'patch', 'locations': {'changed': [], 'deleted': [1]}})
+        message = json.loads((await staff.__anext__()).split('data: ', 1)[1])
+        self.assertEqual(message['events'], events)
+        for stream in (anonymous, staff):
+            await stream.aclose()
+
+    async def test_slow_streams_are_told_to_reload(self):
+        broker = InProcessBroker()
+        _, queue = broker.subscribe()
+        for number in range(queue.maxsize + 1):
+            broker.deliver({'type': 'patch', 'number': number})
+        await asyncio.sleep(0)
+        self.assertEqual(queue.qsize(), 1)
+        self.assertEqual(queue.get_nowait(), RELOAD)
+
+
+class SnapshotTests(MapTestCase):
+    """Pre-serialized snapshots and their debounced rebuilds."""
+
+    def setUp(self):
+        super().setUp()
+        self.location = Location.objects.create(name='A', country='Israel', latitude=32.08, longitude=34.78)
+        Location.objects.create(name='B', country='France', latitude=48.85, longitude=2.35)
+        self.addCleanup(self.reset_builder)
+
+    @staticmethod
+    def reset_builder():
+        if SnapshotBuilder._timer is not None:
+            SnapshotBuilder._timer.cancel()
+        SnapshotBuilder._pending, SnapshotBuilder._first_change, SnapshotBuilder._timer = set(), None, None
+
+    def snapshot(self, **params):
+        response = self.client.get('/map/api/snapshot', params, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual((response.status_code, response['Content-Encoding']), (200, 'gzip'))
+        return json.loads(gzip.decompress(b''.join(response.streaming_content)))
+
+    def test_snapshots_are_built_once_per_filter(self):
+        data = self.snapshot()
+        self.assertEqual([location['name'] for location in data['locations']], ['A', 'B'])
+        self.assertEqual(self.snapshot(country='israel')['count'], 1)
+
+        response = self.client.get('/map/api/snapshot')
+        self.assertEqual(json.loads(response.content)['count'], 2)
+        with self.assertNumQueries(0):
+            cached = self.client.get('/map/api/snapshot', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_unknown_filters_are_rejected(self):
+        for params in ({'country': 'Atlantis'}, {'type': 'shop'}, {'category': 'pirates'}):
+            self.assertEqual(self.client.get('/map/api/snapshot', params).status_code, 400)
+        self.assertFalse(snapshot_dir().exists())
+
+    def test_changes_rebuild_the_matching_snapshots(self):
+        self.snapshot()
+        self.snapshot(country='France')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.location.name = 'Renamed'
+            self.location.save()
+        self.assertEqual(SnapshotBuilder._pending, {('Israel', Location.TYPE_HOLDER, '')})
+
+        # The French snapshot does not list the location
+        self.assertEqual(SnapshotBuilder.rebuild_pending(), 1)
+        self.assertEqual([location['name'] for location in self.snapshot()['locations']], ['Renamed', 'B'])
+
+
+GAZETTEER_ROWS = [
+    # street, house number, city, country, latitude, longitude
+    ('Dizengoff', '', 'Tel Aviv', 'Israel', 32.0810, 34.7740),
+    ('Dizengoff', '50', 'Tel-Aviv', 'Israel', 32.0750, 34.7745),
+    ('Dizengoff 100', '', 'Tel Aviv', 'Israel', 32.0800, 34.7738),
+    ('Herzl', '', 'Haifa', 'Israel', 32.8140, 34.9990),
+    ('Rothschild Boulevard', '', 'Tel Aviv', '', 32.0640, 34.7740),
+]
+
+
+class FailingGeocoder(BaseGeocoder):
+    def geocode(self, address, city=None, country=None):
+        raise ConnectionError("service unavailable")
+
+
+class GazetteerGeocoderTests(TestCase):
+    """Offline lookups against a small index, and the fallback chain (no network involved)."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.path = f"{directory}/gazetteer.idx"
+        self.assertEqual(build_index(GAZETTEER_ROWS, self.path), len(GAZETTEER_ROWS))
+        self.geocoder = GazetteerGeocoder(self.path)
+        self.addCleanup(self.geocoder.close)
+
+    def test_house_numbers_and_streets(self):
+        self.assertEqual(self.geocoder.geocode('Dizengoff 50', 'tel aviv', 'israel'), (32.075, 34.7745))
+        # Closest known house on the street
+        self.assertEqual(self.geocoder.geocode('Dizengoff 97', 'Tel Aviv', 'Israel'), (32.08, 34.7738))
+        self.assertEqual(self.geocoder.geocode('  dizengoff ', 'Tel Aviv', 'Israel'), (32.081, 34.774))
+
+    def test_prefix_and_fuzzy_matches(self):
+        # Extract without a country column, street name completed from its prefix
+        self.assertEqual(self.geocoder.geocode('Rothschild 12', 'Tel Aviv', 'Israel'), (32.064, 34.774))
+        self.assertEqual(self.geocoder.geocode('Dizengof 50', 'Tel Aviv', 'Israel'), (32.075, 34.7745))
+        self.assertEqual(self.geocoder.geocode('Herzel', 'Haifa', 'Israel'), (32.814, 34.999))
+
+    def test_unknown_addresses_are_not_found(self):
+        self.assertIsNone(self.geocoder.geocode('Allenby 5', 'Tel Aviv', 'Israel'))
+        self.assertIsNone(self.geocoder.geocode('Dizengoff 50', 'Haifa', 'Israel'))
+        self.assertIsNone(self.geocoder.reverse(32.075, 34.7745))
+
+    def test_fallback_chain(self):
+        static = StaticGeocoder(data={'Allenby 5, Tel Aviv, Israel': [32.07, 34.77]})
+        chain = FallbackGeocoder([self.geocoder, static])
+        self.assertEqual(chain.geocode('Dizengoff 50', 'Tel Aviv', 'Israel'), (32.075, 34.7745))
+        self.assertEqual(chain.geocode('Allenby 5', 'Tel Aviv', 'Israel'), (32.07, 34.77))
+        self.assertIsNone(chain.geocode('Nowhere 1', 'Tel Aviv', 'Israel'))
+
+        # Errors only surface when no backend answered
+        self.assertEqual(FallbackGeocoder([FailingGeocoder(), static]).geocode('Allenby 5', 'Tel Aviv', 'Israel'), (32.07, 34.77))
+        with self.assertRaises(ConnectionError):
+            FallbackGeocoder([self.geocoder, FailingGeocoder()]).geocode('Nowhere 1', 'Tel Aviv', 'Israel')
+
+    async def test_async_lookups(self):
+        chain = FallbackGeocoder([self.geocoder])
+        self.assertEqual(await chain.ageocode('Dizengoff 50', 'Tel Aviv', 'Israel'), (32.075, 34.7745))
+
+
+class AddressNormalizerTests(TestCase):
+    """Rule tables applied in one pass, per country, and the batch API."""
+
+    def setUp(self):
+        self.normalizer = AddressNormalizer.from_file(DEFAULT_RULES_FILE)
+
+    def test_default_rules(self):
+        self.assertEqual(
+            self.normalizer.normalize('  SHDEROT  ben-gurion 12 ', 'tel-aviv yafo', 'israel'),
+            ('Sderot Ben Gurion 12', 'Tel Aviv', 'Israel'),
+        )
+        self.assertEqual(self.normalizer.normalize('Rechov Herzel 3', 'HEFA', 'IL'), ('Rehov Herzl 3', 'Haifa', 'Israel'))
+        # Whole words only, other cities and countries are capitalized
+        self.assertEqual(self.normalizer.normalize('Sderotayim 1', 'kfar saba', 'france'), ('Sderotayim 1', 'Kfar Saba', 'France'))
+        self.assertEqual(self.normalizer.normalize('', None, ''), ('', None, ''))
+
+    def test_rules_are_per_country(self):
+        normalizer = AddressNormalizer({
+            '*': {'abbreviations': {'st.': 'Street'}},
+            'ireland': {'transliterations': {'baile atha cliath': 'Dublin'}, 'city_aliases': {'baile atha cliath': 'Dublin'}},
+        }, default_country='Ireland')
+        self.assertEqual(normalizer.normalize('Main St. 4', 'baile atha cliath', ''), ('Main Street 4', 'Dublin', ''))
+        self.assertEqual(normalizer.normalize('Main St. 4', 'baile atha cliath', 'Scotland'), ('Main Street 4', 'Baile Atha Cliath', 'Scotland'))
+
+    def test_normalize_many(self):
+        rows = [('Dizengof 5', 'Tel Aviv', 'Israel'), ['Dizengof 5', 'Tel Aviv', 'Israel'], ('Herzel 1', 'haifa', 'israel')]
+        self.assertEqual(self.normalizer.normalize_many(rows), [
+            ('Dizengoff 5', 'Tel Aviv', 'Israel'),
+            ('Dizengoff 5', 'Tel Aviv', 'Israel'),
+            ('Herzl 1', 'Haifa', 'Israel'),
+        ])
@@ -0,0 +1,190 @@
+"""Binary point tiles of the location layer, cached on disk per z/x/y.
+
+Between the cluster zooms and the zoom where logo markers take over, the map
+draws locations on a canvas from these tiles instead of one DOM marker each.
+A tile is little-endian and column-oriented, so the browser can wrap it in
+typed arrays without parsing:
+
+    b'FCT1'  uint32 count
+    uint32 id[count]  uint16 x[count]  uint16 y[count]  uint8 type[count]  uint8 category[count]
+
+x / y are pixel positions inside the tile scaled to TILE_EXTENT; type and
+category are indexes into TYPE_CODES / CATEGORY_CODES. Tiles are written to
+TILE_CACHE_DIR/<filter key>/<z>/<x>/<y>.bin on first request, and a Location
+save or delete removes the files of the tiles containing its old and new
+position (see map.signals). Invalidation also rewrites a marker per tile under
+TILE_CACHE_DIR/.invalidated, so a tile whose rendering overlapped it (and may
+have read the rows from before the change) is rendered again instead of kept.
+"""
+import hashlib
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from django.conf import settings
+from .clustering import CELLS_PER_TILE, CLUSTER_MAX_ZOOM, MAX_LATITUDE, cell_for
+from .models import Location
+
+
+# Point tiles are served between the cluster zooms and the zooms showing logo markers
+TILE_MIN_ZOOM = CLUSTER_MAX_ZOOM + 1
+TILE_MAX_ZOOM = 16
+
+# Coordinate resolution inside a tile
+TILE_EXTENT = 4096
+
+TILE_MAGIC = b'FCT1'
+
+TYPE_CODES = [choice for choice, _ in Location.TYPE_CHOICES]
+CATEGORY_CODES = [''] + [choice for choice, _ in Location.CATEGORY_CHOICES]
+
+TILE_FIELDS = ('id', 'latitude', 'longitude', 'location_type', 'category')
+
+# Directory of the per-tile invalidation markers inside TILE_CACHE_DIR
+MARKER_DIR = '.invalidated'
+
+# Renderings of a tile that keep overlapping its invalidation before it is left uncached
+RENDER_ATTEMPTS = 2
+
+
+def tile_cache_dir() -> Path:
+    return Path(getattr(settings, 'TILE_CACHE_DIR', Path(settings.BASE_DIR) / 'tile_cache'))
+
+
+def filter_key(country='', location_type='', category='') -> str:
+    """Directory name of one filter combination."""
+    if not (country or location_type or category):
+        return 'all'
+    return hashlib.sha1(repr((country.lower(), location_type, category)).encode('utf-8')).hexdigest()[:16]
+
+
+def tile_path(key: str, zoom: int, x: int, y: int) -> Path:
+    return tile_cache_dir() / key / str(zoom) / str(x) / f"{y}.bin"
+
+
+def marker_path(zoom: int = None, x: int = None, y: int = None) -> Path:
+    """Invalidation marker of one tile, or of every tile (clear_tiles) without arguments."""
+    if zoom is None:
+        return tile_cache_dir() / MARKER_DIR / 'all'
+    return tile_cache_dir() / MARKER_DIR / str(zoom) / str(x) / str(y)
+
+
+def _write_atomic(path: Path, data: bytes):
+    """Replace a file so readers never see a partial one."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as out:
+        out.write(data)
+    os.replace(temp, path)
+
+
+def touch_marker(marker: Path):
+    # A fresh token rather than an mtime, which may not change within a coarse timestamp
+    _write_atomic(marker, os.urandom(8))
+
+
+def invalidation_state(zoom: int, x: int, y: int) -> tuple:
+    """Tokens of the markers covering a tile; they differ after any invalidation of it."""
+    state = []
+    for marker in (marker_path(zoom, x, y), marker_path()):
+        try:
+            state.append(marker.read_bytes())
+        except FileNotFoundError:
+            state.append(None)
+    return tuple(state)
+
+
+def tile_bounds(zoom: int, x: int, y: int):
+    """(west, south, east, north) of a Web Mercator tile."""
+    count = 1 << zoom
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / count))))
+
+    return x / count * 360.0 - 180.0, latitude(y + 1), (x + 1) / count * 360.0 - 180.0, latitude(y)
+
+
+def tile_for(latitude: float, longitude: float, zoom: int):
+    """(x, y) of the tile containing a coordinate."""
+    cell_x, cell_y = cell_for(latitude, longitude, zoom)
+    return cell_x // CELLS_PER_TILE, cell_y // CELLS_PER_TILE
+
+
+def encode_tile(zoom: int, x: int, y: int, rows) -> bytes:
+    """Pack (id, latitude, longitude, location_type, category) rows into the tile format."""
+    ids, xs, ys, types, categories = array('I'), array('H'), array('H'), array('B'), array('B')
+    scale = (1 << zoom) * TILE_EXTENT
+    for pk, latitude, longitude, location_type, category in rows:
+        latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, float(latitude)))
+        world_x = (float(longitude) + 180.0) / 360.0 * scale
+        world_y = (1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * scale
+        ids.append(pk)
+        xs.append(min(TILE_EXTENT - 1, max(0, int(world_x - x * TILE_EXTENT))))
+        ys.append(min(TILE_EXTENT - 1, max(0, int(world_y - y * TILE_EXTENT))))
+        types.append(TYPE_CODES.index(location_type) if location_type in TYPE_CODES else 0)
+        categories.append(CATEGORY_CODES.index(category) if category in CATEGORY_CODES else 0)
+    if sys.byteorder == 'big':
+        for column in (ids, xs, ys):
+            column.byteswap()
+    return b''.join((
+        TILE_MAGIC, struct.pack('<I', len(ids)),
+        ids.tobytes(), xs.tobytes(), ys.tobytes(), types.tobytes(), categories.tobytes(),
+    ))
+
+
+def render_tile(zoom: int, x: int, y: int, queryset) -> bytes:
+    """Encode the locations of queryset inside a tile."""
+    rows = queryset.in_bbox(*tile_bounds(zoom, x, y)).order_by('id').values_list(*TILE_FIELDS)
+    return encode_tile(zoom, x, y, rows.iterator(chunk_size=2000))
+
+
+def load_tile(zoom: int, x: int, y: int, queryset, key: str) -> Path:
+    """Path of the cached tile file, rendering and writing it first if missing.
+
+    A tile invalidated while it was rendered may hold rows from before the change,
+    so it is rendered again; after RENDER_ATTEMPTS the file is left out instead.
+    """
+    path = tile_path(key, zoom, x, y)
+    if path.exists():
+        return path
+    # Created first, so an invalidation during rendering finds the cache and leaves its markers
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for _ in range(RENDER_ATTEMPTS):
+        before = invalidation_state(zoom, x, y)
+        _write_atomic(path, render_tile(zoom, x, y, queryset))
+        if invalidation_state(zoom, x, y) == before:
+            return path
+    path.unlink(missing_ok=True)
+    return path
+
+
+def invalidate_tiles(points):
+    """Remove the cached tiles (of every filter combination) containing any (latitude, longitude) point."""
+    root = tile_cache_dir()
+    if not root.is_dir():
+        return
+    tiles = set()
+    for latitude, longitude in points:
+        for zoom in range(TILE_MIN_ZOOM, TILE_MAX_ZOOM + 1):
+            tiles.add((zoom, *tile_for(float(latitude), float(longitude), zoom)))
+    # Marked before the files go, so a rendering that writes in between is redone too
+    for zoom, x, y in tiles:
+        touch_marker(marker_path(zoom, x, y))
+    for key in os.listdir(root):
+        if key == MARKER_DIR:
+            continue
+        for zoom, x, y in tiles:
+            try:
+                os.remove(tile_path(key, zoom, x, y))
+            except FileNotFoundError:
+                pass
+
+
+def clear_tiles():
+    """Remove every cached tile (after bulk changes that bypass signals)."""
+    shutil.rmtree(tile_cache_dir(), ignore_errors=True)
+    touch_marker(marker_path())
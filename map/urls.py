@@ -5,4 +5,15 @@ app_name = 'map'
 
 urlpatterns = [
     path('', views.map_view, name='index'),
+    path('api/locations', views.locations_api, name='api_locations'),
+    path('api/locations/<int:location_id>', views.location_detail_api, name='api_location'),
+    path('api/sync', views.sync_api, name='api_sync'),
+    path('api/snapshot', views.location_snapshot, name='api_snapshot'),
+    path('live', views.live_updates, name='live_updates'),
+    path('api/clusters/<int:zoom>/<int:x>/<int:y>', views.clusters_api, name='api_clusters'),
+    path('api/recommendations', views.recommendations_api, name='api_recommendations'),
+    path('api/export/<str:dataset>.<str:fmt>', views.export_api, name='api_export'),
+    path('tiles/<int:zoom>/<int:x>/<int:y>.bin', views.location_tile, name='location_tile'),
+    path('heatmap/<int:zoom>/<int:x>/<int:y>.bin', views.business_heatmap, name='business_heatmap'),
+    path('media/<path:name>', views.image_variant, name='image_variant'),
 ]
@@ -1,76 +1,153 @@
-"""Utility functions for geocoding."""
+"""Utility functions for geocoding (blocking and async variants)."""
+import asyncio
 import time
-import requests
+from datetime import timedelta
 from typing import Optional, Tuple
+from django.utils import timezone
+from .geocache import GeocodeCache, forward_query, reverse_query
+from .geocoders import get_default_geocoder
+from .models import RateLimit
 
 
 class GeocodeRateLimiter:
-    """Simple rate limiter for Nominatim API (1 request per second)."""
-    last_request_time = 0
+    """Rate limiter for Nominatim API (1 request per second), shared by all processes via the DB."""
+    name = 'nominatim'
     min_interval = 1.0
     
+    @classmethod
+    def with_rate(cls, rate: float):
+        """Limiter on the same shared slot at another rate (requests per second); cls is left untouched."""
+        return type(cls.__name__, (cls,), {'min_interval': 1.0 / rate})
+    
     @classmethod
     def wait_if_needed(cls):
-        """Wait if necessary to respect rate limit."""
-        elapsed = time.time() - cls.last_request_time
-        if elapsed < cls.min_interval:
-            time.sleep(cls.min_interval - elapsed)
-        cls.last_request_time = time.time()
+        """Wait until this process owns the next request slot."""
+        while True:
+            now = timezone.now()
+            claimed = RateLimit.objects.filter(name=cls.name, next_allowed_at__lte=now).update(
+                next_allowed_at=now + timedelta(seconds=cls.min_interval)
+            )
+            if claimed:
+                return
+            slot, created = RateLimit.objects.get_or_create(name=cls.name, defaults={'next_allowed_at': now})
+            if not created:
+                wait = (slot.next_allowed_at - now).total_seconds()
+                time.sleep(min(max(wait, 0.01), cls.min_interval))
+    
+    @classmethod
+    async def await_slot(cls):
+        """Async wait_if_needed(): sleeps on the event loop instead of blocking a thread."""
+        while True:
+            now = timezone.now()
+            claimed = await RateLimit.objects.filter(name=cls.name, next_allowed_at__lte=now).aupdate(
+                next_allowed_at=now + timedelta(seconds=cls.min_interval)
+            )
+            if claimed:
+                return
+            slot, created = await RateLimit.objects.aget_or_create(name=cls.name, defaults={'next_allowed_at': now})
+            if not created:
+                wait = (slot.next_allowed_at - now).total_seconds()
+                await asyncio.sleep(min(max(wait, 0.01), cls.min_interval))
 
 
-def geocode_address(address: str, city: str = None, country: str = None) -> Optional[Tuple[float, float]]:
-    """Convert address to coordinates using Nominatim (OpenStreetMap)."""
-    query_parts = [address]
-    if city:
-        query_parts.append(city)
-    if country:
-        query_parts.append(country)
+def geocode_address(address: str, city: str = None, country: str = None, use_cache: bool = True, raise_errors: bool = False) -> Optional[Tuple[float, float]]:
+    """Convert address to coordinates with the configured geocoder (Nominatim by default).
     
-    query = ", ".join(query_parts)
-    GeocodeRateLimiter.wait_if_needed()
+    Returns None when the address is not found. Transport errors also return None
+    unless raise_errors is set, so callers can retry them.
+    """
+    cache_query = forward_query(address, city, country)
+    if use_cache:
+        cached = GeocodeCache.get_forward(cache_query)
+        if cached is not GeocodeCache.MISS:
+            return cached
+    
+    geocoder = get_default_geocoder()
+    if geocoder.default_rate:
+        GeocodeRateLimiter.wait_if_needed()
     
     try:
-        url = "https://nominatim.openstreetmap.org/search"
-        params = {'q': query, 'format': 'json', 'limit': 1}
-        headers = {'User-Agent': 'FreeCups-Django-App/1.0'}
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        if data:
-            return (float(data[0]['lat']), float(data[0]['lon']))
+        coords = geocoder.geocode(address, city, country)
         
+    except Exception as e:
+        # Transport errors are not cached, only definitive answers
+        if raise_errors:
+            raise
+        print(f"Geocoding error for '{cache_query}': {e}")
         return None
+    
+    if use_cache:
+        GeocodeCache.set_forward(cache_query, coords)
+    return coords
+
+
+async def ageocode_address(address: str, city: str = None, country: str = None, use_cache: bool = True, raise_errors: bool = False) -> Optional[Tuple[float, float]]:
+    """Async geocode_address(): cache, rate limit and request never block a thread."""
+    cache_query = forward_query(address, city, country)
+    if use_cache:
+        cached = await GeocodeCache.aget_forward(cache_query)
+        if cached is not GeocodeCache.MISS:
+            return cached
+    
+    geocoder = get_default_geocoder()
+    if geocoder.default_rate:
+        await GeocodeRateLimiter.await_slot()
+    
+    try:
+        coords = await geocoder.ageocode(address, city, country)
         
     except Exception as e:
-        print(f"Geocoding error for '{query}': {e}")
+        if raise_errors:
+            raise
+        print(f"Geocoding error for '{cache_query}': {e}")
         return None
+    
+    if use_cache:
+        await GeocodeCache.aset_forward(cache_query, coords)
+    return coords
 
 
-def reverse_geocode(latitude: float, longitude: float) -> Optional[dict]:
-    """Convert coordinates to address using Nominatim (OpenStreetMap)."""
-    GeocodeRateLimiter.wait_if_needed()
+def reverse_geocode(latitude: float, longitude: float, use_cache: bool = True) -> Optional[dict]:
+    """Convert coordinates to address with the configured geocoder (Nominatim by default)."""
+    cache_query = reverse_query(latitude, longitude)
+    if use_cache:
+        cached = GeocodeCache.get_reverse(cache_query)
+        if cached is not GeocodeCache.MISS:
+            return cached
+    
+    geocoder = get_default_geocoder()
+    if geocoder.default_rate:
+        GeocodeRateLimiter.wait_if_needed()
     
     try:
-        url = "https://nominatim.openstreetmap.org/reverse"
-        params = {'lat': latitude, 'lon': longitude, 'format': 'json'}
-        headers = {'User-Agent': 'FreeCups-Django-App/1.0'}
-        
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        if 'address' in data:
-            return {
-                'full_address': data.get('display_name', ''),
-                'address': data.get('address', {}),
-                'city': data['address'].get('city') or data['address'].get('town') or data['address'].get('village'),
-                'country': data['address'].get('country'),
-            }
-        
+        result = geocoder.reverse(latitude, longitude)
+    except Exception as e:
+        print(f"Reverse geocoding error for ({latitude}, {longitude}): {e}")
         return None
-        
+    
+    if use_cache:
+        GeocodeCache.set_reverse(cache_query, result)
+    return result
+
+
+async def areverse_geocode(latitude: float, longitude: float, use_cache: bool = True) -> Optional[dict]:
+    """Async reverse_geocode()."""
+    cache_query = reverse_query(latitude, longitude)
+    if use_cache:
+        cached = await GeocodeCache.aget_reverse(cache_query)
+        if cached is not GeocodeCache.MISS:
+            return cached
+    
+    geocoder = get_default_geocoder()
+    if geocoder.default_rate:
+        await GeocodeRateLimiter.await_slot()
+    
+    try:
+        result = await geocoder.areverse(latitude, longitude)
     except Exception as e:
         print(f"Reverse geocoding error for ({latitude}, {longitude}): {e}")
         return None
+    
+    if use_cache:
+        await GeocodeCache.aset_reverse(cache_query, result)
+    return result
@@ -1,8 +1,126 @@
+import gzip
+import hashlib
+import math
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max, Min
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
-from .models import Location
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from .models import Location, LocationTombstone
+from .caching import ageneration, aversioned_key, cache_timeout
+from .clustering import CLUSTER_MAX_ZOOM, aclusters_for_tile
+from .export import CONTENT_TYPES, DATASETS, default_queryset, stream_export
+from .facets import LocationFacets
+from .heatmap import heatmap_tile
+from .realtime import LiveUpdates
+from .recommendations import HolderRecommender
+from .snapshots import load_snapshot
+from .sync import (
+    avalidators, changed_since, decode_cursor, filter_tombstones, next_cursor, tombstone_retention,
+)
+from .tiles import TILE_EXTENT, TILE_MAX_ZOOM, TILE_MIN_ZOOM, TYPE_CODES, filter_key, load_tile
+from .images import VARIANT_CONTENT_TYPES, current_manifest, image_url, variant_srcset, variant_url
 
 
-def map_view(request):
+# Hard cap on markers returned for a single viewport request
+MAX_API_LOCATIONS = 5000
+
+# Snapshots change only after a debounced rebuild; clients revalidate with their ETag
+SNAPSHOT_CACHE_CONTROL = 'public, no-cache'
+
+# Changes per sync page
+MAX_SYNC_CHANGES = 5000
+
+# Sync and viewport responses are revalidated every time (answered with 304 while unchanged)
+REVALIDATE_CACHE_CONTROL = 'private, no-cache'
+
+# Columns needed to draw a marker and its popup
+API_LOCATION_FIELDS = (
+    'id', 'latitude', 'longitude', 'name', 'address', 'city', 'country',
+    'location_type', 'category', 'company_logo', 'company_logo_url',
+    'product_photo', 'product_photo_url',
+    'company_logo_hash', 'product_photo_hash', 'image_variants',
+)
+
+# Marker icons are at most 60px wide; the 64px variant covers them
+MARKER_ICON_WIDTH = 64
+
+# Variant files are content-addressed, so browsers may keep them forever
+VARIANT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Point tiles change in place; browsers reuse them briefly and then revalidate with the ETag
+TILE_CACHE_CONTROL = 'public, max-age=60, stale-while-revalidate=600'
+
+
+def filter_locations(queryset, country='', location_type='', category=''):
+    """Apply the map filter dropdowns to a Location queryset."""
+    if country:
+        queryset = queryset.filter(country__iexact=country)
+    if location_type:
+        queryset = queryset.filter(location_type=location_type)
+    if category:
+        queryset = queryset.filter(category=category)
+    return queryset
+
+
+def known_filters(request):
+    """The (country, type, category) query params, or None if one matches no location.
+
+    Endpoints caching a file per filter combination only accept these, so made-up
+    values cannot fill the disk. Countries are checked against the cached facets.
+    """
+    country = request.GET.get('country', '').strip()
+    location_type = request.GET.get('type', '').strip()
+    category = request.GET.get('category', '').strip()
+    if location_type and location_type not in dict(Location.TYPE_CHOICES):
+        return None
+    if category and category not in dict(Location.CATEGORY_CHOICES):
+        return None
+    if country and country.lower() not in {name.lower() for name, _ in LocationFacets.get()['countries']}:
+        return None
+    return country, location_type, category
+
+
+def parse_bbox(value):
+    """Parse 'west,south,east,north' into floats, or return None if invalid."""
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= south <= north <= 90) or not (-180 <= west <= 180 and -180 <= east <= 180):
+        return None
+    return west, south, east, north
+
+
+def serialize_location(row):
+    """Build the compact marker payload from a .values() row."""
+    logo_variants = current_manifest(row['image_variants'], 'company_logo', row['company_logo_hash'])
+    photo_variants = current_manifest(row['image_variants'], 'product_photo', row['product_photo_hash'])
+    logo = image_url('company_logo', row['company_logo'], row['company_logo_url'], row['company_logo_hash'])
+    return {
+        'id': row['id'],
+        'lat': float(row['latitude']),
+        'lng': float(row['longitude']),
+        'name': row['name'],
+        'address': row['address'],
+        'city': row['city'],
+        'country': row['country'],
+        'type': row['location_type'],
+        'category': row['category'],
+        'logo': logo,
+        'logo_icon': variant_url('company_logo', logo_variants, MARKER_ICON_WIDTH) or logo,
+        'logo_srcset': variant_srcset('company_logo', logo_variants),
+        'product_image': image_url('product_photo', row['product_photo'], row['product_photo_url'], row['product_photo_hash']),
+        'product_srcset': variant_srcset('product_photo', photo_variants),
+    }
+
+
+async def map_view(request):
     """Display interactive map with buyers, holders, and businesses."""
     country_filter = request.GET.get('country', '').strip()
     type_filter = request.GET.get('type', '').strip()
@@ -12,30 +130,353 @@ def map_view(request):
     if not country_filter and not request.GET:
         country_filter = 'Israel'
     
-    # Apply filters
-    locations = Location.objects.all()
-    if country_filter:
-        locations = locations.filter(country__iexact=country_filter)
-    if type_filter:
-        locations = locations.filter(location_type=type_filter)
-    if category_filter:
-        locations = locations.filter(category=category_filter)
-    
-    # Get filter options
-    countries = [c for c in Location.objects.values_list('country', flat=True).distinct().order_by('country') if c]
+    # The page does not depend on the visitor, so anonymous traffic is served from the cache without DB access
+    page_key = await aversioned_key('page', country_filter, type_filter, category_filter)
+    user = await request.auser()
+    cacheable = not user.is_authenticated
+    if cacheable:
+        content = await cache.aget(page_key)
+        if content is not None:
+            return HttpResponse(content)
     
-    # Only show valid categories that exist in DB (intersect CATEGORY_CHOICES with actual data)
-    valid_category_keys = [choice[0] for choice in Location.CATEGORY_CHOICES]
-    categories_in_use = Location.objects.filter(category__in=valid_category_keys).values_list('category', flat=True).distinct()
-    categories = [(key, dict(Location.CATEGORY_CHOICES)[key]) for key in sorted(categories_in_use) if key]
+    # Markers are loaded per viewport from locations_api; only the extent is needed here
+    locations = filter_locations(
+        Location.objects.filter(latitude__isnull=False, longitude__isnull=False),
+        country_filter, type_filter, category_filter,
+    )
+    extent = await locations.aaggregate(
+        count=Count('id'),
+        south=Min('latitude'), north=Max('latitude'),
+        west=Min('longitude'), east=Max('longitude'),
+    )
+    if extent['count']:
+        extent = {key: float(value) for key, value in extent.items()}
+        extent['count'] = int(extent['count'])
+    else:
+        extent = None
     
     context = {
-        'locations': locations,
-        'countries': countries,
-        'categories': categories,
+        'extent': extent,
+        # Filter options with counts (the dropdowns are also fragment-cached in the template)
+        'facets': await LocationFacets.aget(),
+        'cache_generation': await ageneration(),
+        'cache_timeout': cache_timeout(),
+        'category_labels': dict(Location.CATEGORY_CHOICES),
+        'cluster_max_zoom': CLUSTER_MAX_ZOOM,
+        'tile_max_zoom': TILE_MAX_ZOOM,
+        'tile_extent': TILE_EXTENT,
+        'tile_types': TYPE_CODES,
         'selected_country': country_filter,
         'type_filter': type_filter,
         'category_filter': category_filter,
     }
-    return render(request, 'map/index.html', context)
+    response = render(request, 'map/index.html', context)
+    if cacheable:
+        await cache.aset(page_key, response.content, cache_timeout())
+    return response
+
+
+async def locations_api(request):
+    """Return locations inside the requested viewport as compact JSON.
+
+    Query params: bbox=west,south,east,north (required), country, type, category.
+    """
+    bbox = parse_bbox(request.GET.get('bbox'))
+    if bbox is None:
+        return JsonResponse({'error': "bbox must be 'west,south,east,north'"}, status=400)
+    west, south, east, north = bbox
+
+    filters = (
+        request.GET.get('country', '').strip(),
+        request.GET.get('type', '').strip(),
+        request.GET.get('category', '').strip(),
+    )
+    locations = filter_locations(Location.objects.in_bbox(west, south, east, north), *filters)
+
+    # Any removal matching the filters counts as a change, whether or not it was in this viewport
+    not_modified, validators = await aconditional(
+        request, locations, filter_tombstones(LocationTombstone.objects.all(), *filters)
+    )
+    if not_modified:
+        return not_modified
+
+    rows = [row async for row in locations.values(*API_LOCATION_FIELDS).order_by('id')[:MAX_API_LOCATIONS + 1]]
+    truncated = len(rows) > MAX_API_LOCATIONS
+
+    return with_validators(JsonResponse({
+        'locations': [serialize_location(row) for row in rows[:MAX_API_LOCATIONS]],
+        'truncated': truncated,
+    }), validators)
+
+
+async def aconditional(request, locations, tombstones):
+    """Return (304 response or None, validators) for a filtered view of locations."""
+    etag, last_modified = await avalidators(locations, tombstones)
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+    if not_modified is not None:
+        not_modified = with_validators(not_modified, (etag, last_modified))
+    return not_modified, (etag, last_modified)
+
+
+def with_validators(response, validators):
+    etag, last_modified = validators
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = REVALIDATE_CACHE_CONTROL
+    return response
+
+
+async def live_updates(request):
+    """Server-Sent Events stream of batched location changes, plus event changes for staff (see map.realtime)."""
+    if not isinstance(request, ASGIRequest):
+        # A WSGI worker would be held for as long as the page stays open
+        return JsonResponse({'error': "live updates need the ASGI server (freecups.asgi)"}, status=501)
+    user = await request.auser()
+    response = StreamingHttpResponse(LiveUpdates.stream(include_events=user.is_staff), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def sync_api(request):
+    """Locations changed and removed since a cursor, for clients keeping a local copy.
+
+    Query params: since (cursor of the previous response; omit to get everything),
+    limit, country, type, category. Apply `deleted` before `changes` and call
+    again with the returned cursor while `more` is true.
+    """
+    filters = (
+        request.GET.get('country', '').strip(),
+        request.GET.get('type', '').strip(),
+        request.GET.get('category', '').strip(),
+    )
+    try:
+        limit = int(request.GET.get('limit', MAX_SYNC_CHANGES))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= MAX_SYNC_CHANGES:
+        return JsonResponse({'error': f"limit must be between 1 and {MAX_SYNC_CHANGES}"}, status=400)
+
+    since, last_id, reset = None, 0, False
+    if request.GET.get('since'):
+        cursor = decode_cursor(request.GET['since'])
+        if cursor is None:
+            return JsonResponse({'error': "invalid since cursor"}, status=400)
+        since, last_id = cursor
+        if since < timezone.now() - tombstone_retention():
+            # Removals this old are forgotten: start over
+            since, last_id, reset = None, 0, True
+
+    locations = filter_locations(Location.objects.filter(latitude__isnull=False, longitude__isnull=False), *filters)
+    tombstones = filter_tombstones(LocationTombstone.objects.all(), *filters)
+    not_modified, validators = await aconditional(request, locations, tombstones)
+    if not_modified:
+        return not_modified
+
+    rows = [
+        row async for row in changed_since(locations, since, last_id).values(*API_LOCATION_FIELDS, 'updated_at')[:limit + 1]
+    ]
+    more = len(rows) > limit
+    rows = rows[:limit]
+    deleted = []
+    if since is not None:
+        # Only ids no longer in the view: a tombstone is written for any filter change (the client
+        # may not filter on that field), and a location that left and re-entered is just a change
+        deleted = [location_id async for location_id in tombstones.filter(deleted_at__gte=since).exclude(
+            location_id__in=locations.values('id')
+        ).values_list('location_id', flat=True).distinct()]
+
+    changes = []
+    for row in rows:
+        change = serialize_location(row)
+        change['updated_at'] = row['updated_at'].isoformat()
+        changes.append(change)
+    return with_validators(JsonResponse({
+        'cursor': next_cursor(rows[-1] if rows else None, since, last_id, more),
+        'changes': changes,
+        'deleted': deleted,
+        'more': more,
+        'reset': reset,
+    }), validators)
+
+
+async def clusters_api(request, zoom, x, y):
+    """Return precomputed clusters for map tile zoom/x/y with per-type and per-category counts.
+
+    Query params: country, type, category.
+    """
+    if zoom > CLUSTER_MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        return JsonResponse({'error': f"no clusters for tile {zoom}/{x}/{y}"}, status=404)
+
+    clusters = await aclusters_for_tile(
+        zoom, x, y,
+        country=request.GET.get('country', '').strip(),
+        location_type=request.GET.get('type', '').strip(),
+        category=request.GET.get('category', '').strip(),
+    )
+    return JsonResponse({'clusters': clusters})
+
+
+async def location_detail_api(request, location_id):
+    """Popup payload of one location (point tiles only carry ids)."""
+    row = await Location.objects.filter(
+        id=location_id, latitude__isnull=False, longitude__isnull=False
+    ).values(*API_LOCATION_FIELDS).afirst()
+    if row is None:
+        return JsonResponse({'error': "Unknown location"}, status=404)
+    return JsonResponse(serialize_location(row))
+
+
+def location_tile(request, zoom, x, y):
+    """Binary point tile (see map.tiles) for z/x/y, served from the disk cache.
+
+    Query params: country, type, category.
+    """
+    if not TILE_MIN_ZOOM <= zoom <= TILE_MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        raise Http404(f"no point tile {zoom}/{x}/{y}")
+    filters = known_filters(request)
+    if filters is None:
+        return JsonResponse({'error': "unknown country, type or category"}, status=400)
+    queryset = filter_locations(Location.objects.all(), *filters)
+    path = load_tile(zoom, x, y, queryset, filter_key(*filters))
+
+    # Tiles are replaced atomically, so mtime and size identify the content
+    try:
+        stat = path.stat()
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        if request.headers.get('If-None-Match') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+    except FileNotFoundError:
+        # Invalidated between rendering and reading (or while rendering); the next request renders it again
+        response = HttpResponse(status=503)
+        response['Retry-After'] = '1'
+        return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = TILE_CACHE_CONTROL
+    return response
+
+
+def location_snapshot(request):
+    """The whole filtered location layer as one pre-serialized JSON document (see map.snapshots).
+
+    Query params: country, type, category.
+    """
+    filters = known_filters(request)
+    if filters is None:
+        return JsonResponse({'error': "unknown country, type or category"}, status=400)
+    path = load_snapshot(*filters)
+    # Snapshots are swapped in atomically, so mtime and size identify the content
+    stat = path.stat()
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        # Stored compressed: sent as is
+        response = FileResponse(open(path, 'rb'), content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(path.read_bytes()), content_type='application/json')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    response['Cache-Control'] = SNAPSHOT_CACHE_CONTROL
+    response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def business_heatmap(request, zoom, x, y):
+    """Business density tile (see map.heatmap) for z/x/y.
+
+    Query params: country, category.
+    """
+    if zoom > CLUSTER_MAX_ZOOM or x >= 2 ** zoom or y >= 2 ** zoom:
+        raise Http404(f"no heatmap tile {zoom}/{x}/{y}")
+    filters = known_filters(request)
+    if filters is None:
+        return JsonResponse({'error': "unknown country or category"}, status=400)
+    country, _, category = filters
+    data = heatmap_tile(zoom, x, y, country=country, category=category)
+    etag = f'"{hashlib.sha1(data).hexdigest()[:20]}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type='application/octet-stream')
+    response['ETag'] = etag
+    response['Cache-Control'] = TILE_CACHE_CONTROL
+    return response
+
+
+def image_variant(request, name):
+    """Serve a responsive image variant with immutable caching headers."""
+    extension = name.rsplit('.', 1)[-1]
+    if not name.startswith('variants/') or '..' in name.split('/') or extension not in VARIANT_CONTENT_TYPES:
+        raise Http404("Unknown image variant")
+
+    # The path embeds the source hash, so it doubles as a strong validator
+    etag = f'"{name.rsplit("/", 2)[-2]}-{name.rsplit("/", 1)[-1]}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(default_storage.open(name, 'rb'), content_type=VARIANT_CONTENT_TYPES[extension])
+        except (FileNotFoundError, OSError):
+            raise Http404("Unknown image variant")
+    response['ETag'] = etag
+    response['Cache-Control'] = VARIANT_CACHE_CONTROL
+    return response
+
+
+@staff_member_required
+def export_api(request, dataset, fmt):
+    """Stream a full dataset export ('locations' or 'events') as csv, jsonl or geojson.
+
+    Locations accept the map filters: country, type, category.
+    """
+    if dataset not in DATASETS or fmt not in CONTENT_TYPES:
+        raise Http404("Unknown export")
+    queryset = default_queryset(dataset)
+    if dataset == 'locations':
+        queryset = filter_locations(
+            queryset,
+            request.GET.get('country', '').strip(),
+            request.GET.get('type', '').strip(),
+            request.GET.get('category', '').strip(),
+        )
+    response = StreamingHttpResponse(stream_export(dataset, fmt, queryset), content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{dataset}.{fmt}"'
+    return response
+
+
+@staff_member_required
+def recommendations_api(request):
+    """Rank holders for a buyer's next event.
 
+    Query params: buyer (id, required), limit, category (repeatable), radius (metres), recent_days.
+    """
+    try:
+        buyer = Location.objects.get(id=int(request.GET.get('buyer', '')), location_type=Location.TYPE_BUYER)
+    except (ValueError, Location.DoesNotExist):
+        return JsonResponse({'error': "buyer must be the id of a buyer location"}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', 10)), 100)
+        radius = float(request.GET['radius']) if request.GET.get('radius') else None
+        recent_days = int(request.GET['recent_days']) if request.GET.get('recent_days') else None
+    except ValueError:
+        return JsonResponse({'error': "limit, radius and recent_days must be numbers"}, status=400)
+    if limit < 1:
+        return JsonResponse({'error': "limit must be at least 1"}, status=400)
+    if radius is not None and not (math.isfinite(radius) and radius > 0):
+        return JsonResponse({'error': "radius must be a positive number of metres"}, status=400)
+    try:
+        holders = HolderRecommender.recommend(
+            buyer, limit=limit, categories=request.GET.getlist('category'), radius=radius, recent_days=recent_days,
+        )
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'buyer': buyer.id, 'holders': holders})